@@ -1,176 +1,174 @@
-import base64
-import json
 import logging
 import os
+import threading
 import time
+import uuid
 
 import streamlit as st
 from dotenv import load_dotenv
-
-from llm.V4 import Chatbot, AppBaseModel
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from llm.V4 import Chatbot
+from llm.branching import generate_branched_response
+from llm.cache import ResponseCache
+from llm.capabilities import capabilities, parse_capabilities
+from llm.export import export_chain
+from llm.metrics import start_metrics_server
+from llm.policy import make_policy
+from llm.rate_limit import RateLimiter, admission_session
+from llm.reasoning import generate_response
+from llm.router import Router, parse_fallbacks
+from llm.semantic_cache import SemanticCache
+from llm.store import ChainStore
 
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-client = Chatbot(api_key=os.getenv('OPENAI_API_KEY'), api_url=os.getenv('OPENAI_API_BASE'))
-
-
-class StepResultModel(AppBaseModel):
-    title: str
-    content: str
-    next_action: str
-    confidence: float
-
-
-def make_api_call(messages, max_tokens, temperature=0.5, is_final_answer=False, model="gpt-4o"):
-    for attempt in range(3):
-        try:
-            logger.info(f"尝试进行API调用 (第 {attempt + 1}/3 次尝试)")
-            content, _, _, _ = client.ask(
-                model=model,
-                prompt=messages,
-                json_format=True,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                response_model=StepResultModel
-            )
-            logger.info("API调用成功")
-            logger.info(content)
-            return json.loads(content)
-        except Exception as e:
-            logger.error(f"API调用失败 (第 {attempt + 1}/3 次尝试)。错误: {str(e)}")
-            if attempt == 2:
-                if is_final_answer:
-                    logger.error("3次尝试后未能生成最终答案")
-                    return {
-                        "title": "错误",
-                        "content": f"3次尝试后未能生成最终答案。错误: {str(e)}",
-                    }
-                else:
-                    logger.error("3次尝试后未能生成步骤")
-                    return {
-                        "title": "错误",
-                        "content": f"3次尝试后未能生成步骤。错误: {str(e)}",
-                        "next_action": "final_answer",
-                    }
-            logger.info("等待1秒后重试")
-            time.sleep(1)  # 重试前等待1秒
-
-
-def generate_response(prompt, max_steps=5, temperature=0.5, model="gpt-4o"):
-    logger.info(f"正在为提示生成回答: {prompt}")
-    messages = [
-        {
-            "role": "system",
-            "content": """You are an AI assistant that explains your reasoning step by step, incorporating dynamic Chain of Thought (CoT), reflection, and verbal reinforcement learning. Follow these instructions:
-
-1. Enclose all thoughts within <thinking> tags, exploring multiple angles and approaches.
-2. Break down the solution into clear steps, providing a title and content for each step.
-3. After each step, decide if you need another step or if you're ready to give the final answer.
-4. Continuously adjust your reasoning based on intermediate results and reflections, adapting your strategy as you progress.
-5. Regularly evaluate your progress, being critical and honest about your reasoning process.
-6. Assign a quality score between 0.0 and 1.0 to guide your approach:
-   - 0.8+: Continue current approach
-   - 0.5-0.7: Consider minor adjustments
-   - Below 0.5: Seriously consider backtracking and trying a different approach
-7. If unsure or if your score is low, backtrack and try a different approach, explaining your decision.
-8. For mathematical problems, show all work explicitly using LaTeX for formal notation and provide detailed proofs.
-9. Explore multiple solutions individually if possible, comparing approaches in your reflections.
-10. Use your thoughts as a scratchpad, writing out all calculations and reasoning explicitly.
-11. Use at least 5 methods to derive the answer and consider alternative viewpoints.
-12. Be aware of your limitations as an AI and what you can and cannot do.
-
-After every 3 steps, perform a detailed self-reflection on your reasoning so far, considering potential biases and alternative viewpoints.
-
-Respond in JSON format with 'title', 'content', 'next_action' (either 'continue', 'reflect', or 'final_answer'), and 'confidence' (a number between 0 and 1) keys.
-
-Example of a valid JSON response:
-```json
-{
-    "title": "Identifying Key Information",
-    "content": "To begin solving this problem, we need to carefully examine the given information and identify the crucial elements that will guide our solution process. This involves...",
-    "next_action": "continue",
-    "confidence": 0.8
-}```
-
-Your goal is to demonstrate a thorough, adaptive, and self-reflective problem-solving process, emphasizing dynamic thinking and learning from your own reasoning.""",
-        },
-        {"role": "user", "content": prompt}
-    ]
-
-    steps = []
-    step_count = 1
-    total_thinking_time = 0
-
-    while True:
-        logger.info(f"开始第 {step_count} 步")
-        start_time = time.time()
-        step_data = make_api_call(messages, 4096, temperature=temperature, model=model)
-        end_time = time.time()
-        thinking_time = end_time - start_time
-        total_thinking_time += thinking_time
-
-        logger.info(f"第 {step_count} 步完成。思考时间: {thinking_time:.2f} 秒")
-        steps.append((f"{step_data['title']}", step_data["content"], thinking_time))
-
-        messages.append({"role": "assistant", "content": json.dumps(step_data)})
-
-        if step_data["next_action"] == "final_answer" and step_count < max_steps:
-            messages.append({"role": "user",
-                             "content": "Please continue your analysis with at least 5 more steps before providing the final answer."})
-        elif step_data["next_action"] == "final_answer":
-            logger.info("已达到最终答案或最大步骤数")
-            break
-        elif step_data["next_action"] == 'reflect' or step_count % 3 == 0:
-            messages.append({"role": "user",
-                             "content": "Please perform a detailed self-reflection on your reasoning so far, considering potential biases and alternative viewpoints."})
+if os.getenv('METRICS_PORT'):
+    start_metrics_server(int(os.getenv('METRICS_PORT')))
+
+for prefix, mode in parse_capabilities([os.getenv('MODEL_CAPABILITIES', '')]).items():
+    capabilities.register(prefix, mode)
+
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache(path):
+    return ResponseCache(path=path)
+
+
+@st.cache_resource(show_spinner=False)
+def get_chain_store(path):
+    return ChainStore(path)
+
+
+@st.cache_resource(show_spinner=False)
+def get_semantic_cache(threshold, seed_threshold, path):
+    """所有会话共享的语义缓存，threshold 为空时不启用"""
+    if not threshold:
+        return None
+    return SemanticCache(threshold=float(threshold), seed_threshold=float(seed_threshold or threshold), path=path)
+
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter(rpm, tpm, path):
+    """部署内所有会话共享的限流器，path 不为空时与使用同一状态文件的其他进程共享额度"""
+    if not rpm and not tpm:
+        return None
+    return RateLimiter(rpm=float(rpm) if rpm else None, tpm=float(tpm) if tpm else None, path=path)
+
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def get_client(api_key, api_url, proxy):
+    """
+    每次交互 Streamlit 都会重新执行脚本，客户端按 API key/地址/代理缓存在进程内，
+    所有会话和重跑复用同一组 keep-alive 连接；被淘汰的客户端在回收时关闭连接池
+    """
+    logger.info(f"创建 API 客户端: {api_url or 'https://api.openai.com/v1'}")
+    client = Chatbot(api_key=api_key, api_url=api_url, proxy=proxy,
+                     cache=get_response_cache(os.getenv('RESPONSE_CACHE_PATH')),
+                     rate_limiter=get_rate_limiter(os.getenv('RATE_LIMIT_RPM'), os.getenv('RATE_LIMIT_TPM'),
+                                                   os.getenv('RATE_LIMIT_STATE')))
+    # 配置了备用模型链时，按延迟对冲并在模型不可用时故障转移
+    fallbacks = parse_fallbacks([os.getenv('MODEL_FALLBACKS', '')])
+    if fallbacks:
+        return Router(client, fallbacks, hedge=os.getenv('MODEL_HEDGING', '1') != '0')
+    return client
+
+
+class QueueNotice:
+    """
+    限流器的排队回调，在 container 中显示排队位置，请求被放行后由 clear 清除。
+    分支模式下回调可能来自线程池，需要先把当前脚本的上下文绑定到该线程
+    """
+
+    def __init__(self, container):
+        self.container = container
+        self.ctx = get_script_run_ctx()
+        self.shown = False
+
+    def __call__(self, position, wait):
+        if get_script_run_ctx() is None:
+            add_script_run_ctx(threading.current_thread(), self.ctx)
+        if position:
+            self.container.info(f"⏳ 排队中：前面还有 {position} 个请求")
         else:
-            messages.append({"role": "user", "content": "Please continue with the next step in your analysis."})
-        step_count += 1
-
-        yield steps, None, None  # 我们现在yield三个值,但只有steps是有意义的
-
-    # 生成最终答案
-    messages.append({"role": "user",
-                     "content": "Please provide a comprehensive final answer based on your reasoning above, summarizing key points and addressing any uncertainties. USE JSON Formate"})
-
-    start_time = time.time()
-    final_data = make_api_call(messages, 4096, temperature=temperature, is_final_answer=True, model=model)
-    end_time = time.time()
-    thinking_time = end_time - start_time
-    total_thinking_time += thinking_time
-
-    if 'content' in final_data:
-        final_content = final_data["content"]
-    elif 'final_answer' in final_data:
-        final_content = final_data["final_answer"]
-    else:
-        final_content = json.dumps(final_data)
-    logger.info(f"最终答案已生成。思考时间: {thinking_time:.2f} 秒")
-    steps.append(("最终答案", final_content, thinking_time))
-
-    logger.info(f"总思考时间: {total_thinking_time:.2f} 秒")
-    full_response = {"steps": steps, "total_thinking_time": total_thinking_time}
-    yield steps, total_thinking_time, full_response
-
-
-def get_binary_file_downloader_html(bin_file, file_label="文件"):
-    with open(bin_file, "rb") as f:
-        data = f.read()
-    bin_str = base64.b64encode(data).decode()
-    href = f"""
-    <a href="data:application/octet-stream;base64,{bin_str}" download="{os.path.basename(bin_file)}"
-       style="display: inline-block; padding: 0.5em 1em; color: white; background-color: #4CAF50; text-decoration: none; border-radius: 4px;">
-        📥 下载 {file_label}
-    </a>
+            self.container.info(f"⏳ 已达到速率限制，约 {wait:.1f} 秒后发送")
+        self.shown = True
+
+    def clear(self):
+        if self.shown:
+            self.container.empty()
+            self.shown = False
+
+
+class StepRenderer:
     """
-    return href
+    为每个步骤保留一个占位元素，每次更新只重绘有变化的步骤（通常只有最新的一步），
+    已完成的步骤不会被重新发送到浏览器；流式输出时最新一步最多每 min_interval 秒重绘一次
+    """
+
+    def __init__(self, container, min_interval: float = 0.1):
+        self.container = container
+        self.min_interval = min_interval
+        self.placeholders = []
+        self.rendered = []
+        self.last_render = 0.0
+
+    @staticmethod
+    def _render(placeholder, step):
+        title, content, thinking_time = step
+        with placeholder.container():
+            if title.startswith("最终答案"):
+                st.markdown(f"### 🎯 {title}")
+                st.info(content)
+            else:
+                with st.expander(f"🧠 {title} (思考时间: {thinking_time:.2f} 秒)", expanded=True):
+                    st.write(content)  # 使用 write 而不是 markdown 以避免 HTML 转义问题
+
+    def update(self, steps, final: bool = False):
+        changed = [i for i, step in enumerate(steps) if i >= len(self.rendered) or self.rendered[i] != step]
+        only_last = changed == [len(steps) - 1] and len(steps) == len(self.rendered)
+        if not final and only_last and time.monotonic() - self.last_render < self.min_interval:
+            return
+        for i in changed:
+            if i >= len(self.placeholders):
+                with self.container:
+                    self.placeholders.append(st.empty())
+            self._render(self.placeholders[i], steps[i])
+        # 并行分支模式下领先的分支可能变化，多出的步骤需要清空
+        for placeholder in self.placeholders[len(steps):len(self.rendered)]:
+            placeholder.empty()
+        self.rendered = list(steps)
+        self.last_render = time.monotonic()
+
+
+def show_result(total_thinking_time, full_response, time_container, download_container, export_format,
+                compress):
+    summary = full_response["policy"]
+    text = f"⏱️ **总思考时间: {total_thinking_time:.2f} 秒** · {summary['steps']} 步，节省 {summary['calls_saved']} 次调用"
+    prompt_cache = full_response.get("prompt_cache") or {}
+    if prompt_cache.get("cached_tokens"):
+        text += f" · 输入 {prompt_cache['prompt_tokens']} tokens，缓存命中 {prompt_cache['cached_tokens']}"
+    match = full_response.get("semantic_cache")
+    if match is not None:
+        source = "直接复用" if match["kind"] == "hit" else "参考"
+        text += f" · {source}相似问题的推理链（相似度 {match['similarity']:.2f}）: {match['prompt']}"
+    time_container.markdown(text)
+    # 在内存中序列化后作为普通下载提供，不写临时文件，也不把 base64 内嵌到页面中
+    data, file_name, mime = export_chain(full_response, export_format, compress)
+    download_container.download_button(f"📥 下载完整推理链 ({file_name})", data, file_name=file_name, mime=mime)
 
 
 def main():
     st.set_page_config(page_title="g1 原型", page_icon="🧠", layout="wide")
+    # 限流器按会话轮流放行，每个浏览器会话一个 id
+    session_id = st.session_state.setdefault("session_id", uuid.uuid4().hex)
+    client = get_client(os.getenv('OPENAI_API_KEY'), os.getenv('OPENAI_API_BASE'), os.getenv('OPENAI_PROXY'))
+    store = get_chain_store(os.getenv('CHAIN_STORE_PATH')) if os.getenv('CHAIN_STORE_PATH') else None
+    semantic_cache = get_semantic_cache(os.getenv('SEMANTIC_CACHE_THRESHOLD'), os.getenv('SEMANTIC_SEED_THRESHOLD'),
+                                        os.getenv('SEMANTIC_CACHE_PATH'))
 
     st.title("g1: 使用 LLM 创建类似 o1 的推理链")
 
@@ -229,6 +227,36 @@ def main():
         st.markdown("### ⚙️ 生成设置")
         max_steps = st.slider("最大步骤数", 3, 32, 10)
         temperature = st.slider("温度", 0.0, 1.0, 0.2, 0.1)
+        context_budget = st.number_input("上下文预算 (tokens，0 为不压缩)", 0, 128000, 8000, 1000)
+        policy_name = st.selectbox("步骤策略", ["adaptive", "confidence", "convergence", "budget", "legacy"],
+                                   format_func=lambda x: {"adaptive": "自适应（置信度/收敛/预算）",
+                                                          "confidence": "置信度达标即停止",
+                                                          "convergence": "结论收敛即停止",
+                                                          "budget": "时间预算", "legacy": "旧策略（强制补足步骤）"}[x])
+        confidence_threshold = st.slider("停止置信度", 0.5, 1.0, 0.9, 0.05,
+                                         disabled=policy_name not in ("adaptive", "confidence"))
+        chain_timeout = st.number_input("推理链时间预算 (秒，0 为不限制)", 0, 600, 0, 10,
+                                        disabled=policy_name not in ("adaptive", "budget"))
+        branches = st.slider("并行分支数 (1 为关闭)", 1, 5, 1)
+        selection = st.selectbox("分支选择方式", ["vote", "confidence"],
+                                 format_func=lambda x: {"vote": "最终答案投票", "confidence": "最高置信度"}[x],
+                                 disabled=branches == 1)
+
+        st.markdown("### 📦 导出设置")
+        export_format = st.selectbox("导出格式", ["json", "jsonl"],
+                                     format_func=lambda x: {"json": "JSON", "jsonl": "JSONL（每步一行）"}[x])
+        compress = st.checkbox("gzip 压缩", value=False)
+
+        history_id, resume_button = None, False
+        if store is not None:
+            st.markdown("### 🗂️ 历史推理链")
+            chains = {chain["id"]: chain for chain in store.list_chains(limit=20)}
+            status_labels = {"done": "✅", "failed": "⚠️", "running": "⏸️"}
+            history_id = st.selectbox(
+                "最近的推理链", [None] + list(chains),
+                format_func=lambda x: "（无）" if x is None else
+                f"{status_labels.get(chains[x]['status'], '')} {chains[x]['prompt'][:24]} · {chains[x]['steps']} 步")
+            resume_button = st.button("加载 / 从断点继续", disabled=history_id is None)
 
     # 用户查询的文本输入和发送按钮
     st.markdown("### 🔍 输入您的查询")
@@ -239,37 +267,52 @@ def main():
     with col2:
         send_button = st.button("发送")
 
-    if send_button and user_query:
+    chain_id = None
+    if resume_button and history_id is not None:
+        # 已完成的链直接显示保存的结果，未完成或失败的链从最后保存的步骤继续，沿用原来的参数
+        chain = store.get(history_id)
+        chain_id, user_query, model = history_id, chain["prompt"], chain["model"]
+        max_steps = chain["params"].get("max_steps", max_steps)
+        temperature = chain["params"].get("temperature", temperature)
+        context_budget = chain["params"].get("context_budget") or 0
+        branches = 1
+
+    if (send_button and user_query) or chain_id is not None:
         with st.spinner("正在生成回答..."):  # 添加加载指示器
             # 创建空元素以保存生成的文本和总时间
-            response_container = st.empty()
+            queue_notice = QueueNotice(st.empty())
+            renderer = StepRenderer(st.container())
             time_container = st.empty()
             download_container = st.empty()
 
             # 生成并显示回答
-            for steps, total_thinking_time, full_response in generate_response(
-                    user_query, max_steps=max_steps, temperature=temperature, model=model
-            ):
-                with response_container.container():
-                    for i, (title, content, thinking_time) in enumerate(steps):
-                        if title.startswith("最终答案"):
-                            st.markdown(f"### 🎯 {title}")
-                            st.info(content)
-                        else:
-                            with st.expander(f"🧠 {title} (思考时间: {thinking_time:.2f} 秒)", expanded=True):
-                                st.write(content)  # 使用 write 而不是 markdown 以避免 HTML 转义问题
-
-                # 仅在结束时显示总时间
-                if total_thinking_time is not None and full_response is not None:
-                    time_container.markdown(f"⏱️ **总思考时间: {total_thinking_time:.2f} 秒**")
-
-                    # 创建 JSON 文件并提供下载链接
-                    json_filename = "reasoning_chain.json"
-                    with open(json_filename, "w") as f:
-                        json.dump(full_response, f, indent=2)
-
-                    download_link = get_binary_file_downloader_html(json_filename, "完整推理链 JSON")
-                    download_container.markdown(download_link, unsafe_allow_html=True)
+            policy = make_policy(policy_name, confidence=confidence_threshold, max_seconds=chain_timeout or None)
+            if branches > 1:
+                responses = generate_branched_response(
+                    user_query, max_steps=max_steps, temperature=temperature, model=model, client=client,
+                    context_budget=context_budget or None, branches=branches, selection=selection, policy=policy
+                )
+            else:
+                responses = generate_response(
+                    user_query, max_steps=max_steps, temperature=temperature, model=model, stream=True,
+                    client=client, context_budget=context_budget or None, policy=policy, store=store,
+                    chain_id=chain_id, semantic_cache=semantic_cache
+                )
+            with admission_session(session_id, queue_notice):
+                for steps, total_thinking_time, full_response in responses:
+                    queue_notice.clear()
+                    renderer.update(steps, final=full_response is not None)
+
+                    # 仅在结束时显示总时间
+                    if total_thinking_time is not None and full_response is not None:
+                        st.session_state["last_response"] = (total_thinking_time, full_response)
+                        show_result(total_thinking_time, full_response, time_container, download_container,
+                                    export_format, compress)
+    elif "last_response" in st.session_state:
+        # 点击下载或修改设置都会触发重跑，保留上一次的结果
+        total_thinking_time, full_response = st.session_state["last_response"]
+        StepRenderer(st.container()).update(full_response["steps"], final=True)
+        show_result(total_thinking_time, full_response, st.empty(), st.empty(), export_format, compress)
 
 
 if __name__ == "__main__":
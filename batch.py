@@ -0,0 +1,230 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+
+from llm.V4 import AsyncChatbot
+from llm.cache import ResponseCache
+from llm.capabilities import capabilities, parse_capabilities
+from llm.metrics import metrics, start_metrics_server
+from llm.policy import POLICIES, StepPolicy, make_policy
+from llm.rate_limit import RateLimiter
+from llm.reasoning import agenerate_response
+from llm.semantic_cache import SemanticCache
+from llm.retry import RetryPolicy
+from llm.router import Router, parse_fallbacks
+from llm.store import ChainStore
+
+logger = logging.getLogger(__name__)
+
+
+def prompt_id(item: dict) -> str:
+    """输入行没有 id 时，用提示和生成参数计算一个稳定的 id，用于断点续跑"""
+    if item.get("id") is not None:
+        return str(item["id"])
+    key = json.dumps([item["prompt"], item.get("model"), item.get("max_steps"), item.get("temperature")],
+                     ensure_ascii=False)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def load_completed(output_path: str) -> set:
+    """读取已有输出中成功完成的 id，被中断时写了一半的行会被忽略"""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not record.get("error"):
+                completed.add(record["id"])
+    return completed
+
+
+def load_prompts(input_path: str, completed: set):
+    with open(input_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            item["id"] = prompt_id(item)
+            if item["id"] not in completed:
+                yield item
+
+
+def parse_model_limits(values) -> dict:
+    """解析 --model-limit gpt-4o=500:30000 形式的参数，某一项留空表示不限制"""
+    limits = {}
+    for value in values or []:
+        model, _, limit = value.partition("=")
+        rpm, _, tpm = limit.partition(":")
+        limits[model] = (float(rpm) if rpm else None, float(tpm) if tpm else None)
+    return limits
+
+
+async def run_chain(client: AsyncChatbot, item: dict, args, policy: StepPolicy = None,
+                    store: ChainStore = None, semantic_cache: SemanticCache = None) -> dict:
+    model = item.get("model", args.model)
+    max_steps = item.get("max_steps", args.max_steps)
+    temperature = item.get("temperature", args.temperature)
+    steps, total_thinking_time, full_response = [], None, None
+    async for steps, total_thinking_time, full_response in agenerate_response(
+            item["prompt"], max_steps=max_steps, temperature=temperature, model=model, client=client,
+            context_budget=args.context_budget, policy=policy, chain_timeout=args.chain_deadline,
+            store=store, chain_id=item["id"] if store else None, semantic_cache=semantic_cache
+    ):
+        pass
+    return {
+        "id": item["id"],
+        "prompt": item["prompt"],
+        "model": model,
+        "max_steps": max_steps,
+        "temperature": temperature,
+        "steps": steps,
+        "total_thinking_time": total_thinking_time,
+        "policy": full_response["policy"] if full_response else None,
+        "semantic_cache": full_response.get("semantic_cache") if full_response else None,
+        "error": any(title == "错误" for title, _, _ in steps),
+    }
+
+
+async def run_batch(args):
+    completed = load_completed(args.output)
+    if completed:
+        logger.info(f"跳过已完成的 {len(completed)} 条提示")
+
+    for prefix, mode in parse_capabilities(args.structured_output).items():
+        capabilities.register(prefix, mode)
+    limiter = RateLimiter(rpm=args.rpm, tpm=args.tpm, limits=parse_model_limits(args.model_limit),
+                          path=args.rate_limit_state)
+    cache = ResponseCache(path=args.cache) if args.cache else None
+    # 提示 id 即链 id，失败或被中断的推理链再次运行时从最后保存的步骤继续
+    store = ChainStore(args.store) if args.store else None
+    semantic_cache = None
+    if args.semantic_cache:
+        semantic_cache = SemanticCache(threshold=args.semantic_threshold, seed_threshold=args.semantic_seed_threshold,
+                                       path=None if args.semantic_cache == ":memory:" else args.semantic_cache)
+    retry = RetryPolicy(max_attempts=args.max_attempts, step_timeout=args.step_timeout)
+    client = AsyncChatbot(
+        api_key=os.getenv('OPENAI_API_KEY'),
+        api_url=os.getenv('OPENAI_API_BASE'),
+        max_connections=args.concurrency,
+        max_keepalive_connections=args.concurrency,
+        rate_limiter=limiter,
+        cache=cache,
+        retry=retry,
+    )
+    fallbacks = parse_fallbacks(args.fallback)
+    router = None
+    if fallbacks:
+        client = router = Router(client, fallbacks, hedge=not args.no_hedge)
+    policy = make_policy(args.policy, confidence=args.confidence_threshold, max_seconds=args.chain_timeout,
+                         max_tokens=args.chain_tokens)
+    queue = asyncio.Queue(maxsize=args.concurrency * 2)
+    start_time = time.time()
+    done = 0
+
+    with open(args.output, "a", encoding="utf-8") as out:
+        async def worker():
+            nonlocal done
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                try:
+                    record = await run_chain(client, item, args, policy, store, semantic_cache)
+                except Exception as e:
+                    logger.error(f"提示 {item['id']} 处理失败: {e}")
+                    record = {"id": item["id"], "prompt": item["prompt"], "error": str(e)}
+                # 每完成一条就写入并刷新，进程被杀掉后可以从这里续跑
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                done += 1
+                elapsed = time.time() - start_time
+                logger.info(f"已完成 {done} 条，{done / elapsed * 3600:.0f} 条/小时")
+
+        workers = [asyncio.create_task(worker()) for _ in range(args.concurrency)]
+        try:
+            for item in load_prompts(args.input, completed):
+                await queue.put(item)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            await client.close()
+            logger.info(f"调用统计: {json.dumps(metrics.snapshot(), ensure_ascii=False)}")
+            logger.info(f"重试统计: {json.dumps(retry.stats(), ensure_ascii=False)}")
+            if router:
+                logger.info(f"路由统计: {json.dumps(router.stats(), ensure_ascii=False)}")
+            logger.info(f"步骤策略 {policy.name} 共节省 {policy.calls_saved} 次调用")
+            if cache:
+                logger.info(f"响应缓存统计: {cache.stats()}")
+                cache.close()
+            if store:
+                store.close()
+            if semantic_cache:
+                logger.info(f"语义缓存统计: {semantic_cache.stats()}")
+                semantic_cache.close()
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="批量运行 g1 推理链，输入输出均为 JSONL")
+    parser.add_argument("input", help="输入 JSONL，每行包含 prompt，可选 id/model/max_steps/temperature")
+    parser.add_argument("output", help="输出 JSONL，已完成的提示再次运行时会被跳过")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时运行的推理链数量")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--max-steps", type=int, default=10)
+    parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument("--context-budget", type=int, default=None, help="每次请求的上下文 token 预算，超出时压缩较早的步骤")
+    parser.add_argument("--policy", choices=POLICIES, default="adaptive",
+                        help="步骤策略，legacy 为旧行为（不足最大步骤数时拒绝最终答案）")
+    parser.add_argument("--confidence-threshold", type=float, default=0.9, help="置信度达到该值即停止")
+    parser.add_argument("--chain-timeout", type=float, default=None, help="每条推理链的墙钟时间预算（秒）")
+    parser.add_argument("--chain-tokens", type=int, default=None, help="每条推理链的 token 预算")
+    parser.add_argument("--chain-deadline", type=float, default=None,
+                        help="每条推理链的硬性截止时间（秒），到期后请求直接失败")
+    parser.add_argument("--step-timeout", type=float, default=None, help="单步调用（含所有重试）的超时时间（秒）")
+    parser.add_argument("--max-attempts", type=int, default=3, help="每次调用最多发出的请求数（含首次请求）")
+    parser.add_argument("--rpm", type=float, default=None, help="每个模型每分钟的请求数上限")
+    parser.add_argument("--tpm", type=float, default=None, help="每个模型每分钟的 token 数上限")
+    parser.add_argument("--model-limit", action="append", metavar="MODEL=RPM:TPM",
+                        help="为单个模型设置限制，可以重复使用")
+    parser.add_argument("--rate-limit-state", default=None,
+                        help="限流状态文件路径，使用同一文件的多个进程（包括界面）共享同一份 rpm/tpm 额度")
+    parser.add_argument("--fallback", action="append", metavar="MODEL=FALLBACK1,FALLBACK2",
+                        help="模型不可用时依次改用的备用模型，也用作超过 p95 时的对冲目标，可以重复使用")
+    parser.add_argument("--structured-output", action="append", metavar="PREFIX=MODE",
+                        help="指定模型（按名称前缀）的结构化输出方式：json_schema / tools / json_object，可以重复使用")
+    parser.add_argument("--no-hedge", action="store_true", help="只做故障转移，不发出对冲请求")
+    parser.add_argument("--cache", default=None, help="SQLite 响应缓存文件路径，相同请求不会重复调用 API")
+    parser.add_argument("--store", default=None, help="SQLite 推理链存储路径，每一步都会保存，失败的链再次运行时从断点继续")
+    parser.add_argument("--semantic-cache", default=None,
+                        help="SQLite 语义缓存文件路径（:memory: 只在本次运行内缓存），相似的问题复用已有的推理链")
+    parser.add_argument("--semantic-threshold", type=float, default=0.85, help="相似度达到该值时直接返回已有的推理链")
+    parser.add_argument("--semantic-seed-threshold", type=float, default=0.6,
+                        help="相似度达到该值时以已有的答案为参考生成较短的推理链")
+    parser.add_argument("--metrics-port", type=int, default=None, help="在该端口提供 Prometheus /metrics")
+    parser.add_argument("--verbose", action="store_true", help="输出每一步推理的日志")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if not args.verbose:
+        logging.getLogger("llm.reasoning").setLevel(logging.WARNING)
+        logging.getLogger("llm.policy").setLevel(logging.WARNING)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    asyncio.run(run_batch(args))
+
+
+if __name__ == "__main__":
+    main()
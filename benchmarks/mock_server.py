@@ -0,0 +1,298 @@
+"""
+本地模拟的 OpenAI 兼容 /chat/completions 服务，用于在不调用真实 API 的情况下测量 g1 自身的开销。
+
+支持可配置的延迟分布、畸形 JSON 比例、429/503 注入（带 Retry-After）以及 SSE 流式输出，
+也支持 tools 调用（包括流式）和 response_format json_schema，按 schema 约束的请求不会返回畸形 JSON。
+prompt_cache 模拟服务端的前缀缓存：与之前请求相同的消息前缀计入 usage.prompt_tokens_details.cached_tokens。可以单独运行：
+
+    python -m benchmarks.mock_server --port 18080 --latency lognormal:0.2:0.5 --malformed-rate 0.1
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass
+class MockConfig:
+    # 延迟分布：fixed:秒、uniform:最小:最大、lognormal:中位数:sigma
+    latency: str = "fixed:0"
+    # 流式输出时每个块之间的间隔（秒）和每块的字符数
+    chunk_delay: float = 0.0
+    chunk_chars: int = 8
+    malformed_rate: float = 0.0
+    rate_429: float = 0.0
+    rate_503: float = 0.0
+    retry_after: float = 0.0
+    content_chars: int = 600
+    final_answer: bool = True
+    # 为 False 时模拟不支持 response_format json_schema 的服务，返回 400
+    json_schema: bool = True
+    # 模拟 OpenAI 的自动前缀缓存：前缀至少 1024 个 token，按 128 个 token 为单位命中
+    prompt_cache: bool = True
+    seed: int = None
+
+
+@dataclass
+class MockStats:
+    requests: int = 0
+    streamed: int = 0
+    malformed: int = 0
+    injected_errors: dict = field(default_factory=lambda: {429: 0, 503: 0})
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {"requests": self.requests, "streamed": self.streamed, "malformed": self.malformed,
+                    "injected_errors": dict(self.injected_errors)}
+
+
+def sample_latency(spec: str, rng: random.Random) -> float:
+    kind, *params = spec.split(":")
+    params = [float(p) for p in params]
+    if kind == "fixed":
+        return params[0] if params else 0.0
+    if kind == "uniform":
+        return rng.uniform(params[0], params[1])
+    if kind == "lognormal":
+        median, sigma = params
+        return rng.lognormvariate(0, sigma) * median
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+
+def _step_json(rng: random.Random, config: MockConfig) -> dict:
+    words = ["compare", "the", "decimal", "parts", "1.11", "and", "1.3", "so", "that", "\\(x\\)", "holds"]
+    content = ""
+    while len(content) < config.content_chars:
+        content += rng.choice(words) + " "
+    return {
+        "title": f"Step {rng.randint(1, 1000)}",
+        "content": content.strip(),
+        "next_action": "final_answer" if config.final_answer else rng.choice(["continue", "reflect"]),
+        "confidence": round(rng.uniform(0.5, 0.95), 2),
+    }
+
+
+def _malformed(text: str, rng: random.Random) -> str:
+    """生成本地修复可以处理的几种常见错误"""
+    kind = rng.randrange(4)
+    if kind == 0:
+        return text[:-1] + ", }"
+    if kind == 1:
+        return "Here is my step:\n```json\n" + text + "\n```\nLet me know if you need more."
+    if kind == 2:
+        return text.replace('"content": "', '"content": "He said "hi" and ', 1)
+    return text.replace("\\\\", "\\")
+
+
+def _message_text(message: dict) -> str:
+    """消息正文，content 为分段列表（带 cache_control 标记）时拼接各段文本"""
+    content = message.get("content")
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content)
+    return str(content or "")
+
+
+class PrefixCache:
+    """按消息前缀的哈希记录见过的请求，返回本次请求可以命中缓存的 token 数"""
+
+    def __init__(self, min_tokens: int = 1024, increment: int = 128):
+        self.min_tokens = min_tokens
+        self.increment = increment
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def lookup(self, body: dict) -> int:
+        head = json.dumps([body.get("tools"), body.get("response_format")], sort_keys=True)
+        digest = hashlib.sha256(head.encode("utf-8"))
+        tokens = cached = 0
+        with self._lock:
+            for message in body.get("messages", []):
+                digest.update(json.dumps([message.get("role"), _message_text(message)]).encode("utf-8"))
+                tokens += len(_message_text(message)) // 4
+                key = digest.hexdigest()
+                if key in self._seen:
+                    cached = tokens
+                self._seen.add(key)
+        if cached < self.min_tokens:
+            return 0
+        return cached // self.increment * self.increment
+
+
+def make_handler(config: MockConfig, stats: MockStats, rng: random.Random):
+    rng_lock = threading.Lock()
+    prefix_cache = PrefixCache()
+
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # 头部和正文分两次写入，关闭 Nagle 以免与客户端的延迟 ACK 叠加出 40ms 的额外延迟
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status: int, body: dict, headers: dict = None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _write_chunk(self, text: str):
+            data = text.encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send_json(200, stats.as_dict())
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            json_schema = (body.get("response_format") or {}).get("type") == "json_schema"
+            if json_schema and not config.json_schema:
+                with stats.lock:
+                    stats.requests += 1
+                self._send_json(400, {"error": {"message": "response_format json_schema is not supported"}})
+                return
+            with rng_lock:
+                latency = sample_latency(config.latency, rng)
+                roll = rng.random()
+                step = _step_json(rng, config)
+                malformed = rng.random() < config.malformed_rate
+                text = json.dumps(step)
+                malformed = malformed and not body.get("tools") and not json_schema
+                if malformed:
+                    text = _malformed(text, rng)
+            with stats.lock:
+                stats.requests += 1
+            if roll < config.rate_429 + config.rate_503:
+                status = 429 if roll < config.rate_429 else 503
+                with stats.lock:
+                    stats.injected_errors[status] += 1
+                self._send_json(status, {"error": {"message": "injected error"}},
+                                {"Retry-After": str(config.retry_after)})
+                return
+            time.sleep(latency)
+            if malformed:
+                with stats.lock:
+                    stats.malformed += 1
+            prompt_tokens = sum(len(_message_text(m)) for m in body.get("messages", [])) // 4
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(text) // 4,
+                     "total_tokens": prompt_tokens + len(text) // 4}
+            if config.prompt_cache:
+                usage["prompt_tokens_details"] = {"cached_tokens": prefix_cache.lookup(body)}
+            model = body.get("model", "mock")
+
+            if body.get("tools") and not body.get("stream"):
+                # instructor 的 TOOLS 模式
+                tool = body["tools"][0]["function"]["name"]
+                message = {"role": "assistant", "content": None, "tool_calls": [{
+                    "id": "call_mock", "type": "function",
+                    "function": {"name": tool, "arguments": json.dumps(step)},
+                }]}
+                self._send_json(200, {"id": "mock", "object": "chat.completion", "created": int(time.time()),
+                                      "model": model, "usage": usage,
+                                      "choices": [{"index": 0, "message": message, "finish_reason": "stop"}]})
+                return
+
+            if not body.get("stream"):
+                texts = [text]
+                with rng_lock:
+                    texts += [json.dumps(_step_json(rng, config)) for _ in range(int(body.get("n") or 1) - 1)]
+                choices = [{"index": i, "message": {"role": "assistant", "content": t}, "finish_reason": "stop"}
+                           for i, t in enumerate(texts)]
+                self._send_json(200, {"id": "mock", "object": "chat.completion", "created": int(time.time()),
+                                      "model": model, "usage": usage, "choices": choices})
+                return
+
+            with stats.lock:
+                stats.streamed += 1
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(text), config.chunk_chars):
+                if config.chunk_delay:
+                    time.sleep(config.chunk_delay)
+                delta = {"content": text[i:i + config.chunk_chars]}
+                if body.get("tools"):
+                    delta = {"tool_calls": [{"index": 0, "function": {"arguments": delta["content"]}}]}
+                chunk = {"choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+            self._write_chunk(f"data: {json.dumps({'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})}\n\n")
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self._write_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n")
+            self._write_chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+    return MockHandler
+
+
+class _Server(ThreadingHTTPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class MockServer:
+    """在后台线程中运行的模拟服务，base_url 可直接作为 OPENAI_API_BASE 使用"""
+
+    def __init__(self, config: MockConfig = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or MockConfig()
+        self.stats = MockStats()
+        handler = make_handler(self.config, self.stats, random.Random(self.config.seed))
+        self.httpd = _Server((host, port), handler)
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-openai", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的模拟 /chat/completions 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--latency", default="fixed:0", help="fixed:S | uniform:MIN:MAX | lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--chunk-delay", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-503", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    config = MockConfig(latency=args.latency, chunk_delay=args.chunk_delay, malformed_rate=args.malformed_rate,
+                        rate_429=args.rate_429, rate_503=args.rate_503, retry_after=args.retry_after, seed=args.seed)
+    server = MockServer(config, args.host, args.port)
+    print(f"mock server listening on {server.base_url}")
+    server.httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
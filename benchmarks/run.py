@@ -0,0 +1,287 @@
+"""
+g1 离线基准测试，使用本地模拟服务，不会调用真实 API：
+
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --suite json_repair --compare bench.json
+    python -m benchmarks.run --suite cold_start
+
+python -m 需要在仓库根目录下运行；在其他目录中可以直接运行脚本：python path/to/g1/benchmarks/run.py
+
+结果写成 JSON，便于比较不同版本。
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    # 以 python path/to/benchmarks/run.py 在其他目录运行时同样能导入 benchmarks 和 llm
+    sys.path.insert(0, ROOT)
+
+from benchmarks.mock_server import MockConfig, MockServer
+from llm.V4 import AsyncChatbot, Chatbot
+from llm.llm_tools import extract_json, repair_json
+from llm.metrics import MetricsRegistry
+from llm.reasoning import agenerate_response, generate_response
+from llm.retry import RetryPolicy
+
+
+def _percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    return {
+        "mean": statistics.fmean(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        "max": values[-1],
+    }
+
+
+def _use_server(server: MockServer):
+    # try_fix_json_format 通过环境变量找到 API 地址
+    os.environ["OPENAI_API_BASE"] = server.base_url
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+
+
+def _run_chain(client: Chatbot, max_steps: int, stream: bool = False):
+    steps = []
+    for steps, _, _ in generate_response("1.11 和 1.3 哪个大?", max_steps=max_steps, temperature=0,
+                                         stream=stream, client=client):
+        pass
+    return steps
+
+
+def bench_chain_latency(args) -> dict:
+    """单条推理链的端到端延迟，模拟服务的延迟固定，差值即为 g1 自身的开销"""
+    config = MockConfig(latency=args.latency, seed=args.seed)
+    with MockServer(config) as server:
+        _use_server(server)
+        client = Chatbot(api_key="mock", api_url=server.base_url, metrics=MetricsRegistry())
+        durations = []
+        for _ in range(args.chains):
+            start = time.perf_counter()
+            _run_chain(client, args.max_steps)
+            durations.append(time.perf_counter() - start)
+        client.close()
+        calls = server.stats.as_dict()["requests"]
+    return {"chain_seconds": _percentiles(durations), "calls_per_chain": calls / args.chains}
+
+
+def bench_concurrency(args) -> dict:
+    """不同并发度下 AsyncChatbot 的吞吐（步骤/秒）"""
+    config = MockConfig(latency=args.latency, seed=args.seed)
+    results = {}
+    with MockServer(config) as server:
+        _use_server(server)
+        for level in args.concurrency:
+            async def run_level():
+                client = AsyncChatbot(api_key="mock", api_url=server.base_url, max_connections=level,
+                                      max_keepalive_connections=level, metrics=MetricsRegistry())
+                semaphore = asyncio.Semaphore(level)
+                step_count = 0
+
+                async def one():
+                    nonlocal step_count
+                    async with semaphore:
+                        async for steps, _, _ in agenerate_response("1.11 和 1.3 哪个大?", max_steps=args.max_steps,
+                                                                    temperature=0, client=client):
+                            pass
+                        step_count += len(steps)
+
+                start = time.perf_counter()
+                await asyncio.gather(*[one() for _ in range(max(args.chains, level))])
+                elapsed = time.perf_counter() - start
+                await client.close()
+                return step_count / elapsed
+
+            results[str(level)] = {"steps_per_second": asyncio.run(run_level())}
+    return results
+
+
+def bench_json_repair(args) -> dict:
+    """本地 JSON 解析与修复的耗时（微秒）"""
+    step = {"title": "Comparing", "content": "Since \\(1.3 = 1.30\\) and 0.30 > 0.11, " * 20,
+            "next_action": "continue", "confidence": 0.8}
+    text = json.dumps(step)
+    samples = {
+        "valid": text,
+        "code_fence": "Here is my step:\n```json\n" + text + "\n```",
+        "trailing_comma": text[:-1] + ", }",
+        "inner_quotes": text.replace('"content": "', '"content": "He said "hi" and ', 1),
+        "raw_newlines": text.replace(", ", ",\n"),
+        "latex_escapes": text.replace("\\\\", "\\"),
+    }
+    results = {}
+    for name, sample in samples.items():
+        try:
+            extract_json(sample)
+            direct = True
+        except ValueError:
+            direct = False
+        repair_json(sample)
+        seconds = timeit.timeit(lambda: repair_json(sample), number=args.iterations) / args.iterations
+        results[name] = {"direct_parse_ok": direct, "repair_us": seconds * 1e6}
+    return results
+
+
+def bench_retry_amplification(args) -> dict:
+    """注入 429/503 时，每个逻辑调用实际发出的请求数"""
+    config = MockConfig(latency=args.latency, rate_429=args.error_rate / 2, rate_503=args.error_rate / 2,
+                        retry_after=0, seed=args.seed)
+    with MockServer(config) as server:
+        _use_server(server)
+        registry = MetricsRegistry()
+        retry = RetryPolicy()
+        client = Chatbot(api_key="mock", api_url=server.base_url, metrics=registry, retry=retry)
+        start = time.perf_counter()
+        for _ in range(args.chains):
+            _run_chain(client, args.max_steps)
+        elapsed = time.perf_counter() - start
+        client.close()
+        stats = server.stats.as_dict()
+    snapshot = registry.snapshot().values()
+    logical_calls = sum(model["calls"] for model in snapshot)
+    return {
+        "error_rate": args.error_rate,
+        "logical_calls": logical_calls,
+        "attempts": sum(model["attempts"] for model in snapshot),
+        "failed_calls": sum(model["errors"] for model in snapshot),
+        "short_circuited": sum(model.get("short_circuited", 0) for model in retry.stats().values()),
+        "http_requests": stats["requests"],
+        "amplification": stats["requests"] / logical_calls if logical_calls else None,
+        "chain_seconds": elapsed / args.chains,
+    }
+
+
+def bench_streaming(args) -> dict:
+    """流式模式下首个 token 的时间与完整步骤时间"""
+    config = MockConfig(latency=args.latency, chunk_delay=args.chunk_delay, seed=args.seed)
+    with MockServer(config) as server:
+        _use_server(server)
+        registry = MetricsRegistry()
+        client = Chatbot(api_key="mock", api_url=server.base_url, metrics=registry)
+        for _ in range(args.chains):
+            _run_chain(client, args.max_steps, stream=True)
+        client.close()
+    calls = registry.recent_calls(10000)
+    return {
+        "first_token_seconds": _percentiles([c["first_token_time"] for c in calls if c["first_token_time"]]),
+        "step_seconds": _percentiles([c["total_time"] for c in calls]),
+    }
+
+
+COLD_START = {
+    "import_V4": "import llm.V4",
+    "import_reasoning": "import llm.reasoning",
+    "import_batch": "import batch",
+    "create_clients": "from llm.V4 import AsyncChatbot, Chatbot; Chatbot('mock'); AsyncChatbot('mock')",
+}
+
+# 启动时不应该加载的依赖，只有真正发出请求（或走 instructor 回退）时才导入
+HEAVY_MODULES = ("requests", "httpx", "openai", "instructor")
+
+
+def bench_cold_start(args) -> dict:
+    """在新的解释器中执行每段代码，seconds 为其耗时，process_seconds 含解释器启动；heavy_modules 为执行后已加载的重型依赖"""
+    results = {}
+    for name, snippet in COLD_START.items():
+        code = (f"import json, sys, time\nstart = time.perf_counter()\n{snippet}\n"
+                f"print(json.dumps([time.perf_counter() - start, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))")
+        seconds, process_seconds = [], []
+        for _ in range(args.cold_start_runs):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True,
+                                    check=True).stdout
+            process_seconds.append(time.perf_counter() - start)
+            elapsed, loaded = json.loads(output.strip().splitlines()[-1])
+            seconds.append(elapsed)
+        results[name] = {"seconds": _percentiles(seconds), "process_seconds": _percentiles(process_seconds),
+                         "heavy_modules": loaded}
+    return results
+
+
+SUITES = {
+    "chain_latency": bench_chain_latency,
+    "concurrency": bench_concurrency,
+    "json_repair": bench_json_repair,
+    "retry_amplification": bench_retry_amplification,
+    "streaming": bench_streaming,
+    "cold_start": bench_cold_start,
+}
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def _flatten(data, prefix=""):
+    if isinstance(data, dict):
+        for key, value in data.items():
+            yield from _flatten(value, f"{prefix}.{key}" if prefix else str(key))
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        yield prefix, data
+
+
+def compare(baseline: dict, current: dict):
+    old = dict(_flatten(baseline.get("results", {})))
+    for key, value in _flatten(current.get("results", {})):
+        if key in old and old[key]:
+            print(f"{key:70s} {old[key]:12.4f} -> {value:12.4f} ({(value - old[key]) / old[key] * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="g1 离线基准测试")
+    parser.add_argument("--suite", action="append", choices=list(SUITES), help="只运行指定的测试，可以重复使用")
+    parser.add_argument("--output", default=None, help="结果 JSON 输出路径")
+    parser.add_argument("--compare", default=None, help="与之前的结果 JSON 比较")
+    parser.add_argument("--chains", type=int, default=5)
+    parser.add_argument("--max-steps", type=int, default=3)
+    parser.add_argument("--latency", default="fixed:0.05", help="模拟服务的延迟分布")
+    parser.add_argument("--chunk-delay", type=float, default=0.002)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--error-rate", type=float, default=0.2)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cold-start-runs", type=int, default=5, help="cold_start 每段代码运行的次数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = {}
+    for name in args.suite or list(SUITES):
+        start = time.perf_counter()
+        results[name] = SUITES[name](args)
+        print(f"{name}: {json.dumps(results[name], ensure_ascii=False)} ({time.perf_counter() - start:.1f}s)")
+
+    report = {
+        "meta": {
+            "timestamp": time.time(),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,24 @@
+import asyncio
 import json
-from json import JSONDecodeError
+import threading
+import time
+import weakref
+from contextlib import contextmanager
 from typing import Dict, Any, Type
 
-import instructor
-import requests
-from openai import OpenAI, DefaultHttpxClient
 from pydantic import BaseModel
-from requests.adapters import HTTPAdapter, Retry
 
-from llm.llm_tools import extract_json
+from llm.cache import ResponseCache
+from llm.capabilities import CapabilityRegistry, capabilities as default_capabilities, structured_output
+from llm.capabilities import validate_structured
+from llm.llm_tools import estimate_tokens
+from llm.llm_tools import parse_json_locally
+from llm.llm_tools import record_json_tier
 from llm.llm_tools import try_fix_json_format
+from llm.metrics import CallMetrics, MetricsRegistry, metrics as default_metrics, report_usage
+from llm.prompt_cache import cache_style, cached_prompt_tokens, with_cache_breakpoints
+from llm.rate_limit import RateLimiter
+from llm.retry import Deadline, HTTPStatusError, RetryPolicy, raise_if_cancelled, retry_policy
 
 
 def class_to_dict(obj):
@@ -33,7 +42,242 @@ class AppBaseModel(BaseModel):
                     prop['description'] = title
 
 
-class Chatbot:
+def _finish_reason_exceed(finish_reason) -> bool:
+    return finish_reason in ["length", "max_tokens", "MAX_TOKENS"]
+
+
+def _build_messages(prompt, system_prompt: str = None) -> list:
+    if not isinstance(prompt, str):
+        return prompt
+    messages = []
+    if system_prompt:
+        messages.append({
+            "role": "system",
+            "content": system_prompt
+        })
+    messages.append({
+        "role": "user",
+        "content": prompt
+    })
+    return messages
+
+
+def _build_payload(model: str, messages: list, json_format: bool, stream: bool, default_temperature: float,
+                   structured: dict = None, **kwargs) -> dict:
+    payload = {
+        "model": model,
+        # 历史消息原样发送以保持前缀逐字节不变，需要显式标注的服务在副本上插入缓存断点
+        "messages": with_cache_breakpoints(messages, cache_style(model)),
+        "stream": stream,
+        # kwargs
+        "temperature": kwargs.get("temperature", default_temperature),
+        "n": kwargs.get("n", 1),
+    }
+    if stream:
+        payload["stream_options"] = {"include_usage": True}
+    if structured:
+        # 按 schema 约束输出（response_format json_schema 或 tools），见 llm.capabilities
+        payload.update(structured)
+    elif json_format:
+        payload["response_format"] = {
+            "type": "json_object"
+        }
+    for key, value in kwargs.items():
+        payload[key] = value
+    return payload
+
+
+def _message_content(message: dict):
+    """消息正文；tools 模式下结构化输出在第一个工具调用的参数中"""
+    content = message.get("content")
+    tool_calls = message.get("tool_calls")
+    if not content and tool_calls:
+        content = (tool_calls[0].get("function") or {}).get("arguments")
+    return content
+
+
+def _parse_completion(resp: dict):
+    choices = resp.get("choices")
+    delta = choices[0].get("message")
+    content = _message_content(delta)
+    usage = resp.get("usage", None)
+    prompt_tokens = 0
+    completion_tokens = 0
+    if usage:
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+    finish_reason = choices[0].get("finish_reason")
+    tokens_exceed = _finish_reason_exceed(finish_reason)
+    return content, prompt_tokens, completion_tokens, tokens_exceed
+
+
+def _parse_choices(resp: dict):
+    """解析 n > 1 时的全部候选，返回 (contents, prompt_tokens, completion_tokens, tokens_exceed)"""
+    choices = resp.get("choices") or []
+    contents = [_message_content(choice["message"]) for choice in choices if choice.get("message")]
+    contents = [content for content in contents if content]
+    usage = resp.get("usage") or {}
+    tokens_exceed = any(_finish_reason_exceed(choice.get("finish_reason")) for choice in choices)
+    return contents, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), tokens_exceed
+
+
+def _parse_instructor(result_info, com):
+    finish_reason = com.choices[0].finish_reason
+    tokens_exceed = _finish_reason_exceed(finish_reason)
+    prompt_tokens = com.usage.prompt_tokens
+    completion_tokens = com.usage.completion_tokens
+    content = json.dumps(class_to_dict(result_info))
+    return content, prompt_tokens, completion_tokens, tokens_exceed
+
+
+def _is_app_model(response_model) -> bool:
+    return isinstance(response_model, type) and issubclass(response_model, AppBaseModel)
+
+
+def _model_validator(response_model):
+    """本地修复和 LLM 修复的结果需要符合 response_model，否则交给下一级；没有 response_model 时不校验"""
+    if not _is_app_model(response_model):
+        return None
+
+    def validate(json_obj) -> bool:
+        try:
+            response_model.model_validate(json_obj)
+        except ValueError:
+            return False
+        return True
+
+    return validate
+
+
+def _fixed_content(content, validate):
+    """LLM 修复的结果，不符合 response_model 时返回 None"""
+    if content and validate is not None and not validate(json.loads(content)):
+        return None
+    return content
+
+
+def _structured_mode(registry: CapabilityRegistry, model: str, json_format: bool, response_model):
+    """需要按 schema 约束输出时返回方式（json_schema / tools），否则返回 None"""
+    if not json_format or not _is_app_model(response_model):
+        return None
+    mode = registry.mode(model)
+    return None if mode == "json_object" else mode
+
+
+def _schema_rejected(e: HTTPStatusError) -> bool:
+    # 不支持 json_schema / tools 的服务一般以 400 或 422 拒绝请求
+    return e.status_code in (400, 422)
+
+
+def _record_tier(call: CallMetrics, tier: str):
+    record_json_tier(tier)
+    if call is not None:
+        call.json_tier = tier
+
+
+def _record_cached_tokens(call: CallMetrics, usage):
+    if call is not None:
+        call.cached_tokens = cached_prompt_tokens(usage)
+
+
+def _finish_call(registry: MetricsRegistry, call: CallMetrics, start: float, result):
+    call.total_time = time.perf_counter() - start
+    if result is not None:
+        _, call.prompt_tokens, call.completion_tokens, call.tokens_exceed = result
+    elif call.error is None:
+        call.error = "cancelled"
+    registry.record(call)
+    report_usage(call)
+
+
+def _cache_key(cache: ResponseCache, use_cache: bool, model: str, messages: list, json_format: bool,
+               response_model, default_temperature: float, kwargs: dict):
+    if cache is None or not use_cache:
+        return None
+    params = dict(kwargs)
+    params.setdefault("temperature", default_temperature)
+    return cache.make_key(model, messages, response_model=response_model, json_format=json_format, **params)
+
+
+def _reserved_tokens(messages: list, kwargs: dict) -> int:
+    """限流时预约的 token 数：估算的输入 token 加上所有候选的输出上限"""
+    return estimate_tokens(messages) + kwargs.get("max_tokens", 0) * kwargs.get("n", 1)
+
+
+def _used_tokens(result, reserved: int) -> int:
+    """实际消耗的 token 数，服务端没有返回 usage 时保留预约值"""
+    return result[1] + result[2] or reserved
+
+
+class _LazyClients:
+    """
+    按需创建的底层客户端。requests、httpx、openai 和 instructor 的导入都很慢，
+    在第一次真正发出请求时才导入并创建，instructor 客户端只在第三级 JSON 回退时才会用到
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.RLock()
+
+    def get(self, name: str, factory):
+        client = self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    client = self._clients[name] = factory()
+        return client
+
+    def created(self, name: str):
+        return self._clients.get(name)
+
+
+def _close_clients(clients: _LazyClients):
+    for name in ("session", "http"):
+        client = clients.created(name)
+        if client is not None:
+            client.close()
+
+
+
+def _run(flow):
+    """
+    同步执行共享流程：flow yield 需要发出的请求（无参函数），请求的结果或异常送回 flow，
+    flow 的返回值即为调用结果
+    """
+    value, error = None, None
+    while True:
+        try:
+            request = flow.throw(error) if error is not None else flow.send(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value, error = request(), None
+        except BaseException as e:
+            # 取消（KeyboardInterrupt）同样送回 flow，保证其中的指标记录会执行
+            value, error = None, e
+
+
+async def _arun(flow):
+    """_run 的异步版本，flow yield 的请求返回 awaitable"""
+    value, error = None, None
+    while True:
+        try:
+            request = flow.throw(error) if error is not None else flow.send(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value, error = await request(), None
+        except BaseException as e:
+            # 任务被取消（CancelledError）同样送回 flow，保证其中的指标记录会执行
+            value, error = None, e
+
+
+class _ChatbotBase:
+    """
+    Chatbot 与 AsyncChatbot 共用的配置和每次调用的逻辑：缓存、指标、结构化输出、JSON 校验与修复、限流结算。
+    这些逻辑写成只 yield 请求的生成器，由子类以同步（_run）或异步（_arun）的方式执行，子类只实现传输
+    """
 
     def __init__(
             self,
@@ -42,112 +286,628 @@ class Chatbot:
             proxy: str = None,
             timeout: float = None,
             temperature: float = 0.5,
+            cache: ResponseCache = None,
+            metrics: MetricsRegistry = None,
+            retry: RetryPolicy = None,
+            rate_limiter: RateLimiter = None,
+            capabilities: CapabilityRegistry = None,
     ) -> None:
         self.api_url: str = api_url or "https://api.openai.com/v1"
         self.api_key: str = api_key
         self.temperature: float = temperature
         self.timeout: float = timeout
-        retries = Retry(total=3, backoff_factor=1,
-                        allowed_methods=["HEAD", "GET", "PUT", "OPTIONS", "POST"],
-                        status_forcelist=[429, 503, 504, 529])
-        self.session = requests.Session()
-        self.session.mount('http://', HTTPAdapter(max_retries=retries))
-        self.session.mount('https://', HTTPAdapter(max_retries=retries))
-        self.session.proxies.update(
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.metrics = metrics or default_metrics
+        self.capabilities = capabilities or default_capabilities
+        # 重试只在 self.retry 中进行，底层 HTTP 客户端和 OpenAI 客户端自身都不再重试
+        self.retry = retry or retry_policy
+        self.proxy = proxy
+        self._clients = _LazyClients()
+
+    @property
+    def client(self):
+        return self._clients.get("instructor", self._new_instructor_client)
+
+    def _settle(self, model: str, reserved: int, used: int, kwargs: dict):
+        if self.rate_limiter is not None:
+            self.rate_limiter.settle(model, reserved, used, api_key=kwargs.get("api_key", self.api_key))
+
+    @contextmanager
+    def _refund_on_failure(self, model: str, reserved: int, kwargs: dict):
+        """块内的请求没有成功返回（失败、超时或被取消）时归还预约的 token，成功时由调用方按实际用量结算"""
+        done = False
+        try:
+            yield
+            done = True
+        finally:
+            if not done:
+                self._settle(model, reserved, 0, kwargs)
+
+    def _settled(self, model: str, reserved: int, result: tuple, usage, call: CallMetrics, kwargs: dict):
+        """记录命中提示词缓存的 token，并按实际用量结算预约的额度"""
+        _record_cached_tokens(call, usage)
+        self._settle(model, reserved, _used_tokens(result, reserved), kwargs)
+        return result
+
+    def _instructor_create(self, model: str, messages: list, response_model: type[AppBaseModel], kwargs: dict):
+        """instructor 请求 fn(deadline)，异步客户端返回 awaitable"""
+        param = {
+            "temperature": kwargs.get("temperature", self.temperature),
+            "n": kwargs.get("n", 1),
+        }
+        if kwargs:
+            param.update(kwargs)
+
+        def create(d: Deadline):
+            return self.client.chat.completions.create_with_completion(
+                model=model,
+                response_model=response_model,
+                messages=with_cache_breakpoints(messages, cache_style(model)),
+                **dict(param, timeout=self.retry.attempt_timeout(d, param.get("timeout", self.timeout)))
+            )
+
+        return create
+
+    def _structured_flow(
+            self,
+            model: str,
+            messages: list,
+            json_format: bool,
+            response_model: type[AppBaseModel],
+            call: CallMetrics,
+            deadline: Deadline,
+            kwargs: dict,
+    ):
+        """
+        支持结构化输出的模型在首个请求中就带上 response_model 的 schema，返回 (result, 是否按 schema 输出)。
+        服务端以 400/422 拒绝时去掉 schema 重发一次，成功后记下该模型不支持，之后直接使用 json_object
+        """
+        def request(**extra):
+            return lambda: self._ask_request(model=model, messages=messages, json_format=json_format, call=call,
+                                             deadline=deadline, **extra, **kwargs)
+
+        mode = _structured_mode(self.capabilities, model, json_format, response_model)
+        if mode is not None:
+            try:
+                return (yield request(structured=structured_output(mode, response_model))), True
+            except HTTPStatusError as e:
+                if not _schema_rejected(e):
+                    raise
+        result = yield request()
+        if mode is not None:
+            self.capabilities.mark_unsupported(model, mode)
+        return result, False
+
+    def _check_json_flow(
+            self,
+            model: str,
+            messages: list,
+            result: tuple,
+            response_model: type[AppBaseModel],
+            call: CallMetrics,
+            deadline: Deadline,
+            schema: bool,
+            kwargs: dict,
+    ):
+        content, prompt_tokens, completion_tokens, tokens_exceed = result
+        if schema:
+            # 按 schema 约束的输出一次校验通过即可，不再做任何字符串修复
+            validated = validate_structured(content, response_model)
+            if validated is not None:
+                _record_tier(call, "schema")
+                return validated, prompt_tokens, completion_tokens, tokens_exceed
+        validate = _model_validator(response_model)
+        try:
+            # 校验 JSON 格式，先直接解析，失败后在本地修复
+            json_obj, tier = parse_json_locally(content, validate)
+            _record_tier(call, tier)
+            content = json.dumps(json_obj)
+            return content, prompt_tokens, completion_tokens, tokens_exceed
+        except ValueError as e:
+            print(f"json error: {e}")
+        # 本地修复失败后才交给 LLM 修复，最后再使用 instructor 重新请求
+        broken = content
+        content = _fixed_content((yield lambda: self._fix_json(broken)), validate)
+        if content:
+            _record_tier(call, "llm_fix")
+            return content, prompt_tokens, completion_tokens, tokens_exceed
+        if not _is_app_model(response_model):
+            _record_tier(call, "failed")
+            return content, prompt_tokens, completion_tokens, tokens_exceed
+        result = yield lambda: self._ask_instructor(model=model, messages=messages, response_model=response_model,
+                                                    call=call, deadline=deadline, **kwargs)
+        _record_tier(call, "instructor")
+        return result
+
+    def _ask_flow(self, model: str, prompt, system_prompt: str, json_format: bool, kwargs: dict):
+        """ask / ask_async 的共享流程：命中缓存直接返回，否则请求并校验 JSON，同时记录这次调用的指标"""
+        response_model = kwargs.pop("response_model", None)
+        use_cache = kwargs.pop("use_cache", True)
+        deadline = self.retry.step_deadline(kwargs.pop("deadline", None))
+        messages = _build_messages(prompt, system_prompt)
+        key = _cache_key(self.cache, use_cache, model, messages, json_format, response_model, self.temperature, kwargs)
+        call = CallMetrics(model=model, started_at=time.time())
+        start = time.perf_counter()
+        result = None
+        try:
+            if key is not None:
+                result = self.cache.get(key)
+                if result is not None:
+                    call.cached = True
+                    return result
+
+            result, schema = yield from self._structured_flow(
+                model, messages, json_format, response_model, call, deadline, kwargs
+            )
+            call.network_time = time.perf_counter() - start
+            if json_format:
+                parse_start = time.perf_counter()
+                result = yield from self._check_json_flow(
+                    model, messages, result, response_model, call, deadline, schema, kwargs
+                )
+                call.parse_time = time.perf_counter() - parse_start
+            if key is not None and result[0]:
+                self.cache.put(key, result)
+            return result
+        except Exception as e:
+            call.error = str(e)
+            raise
+        finally:
+            _finish_call(self.metrics, call, start, result)
+
+
+class Chatbot(_ChatbotBase):
+    """
+    同步客户端。实例持有 keep-alive 连接池，应在进程内复用而不是每次请求都新建；
+    调用 close() 或实例被回收时会关闭连接池。
+    """
+
+    def __init__(
+            self,
+            api_key: str,
+            api_url: str = None,
+            proxy: str = None,
+            timeout: float = None,
+            temperature: float = 0.5,
+            cache: ResponseCache = None,
+            metrics: MetricsRegistry = None,
+            retry: RetryPolicy = None,
+            rate_limiter: RateLimiter = None,
+            capabilities: CapabilityRegistry = None,
+    ) -> None:
+        super().__init__(api_key=api_key, api_url=api_url, proxy=proxy, timeout=timeout, temperature=temperature,
+                         cache=cache, metrics=metrics, retry=retry, rate_limiter=rate_limiter,
+                         capabilities=capabilities)
+        # 不持有 self 的引用，实例被丢弃（例如从 st.cache_resource 中淘汰）后也能关闭连接
+        self._finalizer = weakref.finalize(self, _close_clients, self._clients)
+
+    def _new_session(self):
+        import requests
+        session = requests.Session()
+        session.proxies.update(
             {
-                "http": proxy,
-                "https": proxy,
+                "http": self.proxy,
+                "https": self.proxy,
             },
         )
-        self.client = instructor.from_openai(OpenAI(
+        return session
+
+    def _new_instructor_client(self):
+        import instructor
+        from openai import OpenAI, DefaultHttpxClient
+        http_client = self._clients.get("http", lambda: DefaultHttpxClient(proxy=self.proxy))
+        return instructor.from_openai(OpenAI(
             api_key=self.api_key,
             base_url=f"{self.api_url}",
             timeout=self.timeout,
-            max_retries=3,
-            http_client=DefaultHttpxClient(
-                proxies=proxy
-            ),
+            max_retries=0,
+            http_client=http_client,
         ))
 
+    @property
+    def session(self):
+        return self._clients.get("session", self._new_session)
+
+    def _limited(self, model: str, messages: list, kwargs: dict, fn):
+        """
+        包装 fn(deadline)：每次尝试之前都向限流器申请额度，重试同样计入 rpm/tpm；
+        请求失败或被取消时归还预约的 token，成功时返回 (结果, 预约的 token 数)，由调用方按实际用量结算
+        """
+        def attempt(d: Deadline):
+            if self.rate_limiter is None:
+                return fn(d), 0
+            reserved = _reserved_tokens(messages, kwargs)
+            self.rate_limiter.acquire(model, reserved, api_key=kwargs.get("api_key", self.api_key))
+            with self._refund_on_failure(model, reserved, kwargs):
+                # 排队期间调用方可能已经放弃结果（对冲落败），此时归还额度而不是发出请求
+                raise_if_cancelled(model)
+                return fn(d), reserved
+
+        return attempt
+
+    def _post(self, payload: dict, deadline: Deadline, stream: bool = False, **kwargs):
+        """发出一次请求，非 200 时抛出 HTTPStatusError，由 self.retry 决定是否重试"""
+        url = (
+            f"{self.api_url}/chat/completions"
+        )
+        headers = {"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"}
+        response = self.session.post(
+            url,
+            headers=headers,
+            json=payload,
+            timeout=self.retry.attempt_timeout(deadline, kwargs.get("timeout", self.timeout)),
+            stream=stream,
+        )
+        if response.status_code != 200:
+            with response:
+                raise HTTPStatusError(response.status_code, response.reason, response.text, response.headers)
+        return response
+
     def _ask_request(
             self,
             model: str,
             messages: list,
             json_format: bool = False,
+            call: CallMetrics = None,
+            all_choices: bool = False,
+            deadline: Deadline = None,
+            structured: dict = None,
             **kwargs,
     ):
         # Get response
+        payload = _build_payload(model, messages, json_format, False, self.temperature, structured, **kwargs)
+        response, reserved = self.retry.call(
+            model, self._limited(model, messages, kwargs, lambda d: self._post(payload, d, **kwargs)), deadline, call
+        )
+        body = response.json()
+        result = _parse_choices(body) if all_choices else _parse_completion(body)
+        return self._settled(model, reserved, result, body.get("usage"), call, kwargs)
+
+    def _ask_stream_request(
+            self,
+            model: str,
+            messages: list,
+            json_format: bool = False,
+            call: CallMetrics = None,
+            deadline: Deadline = None,
+            structured: dict = None,
+            **kwargs,
+    ):
+        """
+        以 SSE 方式请求，逐块 yield (delta, None)，结束时 yield ("", (content, prompt_tokens, ...))。
+        只有在收到响应头之前的失败会重试，已经开始输出的流不会重新请求
+        """
+        payload = _build_payload(model, messages, json_format, True, self.temperature, structured, **kwargs)
+        response, reserved = self.retry.call(
+            model, self._limited(model, messages, kwargs, lambda d: self._post(payload, d, stream=True, **kwargs)),
+            deadline, call
+        )
+        with response:
+            response.encoding = "utf-8"
+            parts = []
+            prompt_tokens = 0
+            completion_tokens = 0
+            finish_reason = None
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk: dict = json.loads(data)
+                usage = chunk.get("usage")
+                if usage:
+                    prompt_tokens = usage.get("prompt_tokens", 0)
+                    completion_tokens = usage.get("completion_tokens", 0)
+                    _record_cached_tokens(call, usage)
+                choices = chunk.get("choices")
+                if not choices:
+                    continue
+                finish_reason = choices[0].get("finish_reason") or finish_reason
+                delta = _message_content(choices[0].get("delta") or {})
+                if delta:
+                    parts.append(delta)
+                    yield delta, None
+        tokens_exceed = _finish_reason_exceed(finish_reason)
+        result = "".join(parts), prompt_tokens, completion_tokens, tokens_exceed
+        self._settle(model, reserved, _used_tokens(result, reserved), kwargs)
+        yield "", result
+
+    def _ask_instructor(
+            self,
+            model: str,
+            messages: list,
+            response_model: type[AppBaseModel],
+            call: CallMetrics = None,
+            deadline: Deadline = None,
+            **kwargs,
+    ):
+        create = self._instructor_create(model, messages, response_model, kwargs)
+        (result_info, com), reserved = self.retry.call(model, self._limited(model, messages, kwargs, create),
+                                                        deadline, call)
+        return self._settled(model, reserved, _parse_instructor(result_info, com), com.usage, call, kwargs)
+
+    def _fix_json(self, content: str):
+        return try_fix_json_format(content)
+
+    def _ask_stream_structured(
+            self,
+            model: str,
+            messages: list,
+            json_format: bool = False,
+            response_model: type[AppBaseModel] = None,
+            call: CallMetrics = None,
+            deadline: Deadline = None,
+            **kwargs,
+    ):
+        """_structured_flow 的流式版本，yield (delta, result, 是否按 schema 输出)；拒绝只会发生在开始输出之前"""
+        mode = _structured_mode(self.capabilities, model, json_format, response_model)
+        if mode is not None:
+            try:
+                for delta, result in self._ask_stream_request(
+                        model=model, messages=messages, json_format=json_format, call=call, deadline=deadline,
+                        structured=structured_output(mode, response_model), **kwargs
+                ):
+                    yield delta, result, True
+                return
+            except HTTPStatusError as e:
+                if not _schema_rejected(e):
+                    raise
+        for delta, result in self._ask_stream_request(
+                model=model, messages=messages, json_format=json_format, call=call, deadline=deadline, **kwargs
+        ):
+            yield delta, result, False
+        if mode is not None:
+            self.capabilities.mark_unsupported(model, mode)
+
+    def _check_json(
+            self,
+            model: str,
+            messages: list,
+            result: tuple,
+            response_model: type[AppBaseModel] = None,
+            call: CallMetrics = None,
+            deadline: Deadline = None,
+            schema: bool = False,
+            **kwargs,
+    ):
+        return _run(self._check_json_flow(model, messages, result, response_model, call, deadline, schema, kwargs))
+
+    def ask(
+            self,
+            model: str,
+            prompt,
+            system_prompt: str = None,
+            json_format: bool = False,
+            **kwargs,
+    ):
+        return _run(self._ask_flow(model, prompt, system_prompt, json_format, kwargs))
+
+    def ask_n(
+            self,
+            model: str,
+            prompt,
+            n: int,
+            system_prompt: str = None,
+            json_format: bool = False,
+            **kwargs,
+    ):
+        """
+        使用 API 的 n 参数一次生成多个候选，返回 (contents, prompt_tokens, completion_tokens, tokens_exceed)。
+        json_format 时只保留能在本地解析的候选；不支持 n 的服务只会返回一个候选，由调用方补足。
+        """
+        kwargs.pop("response_model", None)
+        kwargs.pop("use_cache", None)
+        deadline = kwargs.pop("deadline", None)
+        messages = _build_messages(prompt, system_prompt)
+        call = CallMetrics(model=model, started_at=time.time())
+        start = time.perf_counter()
+        result = None
+        try:
+            contents, prompt_tokens, completion_tokens, tokens_exceed = self._ask_request(
+                model=model, messages=messages, json_format=json_format, call=call, all_choices=True, deadline=deadline,
+                n=n, **kwargs
+            )
+            call.network_time = time.perf_counter() - start
+            if json_format:
+                parse_start = time.perf_counter()
+                parsed = []
+                for content in contents:
+                    try:
+                        json_obj, tier = parse_json_locally(content)
+                    except ValueError:
+                        continue
+                    _record_tier(call, tier)
+                    parsed.append(json.dumps(json_obj))
+                contents = parsed
+                call.parse_time = time.perf_counter() - parse_start
+            result = contents, prompt_tokens, completion_tokens, tokens_exceed
+            return result
+        except Exception as e:
+            call.error = str(e)
+            raise
+        finally:
+            _finish_call(self.metrics, call, start, result)
+
+    def ask_stream(
+            self,
+            model: str,
+            prompt,
+            system_prompt: str = None,
+            json_format: bool = False,
+            **kwargs,
+    ):
+        """
+        ask 的流式版本，逐块 yield (delta, None)，结束时 yield ("", result)，
+        result 为与 ask 相同的 (content, prompt_tokens, completion_tokens, tokens_exceed)
+        """
+        response_model = kwargs.pop("response_model", None)
+        use_cache = kwargs.pop("use_cache", True)
+        deadline = self.retry.step_deadline(kwargs.pop("deadline", None))
+        messages = _build_messages(prompt, system_prompt)
+        key = _cache_key(self.cache, use_cache, model, messages, json_format, response_model, self.temperature, kwargs)
+        call = CallMetrics(model=model, stream=True, started_at=time.time())
+        start = time.perf_counter()
+        result = None
+        try:
+            if key is not None:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    call.cached = True
+                    yield cached[0], None
+                    result = cached
+                    yield "", cached
+                    return
+
+            streamed = None
+            schema = False
+            for delta, streamed, schema in self._ask_stream_structured(
+                    model=model, messages=messages, json_format=json_format, response_model=response_model, call=call,
+                    deadline=deadline, **kwargs
+            ):
+                if streamed is None:
+                    if call.first_token_time is None:
+                        call.first_token_time = time.perf_counter() - start
+                    yield delta, None
+            call.network_time = time.perf_counter() - start
+            if json_format:
+                parse_start = time.perf_counter()
+                streamed = self._check_json(model, messages, streamed, response_model, call=call, deadline=deadline,
+                                            schema=schema, **kwargs)
+                call.parse_time = time.perf_counter() - parse_start
+            if key is not None and streamed[0]:
+                self.cache.put(key, streamed)
+            result = streamed
+            yield "", result
+        except Exception as e:
+            call.error = str(e)
+            raise
+        finally:
+            _finish_call(self.metrics, call, start, result)
+
+    def close(self):
+        self._finalizer()
+
+
+class AsyncChatbot(_ChatbotBase):
+    """
+    Chatbot 的 asyncio 版本，接口与返回值保持一致。
+    直接请求与 instructor 客户端共用同一个有上限的 keep-alive 连接池，同一个实例可以被大量并发的推理链共享。
+    """
+
+    def __init__(
+            self,
+            api_key: str,
+            api_url: str = None,
+            proxy: str = None,
+            timeout: float = None,
+            temperature: float = 0.5,
+            max_connections: int = 100,
+            max_keepalive_connections: int = 20,
+            rate_limiter: RateLimiter = None,
+            cache: ResponseCache = None,
+            metrics: MetricsRegistry = None,
+            retry: RetryPolicy = None,
+            capabilities: CapabilityRegistry = None,
+    ) -> None:
+        super().__init__(api_key=api_key, api_url=api_url, proxy=proxy, timeout=timeout, temperature=temperature,
+                         cache=cache, metrics=metrics, retry=retry, rate_limiter=rate_limiter,
+                         capabilities=capabilities)
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+
+    def _new_http(self):
+        import httpx
+        return httpx.AsyncClient(
+            proxy=self.proxy,
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+            ),
+            follow_redirects=True,
+        )
+
+    def _new_instructor_client(self):
+        import instructor
+        from openai import AsyncOpenAI
+        return instructor.from_openai(AsyncOpenAI(
+            api_key=self.api_key,
+            base_url=f"{self.api_url}",
+            timeout=self.timeout,
+            max_retries=0,
+            http_client=self.http,
+        ))
+
+    @property
+    def http(self):
+        return self._clients.get("http", self._new_http)
+
+    def _limited(self, model: str, messages: list, kwargs: dict, fn):
+        """Chatbot._limited 的异步版本，排队等待额度时不阻塞事件循环"""
+        async def attempt(d: Deadline):
+            if self.rate_limiter is None:
+                return await fn(d), 0
+            reserved = _reserved_tokens(messages, kwargs)
+            await self.rate_limiter.acquire_async(model, reserved, api_key=kwargs.get("api_key", self.api_key))
+            # 对冲落败或客户端断开时任务被取消（CancelledError），同样归还额度
+            with self._refund_on_failure(model, reserved, kwargs):
+                raise_if_cancelled(model)
+                return await fn(d), reserved
+
+        return attempt
+
+    async def _post(self, payload: dict, deadline: Deadline, **kwargs):
         url = (
             f"{self.api_url}/chat/completions"
         )
         headers = {"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"}
-
-        payload = {
-            "model": model,
-            "messages": messages,
-            "stream": False,
-            # kwargs
-            "temperature": kwargs.get("temperature", self.temperature),
-            "n": kwargs.get("n", 1),
-        }
-        if json_format:
-            payload["response_format"] = {
-                "type": "json_object"
-            }
-        for key, value in kwargs.items():
-            payload[key] = value
-        response = self.session.post(
+        response = await self.http.post(
             url,
             headers=headers,
             json=payload,
-            timeout=kwargs.get("timeout", self.timeout),
-            stream=False,
+            timeout=self.retry.attempt_timeout(deadline, kwargs.get("timeout", self.timeout)),
         )
         if response.status_code != 200:
-            raise Exception(
-                f"{response.status_code} {response.reason} {response.text}",
-            )
-        resp: dict = response.json()
-        choices = resp.get("choices")
-        delta = choices[0].get("message")
-        content = delta["content"]
-        usage = resp.get("usage", None)
-        prompt_tokens = 0
-        completion_tokens = 0
-        if usage:
-            prompt_tokens = usage.get("prompt_tokens", 0)
-            completion_tokens = usage.get("completion_tokens", 0)
-        finish_reason = choices[0].get("finish_reason")
-        tokens_exceed = finish_reason in ["length", "max_tokens", "MAX_TOKENS"]
-        return content, prompt_tokens, completion_tokens, tokens_exceed
+            raise HTTPStatusError(response.status_code, response.reason_phrase, response.text, response.headers)
+        return response
 
-    def _ask_instructor(
+    async def _ask_request(
             self,
             model: str,
             messages: list,
-            response_model: type[AppBaseModel],
+            json_format: bool = False,
+            call: CallMetrics = None,
+            deadline: Deadline = None,
+            structured: dict = None,
             **kwargs,
     ):
-        param = {
-            "temperature": kwargs.get("temperature", self.temperature),
-            "n": kwargs.get("n", 1),
-        }
-        if kwargs:
-            param.update(kwargs)
-        result_info, com = self.client.chat.completions.create_with_completion(
-            model=model,
-            response_model=response_model,
-            messages=messages,
-            **param
+        payload = _build_payload(model, messages, json_format, False, self.temperature, structured, **kwargs)
+        response, reserved = await self.retry.acall(
+            model, self._limited(model, messages, kwargs, lambda d: self._post(payload, d, **kwargs)), deadline, call
         )
-        finish_reason = com.choices[0].finish_reason
-        tokens_exceed = finish_reason in ["length", "max_tokens", "MAX_TOKENS"]
-        prompt_tokens = com.usage.prompt_tokens
-        completion_tokens = com.usage.completion_tokens
-        content = json.dumps(class_to_dict(result_info))
-        return content, prompt_tokens, completion_tokens, tokens_exceed
+        body = response.json()
+        return self._settled(model, reserved, _parse_completion(body), body.get("usage"), call, kwargs)
 
-    def ask(
+    async def _ask_instructor(
+            self,
+            model: str,
+            messages: list,
+            response_model: type[AppBaseModel],
+            call: CallMetrics = None,
+            deadline: Deadline = None,
+            **kwargs,
+    ):
+        create = self._instructor_create(model, messages, response_model, kwargs)
+        (result_info, com), reserved = await self.retry.acall(model, self._limited(model, messages, kwargs, create),
+                                                               deadline, call)
+        return self._settled(model, reserved, _parse_instructor(result_info, com), com.usage, call, kwargs)
+
+    async def _fix_json(self, content: str):
+        return await asyncio.to_thread(try_fix_json_format, content)
+
+    async def ask_async(
             self,
             model: str,
             prompt,
@@ -155,40 +915,9 @@ class Chatbot:
             json_format: bool = False,
             **kwargs,
     ):
-        response_model = kwargs.pop("response_model", None)
-        if isinstance(prompt, str):
-            messages = []
-            if system_prompt:
-                messages.append({
-                    "role": "system",
-                    "content": system_prompt
-                })
-            messages.append({
-                "role": "user",
-                "content": prompt
-            })
-        else:
-            messages = prompt
-
-        content, prompt_tokens, completion_tokens, tokens_exceed = self._ask_request(
-            model=model, messages=messages, json_format=json_format, **kwargs
-        )
-        if not json_format:
-            return content, prompt_tokens, completion_tokens, tokens_exceed
-        try:
-            # 校验 JSON 格式
-            json_obj = extract_json(content)
-            content = json.dumps(json_obj)
-            return content, prompt_tokens, completion_tokens, tokens_exceed
-        except JSONDecodeError as e:
-            print(f"json error: {e}")
-            content = try_fix_json_format(content)
-            if content:
-                return content, prompt_tokens, completion_tokens, tokens_exceed
-            if not (isinstance(response_model, type) and issubclass(response_model, AppBaseModel)):
-                return content, prompt_tokens, completion_tokens, tokens_exceed
-            return self._ask_instructor(model=model, messages=messages, response_model=response_model, **kwargs)
+        return await _arun(self._ask_flow(model, prompt, system_prompt, json_format, kwargs))
 
-    def close(self):
-        self.session.close()
-        self.client.client.close()
+    async def close(self):
+        http = self._clients.created("http")
+        if http is not None:
+            await http.aclose()
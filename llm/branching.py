@@ -0,0 +1,229 @@
+import contextvars
+import json
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from llm.context import ContextCompactor
+from llm.reasoning import (
+    FINAL_ANSWER_PROMPT,
+    default_client,
+    final_answer_content,
+    initial_messages,
+    make_api_call,
+    make_api_call_error,
+    prepare_messages,
+)
+from llm.policy import ChainState, StepPolicy, make_policy
+from llm.retry import Deadline
+
+logger = logging.getLogger(__name__)
+
+SELECTIONS = ("confidence", "vote")
+# 候选步骤必须包含的字段，缺少 next_action 的步骤会在步骤策略或推理链结束时出错
+STEP_KEYS = ("title", "content", "next_action")
+
+
+class Branch:
+    """一条并行探索的推理分支"""
+
+    def __init__(self, index: int, messages: list, max_steps: int):
+        self.index = index
+        self.messages = messages
+        self.state = ChainState(max_steps)
+        self.steps = []
+        self.step_data = None
+        self.confidence = 0.0
+        self.finished = False
+        self.pruned_at = None
+        self.final_content = None
+
+    @property
+    def alive(self) -> bool:
+        return not self.finished and self.pruned_at is None
+
+    def append(self, step_data: dict, thinking_time: float):
+        self.step_data = step_data
+        self.steps.append((f"{step_data['title']}", step_data["content"], thinking_time))
+        self.messages.append({"role": "assistant", "content": json.dumps(step_data)})
+        self.state.add(step_data)
+        try:
+            self.confidence = float(step_data.get("confidence", 0))
+        except (TypeError, ValueError):
+            self.confidence = 0.0
+
+    def summary(self) -> dict:
+        return {
+            "branch": self.index,
+            "steps": len(self.steps),
+            "confidence": self.confidence,
+            "pruned_at": self.pruned_at,
+            "stopped_by": self.state.stopped_by,
+            "final_answer": self.final_content,
+        }
+
+
+def _answer_tokens(text: str) -> set:
+    return set(re.findall(r"\w+", str(text).lower()))
+
+
+def _vote(branches: list) -> Branch:
+    """把相似的最终答案（词集合 Jaccard >= 0.6）归为一组，选票数最多的组，平票时比较平均置信度"""
+    groups = []
+    for branch in branches:
+        tokens = _answer_tokens(branch.final_content)
+        for group in groups:
+            union = tokens | group["tokens"]
+            if union and len(tokens & group["tokens"]) / len(union) >= 0.6:
+                group["members"].append(branch)
+                break
+        else:
+            groups.append({"tokens": tokens, "members": [branch]})
+    best = max(groups, key=lambda g: (len(g["members"]), sum(b.confidence for b in g["members"]) / len(g["members"])))
+    return max(best["members"], key=lambda b: b.confidence)
+
+
+def _submit(pool, fn, *args, **kwargs):
+    """在线程池中执行 fn，并带上当前的上下文变量（例如限流器的排队会话）"""
+    return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def _valid_step(step_data) -> bool:
+    return isinstance(step_data, dict) and all(isinstance(step_data.get(key), str) for key in STEP_KEYS)
+
+
+def _fork(client, messages: list, branches: int, temperature: float, model: str, use_n: bool, pool,
+          deadline: Deadline = None):
+    """在当前位置分叉出多个候选步骤，优先用 n 参数一次请求，不支持时用并发请求补足"""
+    candidates = []
+    if use_n:
+        try:
+            contents, _, _, _ = client.ask_n(model=model, prompt=messages, n=branches, json_format=True,
+                                             max_tokens=4096, temperature=temperature, deadline=deadline)
+            candidates = [c for c in map(json.loads, contents) if _valid_step(c)]
+        except Exception as e:
+            logger.error(f"使用 n 参数分叉失败，改为并发请求。错误: {str(e)}")
+    missing = branches - len(candidates)
+    if missing > 0:
+        # 分叉点的消息完全相同，需要绕过响应缓存才能得到不同的候选
+        futures = [_submit(pool, make_api_call, messages, 4096, temperature=temperature, model=model, client=client,
+                                  use_cache=False, deadline=deadline) for _ in range(missing)]
+        candidates.extend(f.result() for f in futures)
+    valid = [c for c in candidates if _valid_step(c)]
+    if len(valid) < len(candidates):
+        logger.warning(f"丢弃 {len(candidates) - len(valid)} 个缺少必需字段的候选步骤")
+    if not valid:
+        return [make_api_call_error(ValueError("no candidate step has all of " + ", ".join(STEP_KEYS)))]
+    return valid[:branches]
+
+
+def _timed_call(messages, temperature, model, client, deadline, is_final_answer=False):
+    start = time.time()
+    data = make_api_call(messages, 4096, temperature=temperature, is_final_answer=is_final_answer, model=model,
+                         client=client, deadline=deadline)
+    return data, time.time() - start
+
+
+def generate_branched_response(prompt, max_steps=5, temperature=0.5, model="gpt-4o", client=None,
+                               context_budget=None, branches=3, selection="vote", prune_threshold=0.5,
+                               use_n=True, policy: StepPolicy = None, chain_timeout: float = None):
+    """
+    并行自洽（self-consistency）模式：在第一步分叉出 branches 条分支，之后各分支并发推进，
+    每一轮置信度低于 prune_threshold 的分支会被提前剪掉（至少保留一条）。
+    selection 为 "confidence" 时选择最后置信度最高的分支，为 "vote" 时对各分支的最终答案多数投票。
+    yield 的内容与 generate_response 相同，steps 为当前最优分支；分支需要一定的随机性，温度至少为 0.7。
+    policy 对每条分支独立判断是否继续，节省的调用次数按分支累计。
+    """
+    client = client or default_client()
+    policy = policy or make_policy("legacy")
+    deadline = Deadline(chain_timeout)
+    if selection not in SELECTIONS:
+        raise ValueError(f"unknown selection: {selection}")
+    branch_temperature = max(temperature, 0.7)
+    compactor = ContextCompactor(context_budget) if context_budget else None
+    logger.info(f"正在以 {branches} 条并行分支为提示生成回答: {prompt}")
+    start_time = time.time()
+    messages = initial_messages(prompt)
+
+    with ThreadPoolExecutor(max_workers=branches) as pool:
+        step_start = time.time()
+        request_messages, _ = prepare_messages(messages, compactor, 1)
+        candidates = _fork(client, request_messages, branches, branch_temperature, model, use_n, pool, deadline)
+        thinking_time = time.time() - step_start
+        active = []
+        for index, step_data in enumerate(candidates):
+            branch = Branch(index, list(messages), max_steps)
+            branch.append(step_data, thinking_time)
+            active.append(branch)
+        all_branches = list(active)
+        step_count = 1
+
+        while True:
+            for branch in active:
+                user_message = policy.next_message(branch.state)
+                if user_message is None:
+                    branch.finished = True
+                else:
+                    branch.messages.append({"role": "user", "content": user_message})
+            live = [b for b in active if b.alive]
+            if step_count >= 2 and len(live) > 1:
+                best = max(live, key=lambda b: b.confidence)
+                for branch in live:
+                    if branch is not best and branch.confidence < prune_threshold:
+                        branch.pruned_at = step_count
+                        logger.info(f"第 {step_count} 步剪掉分支 {branch.index} (置信度 {branch.confidence:.2f})")
+                live = [b for b in live if b.alive]
+            leader = max((b for b in all_branches if b.pruned_at is None), key=lambda b: b.confidence)
+            if not live:
+                break
+            yield leader.steps, None, None
+
+            step_count += 1
+            logger.info(f"开始第 {step_count} 步，剩余 {len(live)} 条分支")
+            futures = {}
+            for branch in live:
+                branch_messages, _ = prepare_messages(branch.messages, compactor, step_count)
+                futures[_submit(pool, _timed_call, branch_messages, branch_temperature, model, client, deadline)] = branch
+            for future, branch in futures.items():
+                step_data, elapsed = future.result()
+                if not _valid_step(step_data):
+                    remaining = [b for b in all_branches if b.pruned_at is None and b is not branch]
+                    if remaining:
+                        # 缺少必需字段的步骤只影响这一条分支，把它剪掉，其余分支继续
+                        branch.pruned_at = step_count
+                        logger.warning(f"第 {step_count} 步分支 {branch.index} 的步骤缺少必需字段，剪掉该分支")
+                        continue
+                    step_data = make_api_call_error(ValueError("step is missing one of " + ", ".join(STEP_KEYS)))
+                branch.append(step_data, elapsed)
+            active = [b for b in live if b.pruned_at is None]
+
+        # 为每条未被剪掉的分支并发生成最终答案
+        survivors = [b for b in all_branches if b.pruned_at is None]
+        futures = {}
+        for branch in survivors:
+            branch.messages.append({"role": "user", "content": FINAL_ANSWER_PROMPT})
+            branch_messages, _ = prepare_messages(branch.messages, compactor, step_count + 1)
+            futures[_submit(pool, _timed_call, branch_messages, temperature, model, client, deadline, True)] = branch
+        for future, branch in futures.items():
+            final_data, elapsed = future.result()
+            branch.final_content = final_answer_content(final_data)
+            branch.steps.append(("最终答案", branch.final_content, elapsed))
+
+    if selection == "vote" and len(survivors) > 1:
+        winner = _vote(survivors)
+    else:
+        winner = max(survivors, key=lambda b: b.confidence)
+    calls_saved = sum(policy.finish(b.state) for b in survivors)
+    total_thinking_time = time.time() - start_time
+    logger.info(f"选择分支 {winner.index}，总思考时间: {total_thinking_time:.2f} 秒")
+    full_response = {
+        "steps": winner.steps,
+        "total_thinking_time": total_thinking_time,
+        "selection": selection,
+        "winner": winner.index,
+        "branches": [b.summary() for b in all_branches],
+        "policy": {"name": policy.name, "stopped_by": winner.state.stopped_by, "steps": winner.state.step_count,
+                   "calls_saved": calls_saved},
+    }
+    yield winner.steps, total_thinking_time, full_response
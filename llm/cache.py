@@ -0,0 +1,135 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class ResponseCache:
+    """
+    以请求内容寻址的两级响应缓存：进程内 LRU + 可选的 SQLite 持久化。
+    缓存值为 ask 的完整返回值 (content, prompt_tokens, completion_tokens, tokens_exceed)，命中时 token 数与原始请求一致。
+    ttl 为秒数，None 表示不过期；path 为 None 时只使用内存缓存。
+    """
+
+    def __init__(
+            self,
+            max_entries: int = 1024,
+            ttl: float = None,
+            path: str = None,
+            max_disk_entries: int = 100000,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "puts": 0, "evictions": 0}
+        self._db = None
+        self._puts_since_trim = 0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS response_cache_created ON response_cache (created)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(model: str, messages: list, response_model=None, **params) -> str:
+        params.pop("api_key", None)
+        params.pop("timeout", None)
+        if isinstance(response_model, type):
+            response_model = f"{response_model.__module__}.{response_model.__qualname__}"
+        data = json.dumps(
+            {"model": model, "messages": messages, "response_model": response_model, "params": params},
+            sort_keys=True, ensure_ascii=False, default=str,
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl is not None and now - created > self.ttl
+
+    def get(self, key: str) -> Optional[tuple]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created = entry
+                if not self._expired(created, now):
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created FROM response_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    if not self._expired(row[1], now):
+                        value = tuple(json.loads(row[0]))
+                        self._put_memory(key, value, row[1])
+                        self._stats["disk_hits"] += 1
+                        return value
+                    self._db.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                    self._db.commit()
+            self._stats["misses"] += 1
+            return None
+
+    def _put_memory(self, key: str, value: tuple, created: float):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def put(self, key: str, value: tuple):
+        now = time.time()
+        with self._lock:
+            self._put_memory(key, tuple(value), now)
+            self._stats["puts"] += 1
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, created) VALUES (?, ?, ?)",
+                (key, json.dumps(list(value), ensure_ascii=False), now),
+            )
+            self._puts_since_trim += 1
+            if self._puts_since_trim >= 100:
+                self._trim_disk(now)
+            self._db.commit()
+
+    def _trim_disk(self, now: float):
+        """删除过期条目，并在超过 max_disk_entries 时删除最早写入的条目"""
+        self._puts_since_trim = 0
+        if self.ttl is not None:
+            self._db.execute("DELETE FROM response_cache WHERE created < ?", (now - self.ttl,))
+        cursor = self._db.execute(
+            "DELETE FROM response_cache WHERE key IN "
+            "(SELECT key FROM response_cache ORDER BY created DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,),
+        )
+        self._stats["evictions"] += max(cursor.rowcount, 0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM response_cache")
+                self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,130 @@
+import copy
+import functools
+import json
+import logging
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# 结构化输出方式：json_schema 为 response_format 严格模式，tools 为强制调用一个以 schema 为参数的函数，
+# json_object 只保证输出是 JSON，需要在本地解析和修复
+STRUCTURED_MODES = ("json_schema", "tools", "json_object")
+
+# 按模型名前缀匹配，靠前的规则优先；未匹配的模型使用 json_object
+DEFAULT_CAPABILITIES = (
+    ("gpt-4o", "json_schema"),
+    ("gpt-3.5-turbo", "tools"),
+    ("claude-", "tools"),
+    ("gemini-", "json_schema"),
+    ("qwen", "tools"),
+    ("llama-3.1", "tools"),
+)
+
+
+def parse_capabilities(values) -> Dict[str, str]:
+    """解析 PREFIX=MODE 形式的规则，多条规则可以用分号或多次传入分隔"""
+    rules = {}
+    for value in values or []:
+        for rule in value.split(";"):
+            if not rule.strip():
+                continue
+            prefix, _, mode = rule.partition("=")
+            mode = mode.strip()
+            if mode not in STRUCTURED_MODES:
+                raise ValueError(f"unknown structured output mode: {mode}")
+            rules[prefix.strip()] = mode
+    return rules
+
+
+def _strip_titles(schema: dict):
+    """去掉严格模式不需要的 title，并为每个对象补上 additionalProperties: false 和完整的 required"""
+    schema.pop("title", None)
+    if schema.get("type") == "object":
+        schema["additionalProperties"] = False
+        schema["required"] = list(schema.get("properties", {}))
+    for sub in schema.get("properties", {}).values():
+        _strip_titles(sub)
+    for sub in schema.get("$defs", {}).values():
+        _strip_titles(sub)
+    for key in ("anyOf", "allOf", "oneOf"):
+        for sub in schema.get(key, []):
+            _strip_titles(sub)
+    if isinstance(schema.get("items"), dict):
+        _strip_titles(schema["items"])
+
+
+@functools.lru_cache(maxsize=None)
+def strict_schema(response_model) -> dict:
+    schema = copy.deepcopy(response_model.model_json_schema())
+    _strip_titles(schema)
+    return schema
+
+
+def structured_output(mode: str, response_model) -> dict:
+    """生成要合并进请求体的参数，让服务端按 response_model 的 schema 输出"""
+    name = response_model.__name__
+    if mode == "json_schema":
+        return {"response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": name, "schema": strict_schema(response_model), "strict": True},
+        }}
+    if mode == "tools":
+        return {
+            "tools": [{"type": "function", "function": {
+                "name": name,
+                "description": (response_model.__doc__ or name).strip(),
+                "parameters": strict_schema(response_model),
+            }}],
+            "tool_choice": {"type": "function", "function": {"name": name}},
+        }
+    return {"response_format": {"type": "json_object"}}
+
+
+def validate_structured(content: str, response_model) -> Optional[str]:
+    """一次性按 response_model 校验输出，通过时返回规范化的 JSON 文本，否则返回 None，由调用方回到本地解析与修复"""
+    if not content:
+        return None
+    try:
+        return json.dumps(response_model.model_validate_json(content).model_dump())
+    except ValueError:
+        return None
+
+
+class CapabilityRegistry:
+    """
+    每个模型支持的结构化输出方式。register 覆盖默认规则；
+    服务端拒绝 json_schema / tools 参数（400）而去掉该参数后请求成功时，调用方用 mark_unsupported 记下，
+    该模型之后在本进程内退回 json_object。
+    """
+
+    def __init__(self, rules=DEFAULT_CAPABILITIES):
+        self._rules = list(rules)
+        self._unsupported = set()
+        self._lock = threading.Lock()
+
+    def register(self, prefix: str, mode: str):
+        """为模型名前缀指定结构化输出方式，优先于已有规则；重复注册同一前缀会替换原来的设置"""
+        if mode not in STRUCTURED_MODES:
+            raise ValueError(f"unknown structured output mode: {mode}")
+        with self._lock:
+            self._rules = [(prefix, mode)] + [rule for rule in self._rules if rule[0] != prefix]
+
+    def mode(self, model: str) -> str:
+        with self._lock:
+            for prefix, mode in self._rules:
+                if model.startswith(prefix):
+                    return "json_object" if (model, mode) in self._unsupported else mode
+        return "json_object"
+
+    def mark_unsupported(self, model: str, mode: str):
+        logger.warning(f"模型 {model} 不支持 {mode} 结构化输出，退回 json_object")
+        with self._lock:
+            self._unsupported.add((model, mode))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"rules": list(self._rules), "unsupported": sorted(self._unsupported)}
+
+
+capabilities = CapabilityRegistry()
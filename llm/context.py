@@ -0,0 +1,84 @@
+import json
+
+from llm.llm_tools import estimate_tokens
+
+SUMMARY_HEADER = "[Summary of your earlier reasoning steps, condensed to save context]"
+
+
+class ContextCompactor:
+    """
+    把推理链的消息历史压缩到 token 预算以内，原始 messages 不会被修改。
+    第一个步骤之前的消息（系统提示、用户问题以及语义缓存附加的参考答案）和最近 keep_recent 步保持原样，
+    更早的步骤依次降级为：截断后的摘要 -> 只保留标题 -> 省略最早的步骤，摘要会附加在第一个步骤之前的最后一条消息之后，
+    保持消息角色交替。
+    """
+
+    def __init__(self, token_budget: int, keep_recent: int = 3, summary_chars: int = 240):
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.summary_chars = summary_chars
+
+    @staticmethod
+    def _step_fields(message: dict) -> dict:
+        try:
+            data = json.loads(message["content"])
+            if isinstance(data, dict):
+                return data
+        except (ValueError, TypeError):
+            pass
+        return {"content": message.get("content") or ""}
+
+    def _summarize(self, index: int, message: dict, level: int) -> str:
+        data = self._step_fields(message)
+        title = data.get("title") or f"Step {index}"
+        if level == 0:
+            content = " ".join(str(data.get("content", "")).split())
+            if len(content) > self.summary_chars:
+                content = content[:self.summary_chars].rstrip() + "..."
+            line = f"{index}. {title}: {content}"
+        else:
+            line = f"{index}. {title}"
+        if data.get("confidence") is not None:
+            line += f" (confidence {data['confidence']})"
+        return line
+
+    def _build(self, head: list, older: list, tail: list, level: int, omitted: int) -> list:
+        lines = [SUMMARY_HEADER]
+        if omitted:
+            lines.append(f"({omitted} earliest steps omitted)")
+        for index, message in older[omitted:]:
+            lines.append(self._summarize(index, message, level))
+        last = head[-1]
+        last = dict(last, content=f"{last['content']}\n\n" + "\n".join(lines))
+        return head[:-1] + [last] + tail
+
+    def compact(self, messages: list):
+        """返回 (compacted_messages, saved_tokens)，未超出预算时原样返回"""
+        original_tokens = estimate_tokens(messages)
+        if not self.token_budget or original_tokens <= self.token_budget or len(messages) <= 2:
+            return messages, 0
+
+        start = next((i for i, m in enumerate(messages) if m["role"] == "assistant"), len(messages))
+        head, body = messages[:start], messages[start:]
+        # 最近的步骤以 (assistant, user) 成对出现，从第一个保留的 assistant 消息开始截断
+        tail_start = len(body)
+        kept = 0
+        while tail_start > 0 and kept < self.keep_recent:
+            tail_start -= 1
+            if body[tail_start]["role"] == "assistant":
+                kept += 1
+        tail = body[tail_start:]
+        older = [(i + 1, m) for i, m in enumerate(m for m in body[:tail_start] if m["role"] == "assistant")]
+        if not head or not older:
+            return messages, 0
+
+        compacted = None
+        for level in (0, 1):
+            compacted = self._build(head, older, tail, level, 0)
+            if estimate_tokens(compacted) <= self.token_budget:
+                return compacted, original_tokens - estimate_tokens(compacted)
+        for omitted in range(1, len(older) + 1):
+            compacted = self._build(head, older, tail, 1, omitted)
+            if estimate_tokens(compacted) <= self.token_budget:
+                break
+        return compacted, max(original_tokens - estimate_tokens(compacted), 0)
@@ -0,0 +1,43 @@
+import gzip
+import json
+
+FORMATS = ("json", "jsonl")
+
+_MIME = {"json": "application/json", "jsonl": "application/x-ndjson"}
+
+
+def step_records(full_response: dict) -> list:
+    """把 steps 的 (title, content, thinking_time) 元组与 step_stats 中的 token 统计合并为每步一条记录"""
+    stats = full_response.get("step_stats") or []
+    records = []
+    for index, (title, content, thinking_time) in enumerate(full_response["steps"]):
+        record = {"index": index + 1, "title": title, "content": content, "thinking_time": thinking_time}
+        if index < len(stats):
+            record.update(stats[index])
+        records.append(record)
+    return records
+
+
+def chain_summary(full_response: dict) -> dict:
+    """除步骤以外的整条推理链信息"""
+    return {key: value for key, value in full_response.items() if key not in ("steps", "step_stats")}
+
+
+def export_chain(full_response: dict, fmt: str = "json", compress: bool = False):
+    """
+    在内存中序列化推理链，返回 (data, file_name, mime)。
+    json 为单个对象；jsonl 第一行为整条链的汇总（type 为 chain），之后每行一个步骤（type 为 step）
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown export format: {fmt}")
+    steps = step_records(full_response)
+    if fmt == "json":
+        text = json.dumps(dict(chain_summary(full_response), steps=steps), ensure_ascii=False, indent=2)
+    else:
+        lines = [dict(chain_summary(full_response), type="chain")] + [dict(step, type="step") for step in steps]
+        text = "\n".join(json.dumps(line, ensure_ascii=False) for line in lines) + "\n"
+    data = text.encode("utf-8")
+    file_name = f"reasoning_chain.{fmt}"
+    if compress:
+        return gzip.compress(data, mtime=0), file_name + ".gz", "application/gzip"
+    return data, file_name, _MIME[fmt]
@@ -1,10 +1,12 @@
 # coding=utf-8
 import json
 import os
+import re
+import threading
+from collections import Counter
+from json import JSONDecodeError
 from typing import Optional
 
-import requests
-
 
 def extract_json(response):
     response = response.replace("JSON\n", "").replace("json\n", "").replace("```", "")
@@ -13,8 +15,233 @@ def extract_json(response):
     return json.loads(response[json_start:json_end + 1])
 
 
+JSON_TIERS = ("schema", "direct", "local_repair", "llm_fix", "instructor", "failed")
+
+_json_tier_counts = Counter()
+_json_tier_lock = threading.Lock()
+
+_HEX4 = re.compile(r"[0-9a-fA-F]{4}")
+_ASCII_WORD = re.compile(r"[A-Za-z]+")
+# 以 n / r / t 开头、和合法转义冲突的常见 LaTeX 命令；\b \f 后面紧跟字母时一律视为 LaTeX（\beta、\frac）
+_LATEX_NRT = frozenset((
+    "nabla", "ne", "neg", "neq", "newline", "ngeq", "ni", "nleq", "nmid", "not", "notin", "nu",
+    "rangle", "rceil", "rfloor", "rho", "right", "rightarrow", "rm",
+    "tan", "tanh", "tau", "text", "textbf", "textit", "tfrac", "theta", "tilde", "times", "to", "top", "triangle",
+))
+_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def record_json_tier(tier: str):
+    """记录一次 JSON 解析最终由哪一层成功：schema / direct / local_repair / llm_fix / instructor / failed"""
+    with _json_tier_lock:
+        _json_tier_counts[tier] += 1
+
+
+def get_json_tier_counts() -> dict:
+    with _json_tier_lock:
+        return {tier: _json_tier_counts[tier] for tier in JSON_TIERS}
+
+
+def _closes_string(text: str, j: int, is_key: bool, container: str) -> bool:
+    """判断字符串中的引号是结束引号还是未转义的内部引号，依据是它后面的第一个非空白字符"""
+    n = len(text)
+    while j < n and text[j].isspace():
+        j += 1
+    if j >= n:
+        return True
+    c = text[j]
+    if is_key:
+        return c == ":"
+    if c in "}]\"":
+        return True
+    if c != ",":
+        return False
+    j += 1
+    while j < n and text[j].isspace():
+        j += 1
+    if j >= n:
+        return True
+    if container == "{":
+        return text[j] in "\"}"
+    return text[j] in "\"{[]-0123456789tfn"
+
+
+def _latex_escape(text: str, i: int) -> bool:
+    """text[i] 处的反斜杠是否为 LaTeX 命令（如 \frac、\beta、\theta），而不是 \f \b \t 等 JSON 转义"""
+    word = _ASCII_WORD.match(text, i + 1)
+    if word is None:
+        return False
+    word = word.group()
+    if word[0] in "bf":
+        return len(word) > 1
+    return word in _LATEX_NRT
+
+
+def _drop_trailing_comma(out: list):
+    k = len(out) - 1
+    while k >= 0 and out[k].isspace():
+        k -= 1
+    if k >= 0 and out[k] == ",":
+        del out[k]
+
+
+def repair_json(text: str):
+    """
+    在本地容错地修复并解析模型输出的 JSON，不需要额外的 API 调用。
+    可以处理代码块标记和前后说明文字、多余的结尾逗号、缺失的逗号、字符串中未转义的引号和换行、
+    非法的反斜杠转义和与合法转义冲突的 LaTeX 命令（\frac、\beta、\theta）、Python 风格的 True/False/None
+    以及被截断未闭合的对象。无法修复时抛出 JSONDecodeError；未转义的内部引号被误判为结束引号、
+    导致对象提前闭合时也会失败，而不是悄悄丢掉后面的字段。
+    """
+    text = text.replace("```json", "").replace("```JSON", "").replace("```", "")
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        raise JSONDecodeError("no JSON object found", text, 0)
+    i = min(starts)
+    n = len(text)
+    out = []
+    stack = []
+    in_string = False
+    is_key = False
+    expect_key = False
+    gap = False
+    last = ""
+    while i < n:
+        ch = text[i]
+        if in_string:
+            if ch == "\\":
+                nxt = text[i + 1] if i + 1 < n else ""
+                if nxt and nxt in "bfnrt" and _latex_escape(text, i):
+                    out.append("\\\\")
+                    i += 1
+                elif nxt and nxt in '"\\/bfnrt':
+                    out.append(ch + nxt)
+                    i += 2
+                elif nxt == "u" and _HEX4.match(text, i + 2):
+                    out.append(text[i:i + 6])
+                    i += 6
+                else:
+                    out.append("\\\\")
+                    i += 1
+                continue
+            if ch == '"':
+                if _closes_string(text, i + 1, is_key, stack[-1] if stack else "{"):
+                    in_string = False
+                    last = '"'
+                    out.append(ch)
+                else:
+                    out.append('\\"')
+            elif ch < " ":
+                out.append(json.dumps(ch)[1:-1])
+            else:
+                out.append(ch)
+            i += 1
+            continue
+
+        if ch.isspace():
+            out.append(ch)
+            gap = True
+            i += 1
+            continue
+        if stack and (last and last in '"}]' and ch not in ",:}]"
+                      or last.isalnum() and (ch in '"{[' or gap and (ch.isalnum() or ch == "-"))):
+            # 两个值之间缺少逗号
+            out.append(",")
+            expect_key = stack[-1] == "{"
+        gap = False
+        if ch == '"':
+            in_string = True
+            is_key = bool(stack) and stack[-1] == "{" and expect_key
+            out.append(ch)
+        elif ch in "{[":
+            stack.append(ch)
+            expect_key = ch == "{"
+            out.append(ch)
+        elif ch in "}]":
+            _drop_trailing_comma(out)
+            if stack:
+                stack.pop()
+            out.append("}" if ch == "}" else "]")
+            if not stack:
+                rest = text[i + 1:]
+                if '"' in rest and ch in rest:
+                    # 后面还有字符串和同样的闭合括号，多半是 "use "}" here" 这样的内部引号让对象提前闭合
+                    raise JSONDecodeError("object closed early by an unescaped quote", text, i)
+                break
+        elif ch == ",":
+            expect_key = bool(stack) and stack[-1] == "{"
+            out.append(ch)
+        elif ch == ":":
+            expect_key = False
+            out.append(ch)
+        elif ch.isalpha():
+            j = i
+            while j < n and text[j].isalnum():
+                j += 1
+            word = text[i:j]
+            out.append(_LITERALS.get(word, word))
+            last = word[-1]
+            i = j
+            continue
+        else:
+            out.append(ch)
+        last = ch
+        i += 1
+
+    if in_string:
+        out.append('"')
+    _drop_trailing_comma(out)
+    while stack:
+        out.append("}" if stack.pop() == "{" else "]")
+    return json.loads("".join(out))
+
+
+def parse_json_locally(content: str, validate=None):
+    """
+    依次尝试直接解析和本地修复，返回 (json_obj, tier)，都失败时抛出 ValueError，由调用方决定是否交给 LLM 修复。
+    修复结果还要通过 validate(json_obj)：被截断的步骤、单独的 "{"、说明文字里的 "[1]" 都能修复成合法 JSON，
+    却不是调用方需要的结构；说明文字中有方括号时会再从第一个 "{" 开始修复一次
+    """
+    try:
+        return extract_json(content), "direct"
+    except ValueError:
+        pass
+    texts = [content]
+    brace = content.find("{")
+    if brace > 0:
+        texts.append(content[brace:])
+    error = None
+    for text in texts:
+        try:
+            json_obj = repair_json(text)
+        except ValueError as e:
+            error = e
+            continue
+        if validate is None or validate(json_obj):
+            return json_obj, "local_repair"
+        error = ValueError(f"repaired JSON does not match the expected structure: {str(json_obj)[:80]}")
+    raise error
+
+
+def estimate_tokens(messages) -> int:
+    """
+    粗略估算消息的 token 数，不依赖 tokenizer：ASCII 字符约 4 个一个 token，其他字符（如中文）约一个字符一个 token
+    """
+    if isinstance(messages, str):
+        messages = [{"content": messages}]
+    total = 0
+    for message in messages:
+        content = message.get("content") or ""
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False)
+        ascii_len = len(content.encode("ascii", "ignore"))
+        total += ascii_len // 4 + (len(content) - ascii_len) + 4
+    return total
+
+
 def generate_by_openai(model: str, messages: list[dict], temperature: float = 0.5, json_format: bool = False,
                        max_tokens: int = 4096):
+    import requests
     try:
         url = f'{os.getenv("OPENAI_API_BASE")}/chat/completions'
         data = {
@@ -98,3 +325,121 @@ say: "sun", has dog", "age": 30}"""
         return json.dumps(extract_json(result))
     except Exception as e:
         return None
+
+
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class PartialJsonParser:
+    """
+    增量解析流式输出中的 JSON 对象，只关心顶层字段。
+    每次 feed 一段增量文本，返回目前已经能确定的字段，未闭合的字符串值也会以当前内容返回，
+    数字等标量在结束后才会出现。对象之前的代码块标记或其他文字会被忽略。
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self.done = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._unicode = None
+        self._buf = []
+        self._scalar = []
+        self._key = None
+        self._expect = "key"
+
+    def feed(self, text: str) -> dict:
+        for ch in text:
+            if self.done:
+                break
+            self._step(ch)
+        return self.snapshot()
+
+    def snapshot(self) -> dict:
+        fields = dict(self.fields)
+        if self._in_string and self._depth == 1 and self._expect == "value" and self._key is not None:
+            fields[self._key] = "".join(self._buf)
+        return fields
+
+    def _scalar_value(self):
+        raw = "".join(self._scalar)
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return raw
+
+    def _flush_scalar(self):
+        if self._scalar and self._depth == 1 and self._key is not None:
+            self.fields[self._key] = self._scalar_value()
+            self._expect = "comma"
+        self._scalar = []
+
+    def _step(self, ch: str):
+        if self._depth == 0:
+            if ch == "{":
+                self._depth = 1
+            return
+        if self._in_string:
+            self._step_string(ch)
+            return
+        if ch == '"':
+            self._in_string = True
+            self._buf = []
+        elif ch in "{[":
+            self._depth += 1
+        elif ch in "}]":
+            self._flush_scalar()
+            self._depth -= 1
+            if self._depth == 1:
+                self._expect = "comma"
+            elif self._depth == 0:
+                self.done = True
+        elif self._depth > 1:
+            return
+        elif ch == ":":
+            self._expect = "value"
+        elif ch == ",":
+            self._flush_scalar()
+            self._expect = "key"
+            self._key = None
+        elif ch.isspace():
+            self._flush_scalar()
+        elif self._expect == "value":
+            self._scalar.append(ch)
+
+    def _step_string(self, ch: str):
+        if self._unicode is not None:
+            self._unicode.append(ch)
+            if len(self._unicode) == 4:
+                try:
+                    code = int("".join(self._unicode), 16)
+                    if 0xDC00 <= code <= 0xDFFF and self._buf and 0xD800 <= ord(self._buf[-1]) <= 0xDBFF:
+                        code = 0x10000 + ((ord(self._buf.pop()) - 0xD800) << 10) + (code - 0xDC00)
+                    self._buf.append(chr(code))
+                except ValueError:
+                    self._buf.append("\\u" + "".join(self._unicode))
+                self._unicode = None
+            return
+        if self._escape:
+            self._escape = False
+            if ch == "u":
+                self._unicode = []
+            else:
+                self._buf.append(_ESCAPES.get(ch, ch))
+            return
+        if ch == "\\":
+            self._escape = True
+        elif ch == '"':
+            self._in_string = False
+            if self._depth != 1:
+                return
+            value = "".join(self._buf)
+            if self._expect == "key":
+                self._key = value
+                self._expect = "colon"
+            elif self._expect == "value" and self._key is not None:
+                self.fields[self._key] = value
+                self._expect = "comma"
+        else:
+            self._buf.append(ch)
@@ -0,0 +1,244 @@
+import contextvars
+import threading
+import time
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+@dataclass
+class CallMetrics:
+    """一次 ask 调用的遥测数据，时间单位为秒"""
+    model: str
+    stream: bool = False
+    cached: bool = False
+    network_time: float = 0.0
+    parse_time: float = 0.0
+    total_time: float = 0.0
+    first_token_time: Optional[float] = None
+    json_tier: Optional[str] = None
+    attempts: int = 0
+    retries: int = 0
+    prompt_tokens: int = 0
+    # 输入 token 中命中服务端前缀缓存的部分（与 cached 表示的本地响应缓存无关）
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+    tokens_exceed: bool = False
+    error: Optional[str] = None
+    started_at: float = 0.0
+
+
+# 当前调用方用于接收 token 统计的字典，由 usage_scope 设置
+_usage_scope = contextvars.ContextVar("g1_usage_scope", default=None)
+
+
+@contextmanager
+def usage_scope(usage: dict):
+    """
+    在此范围内第一次成功的调用把命中服务端前缀缓存的输入 token 数写入 usage["cached_tokens"]。
+    客户端返回值仍为 (content, prompt_tokens, completion_tokens, tokens_exceed)；对冲时只记录先完成的请求
+    """
+    token = _usage_scope.set(usage)
+    try:
+        yield usage
+    finally:
+        _usage_scope.reset(token)
+
+
+def report_usage(call: CallMetrics):
+    usage = _usage_scope.get()
+    if usage is not None and call.error is None and "cached_tokens" not in usage:
+        usage["cached_tokens"] = call.cached_tokens
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _percentile(values: list, q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+
+
+class MetricsRegistry:
+    """
+    按模型聚合调用遥测：延迟直方图（total / network / parse）、调用数、token 数、JSON 解析层级、重试与截断次数，
+    并保留每个模型最近 window 次调用的延迟用于计算分位数。
+    """
+
+    def __init__(self, window: int = 1000, recent: int = 200):
+        self.window = window
+        self._lock = threading.Lock()
+        self._histograms = defaultdict(Histogram)
+        self._counters = defaultdict(int)
+        self._latencies = defaultdict(lambda: deque(maxlen=self.window))
+        self._first_token_latencies = defaultdict(lambda: deque(maxlen=self.window))
+        self._recent = deque(maxlen=recent)
+        self.started_at = time.time()
+
+    def record(self, call: CallMetrics):
+        with self._lock:
+            self._recent.append(call)
+            model = call.model
+            source = "cache" if call.cached else "network"
+            status = "error" if call.error else "ok"
+            self._counters[("calls", model, source, status)] += 1
+            # 失败的调用同样发出过请求，尝试次数始终计入
+            self._counters[("attempts", model)] += call.attempts
+            self._counters[("retries", model)] += call.retries
+            if call.error:
+                return
+            self._histograms[(model, "total")].observe(call.total_time)
+            if not call.cached:
+                self._histograms[(model, "network")].observe(call.network_time)
+                self._latencies[model].append(call.total_time)
+            if call.json_tier:
+                self._histograms[(model, "parse")].observe(call.parse_time)
+                self._counters[("json_tier", model, call.json_tier)] += 1
+            if call.first_token_time is not None:
+                self._histograms[(model, "first_token")].observe(call.first_token_time)
+                if not call.cached:
+                    self._first_token_latencies[model].append(call.first_token_time)
+            self._counters[("tokens", model, "prompt")] += call.prompt_tokens
+            self._counters[("tokens", model, "cached")] += call.cached_tokens
+            self._counters[("tokens", model, "completion")] += call.completion_tokens
+            if call.tokens_exceed:
+                self._counters[("truncated", model)] += 1
+
+    def latency_percentiles(self, model: str, first_token: bool = False) -> dict:
+        """最近 window 次网络调用的总耗时分位数，first_token 为 True 时为流式调用的首 token 耗时"""
+        latencies = self._first_token_latencies if first_token else self._latencies
+        with self._lock:
+            values = list(latencies.get(model, ()))
+        return {"p50": _percentile(values, 0.5), "p95": _percentile(values, 0.95), "samples": len(values)}
+
+    def recent_calls(self, n: int = 50) -> list:
+        with self._lock:
+            return [asdict(call) for call in list(self._recent)[-n:]]
+
+    def snapshot(self) -> dict:
+        """按模型汇总的当前统计，供进程内查看"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (h.count, h.sum) for key, h in self._histograms.items()}
+            models = {key[1] for key in counters if key[0] == "calls"}
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        result = {}
+        for model in sorted(models):
+            calls = {k[2:]: v for k, v in counters.items() if k[0] == "calls" and k[1] == model}
+            total_calls = sum(calls.values())
+            stats = {
+                "calls": total_calls,
+                "errors": sum(v for (source, status), v in calls.items() if status == "error"),
+                "cache_hits": sum(v for (source, status), v in calls.items() if source == "cache"),
+                "calls_per_minute": total_calls / elapsed * 60,
+                "prompt_tokens": counters.get(("tokens", model, "prompt"), 0),
+                "cached_tokens": counters.get(("tokens", model, "cached"), 0),
+                "completion_tokens": counters.get(("tokens", model, "completion"), 0),
+                "attempts": counters.get(("attempts", model), 0),
+                "retries": counters.get(("retries", model), 0),
+                "truncated": counters.get(("truncated", model), 0),
+                "json_tiers": {k[2]: v for k, v in counters.items() if k[0] == "json_tier" and k[1] == model},
+            }
+            for phase in ("total", "network", "parse", "first_token"):
+                count, total = histograms.get((model, phase), (0, 0.0))
+                stats[f"avg_{phase}_time"] = total / count if count else None
+            stats.update(self.latency_percentiles(model))
+            result[model] = stats
+        return result
+
+    def prometheus_text(self) -> str:
+        """Prometheus 文本格式导出"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h.counts), h.sum, h.count, h.buckets) for key, h in self._histograms.items()}
+        lines = [
+            "# HELP g1_llm_call_duration_seconds Latency of chat completion calls by phase.",
+            "# TYPE g1_llm_call_duration_seconds histogram",
+        ]
+        for (model, phase), (counts, total, count, buckets) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"g1_llm_call_duration_seconds_bucket{{{_labels(model=model, phase=phase, le=bound)}}} "
+                             f"{cumulative}")
+            lines.append(f"g1_llm_call_duration_seconds_sum{{{_labels(model=model, phase=phase)}}} {total}")
+            lines.append(f"g1_llm_call_duration_seconds_count{{{_labels(model=model, phase=phase)}}} {count}")
+        families = {
+            "calls": ("g1_llm_calls_total", "Chat completion calls.", ("source", "status")),
+            "tokens": ("g1_llm_tokens_total", "Tokens reported by the provider.", ("type",)),
+            "json_tier": ("g1_llm_json_tier_total", "JSON parse tier that produced the step.", ("tier",)),
+            "attempts": ("g1_llm_attempts_total", "HTTP requests actually sent, including retries.", ()),
+            "retries": ("g1_llm_retries_total", "Retried requests.", ()),
+            "truncated": ("g1_llm_truncated_total", "Responses cut off by max_tokens.", ()),
+        }
+        for kind, (name, help_text, label_names) in families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in sorted(counters.items()):
+                if key[0] != kind:
+                    continue
+                labels = dict(model=key[1], **dict(zip(label_names, key[2:])))
+                lines.append(f"{name}{{{_labels(**labels)}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: int, registry: MetricsRegistry = None, host: str = "0.0.0.0"):
+    """在后台线程中启动 /metrics HTTP 服务，同一进程内重复调用只会启动一次"""
+    global _server
+    registry = registry or metrics
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="g1-metrics", daemon=True).start()
+    return _server
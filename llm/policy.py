@@ -0,0 +1,209 @@
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MORE_STEPS_PROMPT = "Please continue your analysis with at least 5 more steps before providing the final answer."
+REFLECT_PROMPT = "Please perform a detailed self-reflection on your reasoning so far, considering potential biases and alternative viewpoints."
+CONTINUE_PROMPT = "Please continue with the next step in your analysis."
+
+
+def next_user_message(step_data, step_count, max_steps):
+    """根据当前步骤决定下一条用户消息，返回 None 表示推理结束"""
+    if step_data["next_action"] == "final_answer" and step_count < max_steps:
+        return MORE_STEPS_PROMPT
+    elif step_data["next_action"] == "final_answer":
+        logger.info("已达到最终答案或最大步骤数")
+        return None
+    elif step_data["next_action"] == 'reflect' or step_count % 3 == 0:
+        return REFLECT_PROMPT
+    else:
+        return CONTINUE_PROMPT
+
+
+class ChainState:
+    """一条推理链的进度，供步骤策略判断是否继续"""
+
+    def __init__(self, max_steps: int):
+        self.max_steps = max_steps
+        self.steps = []
+        self.tokens = 0
+        self.started_at = time.time()
+        self.stopped_by = None
+
+    @property
+    def step_count(self) -> int:
+        return len(self.steps)
+
+    @property
+    def last(self) -> dict:
+        return self.steps[-1]
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.started_at
+
+    def add(self, step_data: dict, tokens: int = 0):
+        self.steps.append(step_data)
+        self.tokens += tokens
+
+
+def _confidence(step_data: dict) -> float:
+    try:
+        return float(step_data.get("confidence", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class StepPolicy:
+    """
+    步骤策略：决定每一步之后是继续、反思还是进入最终答案。
+    子类实现 should_stop；默认接受模型给出的 final_answer，只在模型要求时反思，达到 max_steps 时停止。
+    同一个策略对象可以被多条推理链共享，calls_saved 累计相对旧策略（至少 max_steps 步）节省的调用次数。
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self.calls_saved = 0
+        self._lock = threading.Lock()
+
+    def should_stop(self, state: ChainState) -> bool:
+        return False
+
+    def next_message(self, state: ChainState):
+        step_data = state.last
+        if step_data.get("next_action") == "final_answer":
+            state.stopped_by = state.stopped_by or "model"
+            return None
+        if state.step_count >= state.max_steps:
+            state.stopped_by = state.stopped_by or "max_steps"
+            return None
+        if self.should_stop(state):
+            state.stopped_by = state.stopped_by or self.name
+            return None
+        if step_data.get("next_action") == "reflect":
+            return REFLECT_PROMPT
+        return CONTINUE_PROMPT
+
+    def finish(self, state: ChainState) -> int:
+        """推理链结束时调用，返回并累计节省的调用次数"""
+        saved = max(0, state.max_steps - state.step_count)
+        with self._lock:
+            self.calls_saved += saved
+        if saved:
+            logger.info(f"步骤策略 {self.name} 在第 {state.step_count} 步结束 ({state.stopped_by})，节省 {saved} 次调用")
+        return saved
+
+
+class LegacyPolicy(StepPolicy):
+    """原有行为：不足 max_steps 时拒绝最终答案，每 3 步强制反思"""
+
+    name = "legacy"
+
+    def next_message(self, state: ChainState):
+        message = next_user_message(state.last, state.step_count, state.max_steps)
+        if message is None:
+            state.stopped_by = "model"
+        return message
+
+
+class ConfidencePolicy(StepPolicy):
+    """至少 min_steps 步之后，置信度达到 threshold 即停止"""
+
+    name = "confidence"
+
+    def __init__(self, threshold: float = 0.9, min_steps: int = 2):
+        super().__init__()
+        self.threshold = threshold
+        self.min_steps = min_steps
+
+    def should_stop(self, state: ChainState) -> bool:
+        return state.step_count >= self.min_steps and _confidence(state.last) >= self.threshold
+
+
+class ConvergencePolicy(StepPolicy):
+    """连续 window 步的内容高度相似（词集合 Jaccard >= similarity），说明只是在重复同一个结论"""
+
+    name = "convergence"
+
+    def __init__(self, window: int = 2, similarity: float = 0.6):
+        super().__init__()
+        self.window = window
+        self.similarity = similarity
+
+    @staticmethod
+    def _tokens(step_data: dict) -> set:
+        return set(re.findall(r"\w+", str(step_data.get("content", "")).lower()))
+
+    def should_stop(self, state: ChainState) -> bool:
+        if state.step_count < self.window + 1:
+            return False
+        recent = [self._tokens(step) for step in state.steps[-(self.window + 1):]]
+        for a, b in zip(recent, recent[1:]):
+            union = a | b
+            if not union or len(a & b) / len(union) < self.similarity:
+                return False
+        return True
+
+
+class BudgetPolicy(StepPolicy):
+    """整条推理链的墙钟时间（秒）或 token 数超出预算时停止"""
+
+    name = "budget"
+
+    def __init__(self, max_seconds: float = None, max_tokens: int = None):
+        super().__init__()
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+
+    def should_stop(self, state: ChainState) -> bool:
+        if self.max_seconds is not None and state.elapsed >= self.max_seconds:
+            return True
+        return self.max_tokens is not None and state.tokens >= self.max_tokens
+
+
+class CompositePolicy(StepPolicy):
+    """任意一个子策略要求停止即停止"""
+
+    name = "adaptive"
+
+    def __init__(self, policies: list):
+        super().__init__()
+        self.policies = policies
+
+    def should_stop(self, state: ChainState) -> bool:
+        for policy in self.policies:
+            if policy.should_stop(state):
+                state.stopped_by = policy.name
+                return True
+        return False
+
+    def finish(self, state: ChainState) -> int:
+        saved = super().finish(state)
+        for policy in self.policies:
+            if policy.name == state.stopped_by:
+                with policy._lock:
+                    policy.calls_saved += saved
+        return saved
+
+
+POLICIES = ("legacy", "adaptive", "confidence", "convergence", "budget")
+
+
+def make_policy(name: str = "legacy", confidence: float = 0.9, max_seconds: float = None,
+                max_tokens: int = None) -> StepPolicy:
+    """按名称创建步骤策略，adaptive 为置信度、收敛与预算策略的组合"""
+    if name == "legacy":
+        return LegacyPolicy()
+    if name == "confidence":
+        return ConfidencePolicy(confidence)
+    if name == "convergence":
+        return ConvergencePolicy()
+    if name == "budget":
+        return BudgetPolicy(max_seconds, max_tokens)
+    if name == "adaptive":
+        return CompositePolicy([ConfidencePolicy(confidence), ConvergencePolicy(), BudgetPolicy(max_seconds, max_tokens)])
+    raise ValueError(f"unknown step policy: {name}")
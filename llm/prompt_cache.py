@@ -0,0 +1,60 @@
+import copy
+from typing import Dict
+
+# 服务端前缀缓存的标注方式，按模型名前缀匹配，靠前的规则优先：anthropic 需要在消息上标注 cache_control 断点；
+# 未匹配的模型为 auto，即 OpenAI、DeepSeek、Gemini 等自动缓存相同前缀的服务，无需标注
+DEFAULT_CACHE_STYLES = (
+    ("claude-", "anthropic"),
+    ("anthropic/", "anthropic"),
+    ("anthropic.claude", "anthropic"),
+)
+
+
+def cache_style(model: str, rules=DEFAULT_CACHE_STYLES) -> str:
+    for prefix, style in rules:
+        if model.startswith(prefix):
+            return style
+    return "auto"
+
+
+def _mark(message: dict) -> dict:
+    content = message.get("content")
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    elif isinstance(content, list) and content:
+        content = copy.deepcopy(content)
+    else:
+        return message
+    content[-1]["cache_control"] = {"type": "ephemeral"}
+    return dict(message, content=content)
+
+
+def with_cache_breakpoints(messages: list, style: str) -> list:
+    """
+    返回插入了缓存断点的消息副本，原 messages 不会被修改，推理链保存的历史因此在各步之间逐字节保持不变。
+    anthropic 方式在系统提示（所有推理链共享）和最后一条消息（本步的完整前缀，供下一步读取）上各标注一个断点，
+    其余方式原样返回
+    """
+    if style != "anthropic" or not messages:
+        return messages
+    marks = {len(messages) - 1}
+    if messages[0].get("role") == "system":
+        marks.add(0)
+    return [_mark(message) if i in marks else message for i, message in enumerate(messages)]
+
+
+def cached_prompt_tokens(usage) -> int:
+    """usage 中命中服务端前缀缓存的输入 token 数，兼容 OpenAI（prompt_tokens_details）和 Anthropic 的字段"""
+    if not usage:
+        return 0
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, "model_dump") else vars(usage)
+    details = usage.get("prompt_tokens_details") or {}
+    return details.get("cached_tokens") or usage.get("cache_read_input_tokens") or 0
+
+
+def prompt_cache_summary(step_stats) -> Dict[str, int]:
+    """汇总推理链各步的输入 token：cached 为命中前缀缓存的部分，uncached 为按原价计费的部分"""
+    prompt = sum(stats.get("prompt_tokens", 0) for stats in step_stats)
+    cached = sum(stats.get("cached_tokens", 0) for stats in step_stats)
+    return {"prompt_tokens": prompt, "cached_tokens": cached, "uncached_tokens": prompt - cached}
@@ -0,0 +1,290 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+# 当前调用所属的会话及排队位置回调，由 admission_session 设置
+_session = contextvars.ContextVar("g1_admission_session", default=(None, None))
+
+
+@contextmanager
+def admission_session(session_id: str, on_wait: Callable[[int, float], None] = None):
+    """
+    在此范围内发出的请求属于 session_id，RateLimiter 在各会话之间轮流放行。
+    on_wait(position, wait) 在排队位置变化时被调用，position 为前面还有多少个请求，wait 为预计等待秒数
+    """
+    token = _session.set((session_id, on_wait))
+    try:
+        yield
+    finally:
+        _session.reset(token)
+
+
+def api_key_id(api_key: str = None) -> str:
+    """桶按 API key 区分，只保留 key 的哈希前缀"""
+    if not api_key:
+        return "default"
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+class TokenBucket:
+    """
+    按分钟速率补充的令牌桶。reserve 会立即扣除令牌（允许为负数），并返回需要等待的秒数，
+    因此先预约的调用者总是先获得额度。
+    """
+
+    def __init__(self, per_minute: float, capacity: float = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float = None) -> float:
+        """不扣除令牌，返回 amount 个令牌可用前需要等待的秒数，超过容量的请求按容量计算"""
+        self._refill(now or time.monotonic())
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def reserve(self, amount: float, now: float = None) -> float:
+        self._refill(now or time.monotonic())
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def adjust(self, amount: float):
+        """归还（正数）或追加扣除（负数）令牌"""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class _FileState:
+    """
+    多进程共享的桶状态，保存在一个 JSON 文件中，读写时持有 fcntl 文件锁。
+    时间使用墙钟，各进程之间可以比较
+    """
+
+    def __init__(self, path: str):
+        import fcntl
+        self._fcntl = fcntl
+        self.path = path
+        self._lock_path = path + ".lock"
+
+    @contextmanager
+    def locked(self):
+        with open(self._lock_path, "a") as lock_file:
+            self._fcntl.flock(lock_file, self._fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path, encoding="utf-8") as f:
+                        state = json.load(f)
+                except (OSError, ValueError):
+                    state = {}
+                yield state
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(state, f)
+                os.replace(tmp, self.path)
+            finally:
+                self._fcntl.flock(lock_file, self._fcntl.LOCK_UN)
+
+
+class RateLimiter:
+    """
+    按 (API key, 模型) 分别限制每分钟请求数（rpm）和 token 数（tpm）。
+    limits 可以为单个模型覆盖默认值：{"gpt-4o": (500, 30000)}，值为 None 表示不限制。
+    acquire 在额度不足时排队，同一个桶的等待者按会话轮流放行（见 admission_session），
+    单个会话的大量并发请求不会饿死其他会话。path 不为空时桶的状态保存在该文件中，由同一台机器上的多个进程共享。
+    """
+
+    def __init__(self, rpm: float = None, tpm: float = None, limits: Dict[str, Tuple[float, float]] = None,
+                 path: str = None, poll_interval: float = 0.05):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.limits = limits or {}
+        self.poll_interval = poll_interval
+        self._buckets: Dict[str, Tuple[Optional[TokenBucket], Optional[TokenBucket]]] = {}
+        self._file = _FileState(path) if path else None
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        # 桶 -> 会话 -> 等待中的请求；会话的顺序即轮转顺序
+        self._queues: Dict[str, OrderedDict] = {}
+
+    @staticmethod
+    def _key(model: str, api_key: str = None) -> str:
+        return f"{api_key_id(api_key)}/{model}"
+
+    def _new_buckets(self, model: str):
+        rpm, tpm = self.limits.get(model, (self.rpm, self.tpm))
+        return TokenBucket(rpm) if rpm else None, TokenBucket(tpm) if tpm else None
+
+    @contextmanager
+    def _buckets_for(self, model: str, api_key: str = None):
+        """返回 ((请求桶, token 桶), now)，多进程模式下在文件锁内读取并写回桶的状态"""
+        key = self._key(model, api_key)
+        if self._file is None:
+            buckets = self._buckets.get(key)
+            if buckets is None:
+                buckets = self._buckets[key] = self._new_buckets(model)
+            yield buckets, time.monotonic()
+            return
+        with self._file.locked() as state:
+            now = time.time()
+            buckets = self._new_buckets(model)
+            for name, bucket in zip(("requests", "tokens"), buckets):
+                if bucket is None:
+                    continue
+                bucket.tokens, bucket.updated = state.get(f"{key}/{name}", (bucket.capacity, now))
+            yield buckets, now
+            for name, bucket in zip(("requests", "tokens"), buckets):
+                if bucket is not None:
+                    state[f"{key}/{name}"] = (bucket.tokens, bucket.updated)
+
+    def _wait_time(self, model: str, tokens: int, api_key: str) -> float:
+        with self._buckets_for(model, api_key) as ((requests_bucket, tokens_bucket), now):
+            wait = 0.0
+            if requests_bucket:
+                wait = max(wait, requests_bucket.wait_time(1, now))
+            if tokens_bucket:
+                wait = max(wait, tokens_bucket.wait_time(tokens, now))
+            return wait
+
+    def _reserve(self, model: str, tokens: int, api_key: str) -> float:
+        with self._buckets_for(model, api_key) as ((requests_bucket, tokens_bucket), now):
+            wait = 0.0
+            if requests_bucket:
+                wait = max(wait, requests_bucket.reserve(1, now))
+            if tokens_bucket:
+                wait = max(wait, tokens_bucket.reserve(tokens, now))
+            return wait
+
+    def wait_time(self, model: str, tokens: int = 0, api_key: str = None) -> float:
+        """不占用额度，返回一次请求和 tokens 个 token 可用前需要等待的秒数"""
+        with self._lock:
+            return self._wait_time(model, tokens, api_key)
+
+    def reserve(self, model: str, tokens: int = 0, api_key: str = None) -> float:
+        """不排队直接预约一次请求和 tokens 个 token，返回需要等待的秒数"""
+        with self._lock:
+            return self._reserve(model, tokens, api_key)
+
+    def settle(self, model: str, reserved: int, used: int, api_key: str = None):
+        """请求完成后用实际消耗的 token 数修正预约时的估算值"""
+        with self._lock:
+            with self._buckets_for(model, api_key) as ((_, tokens_bucket), _now):
+                if tokens_bucket:
+                    tokens_bucket.adjust(reserved - used)
+            self._cond.notify_all()
+
+    def queue_length(self, model: str = None, api_key: str = None) -> int:
+        with self._lock:
+            if model is not None:
+                queues = [self._queues.get(self._key(model, api_key), {})]
+            else:
+                queues = list(self._queues.values())
+            return sum(len(tickets) for queue in queues for tickets in queue.values())
+
+    def _enqueue(self, key: str, session, ticket):
+        queue = self._queues.setdefault(key, OrderedDict())
+        queue.setdefault(session, deque()).append(ticket)
+
+    def _dequeue(self, key: str, session, ticket):
+        queue = self._queues.get(key)
+        if not queue or session not in queue:
+            return
+        tickets = queue[session]
+        if ticket in tickets:
+            tickets.remove(ticket)
+        if not tickets:
+            del queue[session]
+        if not queue:
+            del self._queues[key]
+        self._cond.notify_all()
+
+    def _position(self, queue: OrderedDict, session, ticket) -> int:
+        """按轮转顺序计算排在 ticket 前面的请求数"""
+        index = queue[session].index(ticket)
+        position = index
+        before = True
+        for other, tickets in queue.items():
+            if other == session:
+                before = False
+                continue
+            position += min(len(tickets), index + 1 if before else index)
+        return position
+
+    def _try_admit(self, key: str, session, ticket, model: str, tokens: int, api_key: str):
+        """调用方持有 self._lock，返回 (是否放行, 建议等待秒数, 排队位置)"""
+        queue = self._queues[key]
+        head_session = next(iter(queue))
+        if head_session != session or queue[session][0] is not ticket:
+            return False, self.poll_interval, self._position(queue, session, ticket)
+        wait = self._wait_time(model, tokens, api_key)
+        if wait > 0:
+            return False, wait, 0
+        self._reserve(model, tokens, api_key)
+        queue[session].popleft()
+        if queue[session]:
+            queue.move_to_end(session)
+        else:
+            del queue[session]
+        if not queue:
+            del self._queues[key]
+        self._cond.notify_all()
+        return True, 0.0, 0
+
+    def acquire(self, model: str, tokens: int = 0, api_key: str = None):
+        session, on_wait = _session.get()
+        key = self._key(model, api_key)
+        ticket = object()
+        last_position = None
+        with self._cond:
+            self._enqueue(key, session, ticket)
+        try:
+            while True:
+                with self._cond:
+                    granted, wait, position = self._try_admit(key, session, ticket, model, tokens, api_key)
+                    if granted:
+                        return
+                    if on_wait is None or position == last_position:
+                        # 有请求被放行或额度被归还时会提前唤醒；多进程模式下其他进程的消耗只能靠超时重新检查
+                        self._cond.wait(wait if position == 0 else None if self._file is None else self.poll_interval)
+                        continue
+                # on_wait 可能渲染界面，在锁外调用，避免阻塞其他会话的放行；调用后重新检查而不是直接等待，不会错过唤醒
+                last_position = position
+                on_wait(position, wait)
+        except BaseException:
+            with self._cond:
+                self._dequeue(key, session, ticket)
+            raise
+
+    async def acquire_async(self, model: str, tokens: int = 0, api_key: str = None):
+        session, on_wait = _session.get()
+        key = self._key(model, api_key)
+        ticket = object()
+        last_position = None
+        with self._lock:
+            self._enqueue(key, session, ticket)
+        try:
+            while True:
+                with self._lock:
+                    granted, wait, position = self._try_admit(key, session, ticket, model, tokens, api_key)
+                if granted:
+                    return
+                if on_wait is not None and position != last_position:
+                    last_position = position
+                    on_wait(position, wait)
+                await asyncio.sleep(wait if position == 0 else self.poll_interval)
+        except BaseException:
+            with self._lock:
+                self._dequeue(key, session, ticket)
+            raise
@@ -0,0 +1,508 @@
+import json
+import logging
+import os
+import time
+
+from llm.V4 import Chatbot, AsyncChatbot, AppBaseModel
+from llm.context import ContextCompactor
+from llm.llm_tools import PartialJsonParser, estimate_tokens
+from llm.metrics import usage_scope
+from llm.policy import ChainState, StepPolicy, make_policy
+from llm.prompt_cache import prompt_cache_summary
+from llm.retry import Deadline
+from llm.semantic_cache import SemanticCache, SemanticMatch
+from llm.store import ChainStore
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = """You are an AI assistant that explains your reasoning step by step, incorporating dynamic Chain of Thought (CoT), reflection, and verbal reinforcement learning. Follow these instructions:
+
+1. Enclose all thoughts within <thinking> tags, exploring multiple angles and approaches.
+2. Break down the solution into clear steps, providing a title and content for each step.
+3. After each step, decide if you need another step or if you're ready to give the final answer.
+4. Continuously adjust your reasoning based on intermediate results and reflections, adapting your strategy as you progress.
+5. Regularly evaluate your progress, being critical and honest about your reasoning process.
+6. Assign a quality score between 0.0 and 1.0 to guide your approach:
+   - 0.8+: Continue current approach
+   - 0.5-0.7: Consider minor adjustments
+   - Below 0.5: Seriously consider backtracking and trying a different approach
+7. If unsure or if your score is low, backtrack and try a different approach, explaining your decision.
+8. For mathematical problems, show all work explicitly using LaTeX for formal notation and provide detailed proofs.
+9. Explore multiple solutions individually if possible, comparing approaches in your reflections.
+10. Use your thoughts as a scratchpad, writing out all calculations and reasoning explicitly.
+11. Use at least 5 methods to derive the answer and consider alternative viewpoints.
+12. Be aware of your limitations as an AI and what you can and cannot do.
+
+After every 3 steps, perform a detailed self-reflection on your reasoning so far, considering potential biases and alternative viewpoints.
+
+Respond in JSON format with 'title', 'content', 'next_action' (either 'continue', 'reflect', or 'final_answer'), and 'confidence' (a number between 0 and 1) keys.
+
+Example of a valid JSON response:
+```json
+{
+    "title": "Identifying Key Information",
+    "content": "To begin solving this problem, we need to carefully examine the given information and identify the crucial elements that will guide our solution process. This involves...",
+    "next_action": "continue",
+    "confidence": 0.8
+}```
+
+Your goal is to demonstrate a thorough, adaptive, and self-reflective problem-solving process, emphasizing dynamic thinking and learning from your own reasoning."""
+
+_client = None
+_async_client = None
+
+
+class StepResultModel(AppBaseModel):
+    title: str
+    content: str
+    next_action: str
+    confidence: float
+
+
+def default_client() -> Chatbot:
+    """根据环境变量创建进程内共享的 Chatbot"""
+    global _client
+    if _client is None:
+        _client = Chatbot(api_key=os.getenv('OPENAI_API_KEY'), api_url=os.getenv('OPENAI_API_BASE'))
+    return _client
+
+
+def default_async_client() -> AsyncChatbot:
+    """根据环境变量创建共享的 AsyncChatbot，所有并发的推理链复用同一个连接池，需在同一个事件循环中使用"""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncChatbot(api_key=os.getenv('OPENAI_API_KEY'), api_url=os.getenv('OPENAI_API_BASE'))
+    return _async_client
+
+
+def make_api_call_error(e, is_final_answer=False):
+    if is_final_answer:
+        logger.error("未能生成最终答案")
+        return {
+            "title": "错误",
+            "content": f"未能生成最终答案。错误: {str(e)}",
+        }
+    else:
+        logger.error("未能生成步骤")
+        return {
+            "title": "错误",
+            "content": f"未能生成步骤。错误: {str(e)}",
+            "next_action": "final_answer",
+        }
+
+
+def _step_request(messages, max_tokens, temperature, model, use_cache, deadline: Deadline):
+    """生成一个步骤的请求参数，各版本的 make_api_call 共用"""
+    return dict(model=model, prompt=messages, json_format=True, max_tokens=max_tokens, temperature=temperature,
+                response_model=StepResultModel, use_cache=use_cache, deadline=deadline)
+
+
+def _step_result(content, prompt_tokens, completion_tokens, usage: dict = None):
+    logger.info("API调用成功")
+    logger.info(content)
+    if usage is not None:
+        usage.update(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    return json.loads(content)
+
+
+def make_api_call(messages, max_tokens, temperature=0.5, is_final_answer=False, model="gpt-4o", client=None,
+                  use_cache=True, deadline: Deadline = None, usage: dict = None):
+    """
+    生成一个步骤。网络错误的重试、退避、截止时间和熔断统一由 client.retry 处理，这里不再叠加重试；
+    deadline 为整条推理链的截止时间，传入 usage 字典时会写入本次调用的 token 数，其中 cached_tokens 为命中服务端前缀缓存的部分
+    """
+    client = client or default_client()
+    try:
+        logger.info("尝试进行API调用")
+        with usage_scope({} if usage is None else usage):
+            content, prompt_tokens, completion_tokens, _ = client.ask(
+                **_step_request(messages, max_tokens, temperature, model, use_cache, deadline)
+            )
+        return _step_result(content, prompt_tokens, completion_tokens, usage)
+    except Exception as e:
+        logger.error(f"API调用失败。错误: {str(e)}")
+        return make_api_call_error(e, is_final_answer)
+
+
+async def make_api_call_async(messages, max_tokens, temperature=0.5, is_final_answer=False, model="gpt-4o",
+                              client=None, use_cache=True, deadline: Deadline = None, usage: dict = None):
+    """make_api_call 的异步版本"""
+    client = client or default_async_client()
+    try:
+        logger.info("尝试进行API调用")
+        with usage_scope({} if usage is None else usage):
+            content, prompt_tokens, completion_tokens, _ = await client.ask_async(
+                **_step_request(messages, max_tokens, temperature, model, use_cache, deadline)
+            )
+        return _step_result(content, prompt_tokens, completion_tokens, usage)
+    except Exception as e:
+        logger.error(f"API调用失败。错误: {str(e)}")
+        return make_api_call_error(e, is_final_answer)
+
+
+def make_api_call_stream(messages, max_tokens, temperature=0.5, is_final_answer=False, model="gpt-4o", client=None,
+                         use_cache=True, deadline: Deadline = None, usage: dict = None):
+    """
+    make_api_call 的流式版本，yield (step_data, done)。
+    done 为 False 时 step_data 是从未完成的 JSON 中解析出的部分字段，最后一次 yield 与 make_api_call 的返回值相同
+    """
+    client = client or default_client()
+    try:
+        logger.info("尝试进行流式API调用")
+        parser = PartialJsonParser()
+        content = None
+        with usage_scope({} if usage is None else usage):
+            for delta, result in client.ask_stream(
+                    **_step_request(messages, max_tokens, temperature, model, use_cache, deadline)
+            ):
+                if result is not None:
+                    content = result[0]
+                    if usage is not None:
+                        usage.update(prompt_tokens=result[1], completion_tokens=result[2])
+                elif delta:
+                    yield parser.feed(delta), False
+        logger.info("API调用成功")
+        logger.info(content)
+        step_data = json.loads(content)
+    except Exception as e:
+        logger.error(f"API调用失败。错误: {str(e)}")
+        step_data = make_api_call_error(e, is_final_answer)
+    yield step_data, True
+
+
+def call_step(messages, max_tokens, temperature=0.5, is_final_answer=False, model="gpt-4o", stream=False,
+              client=None, deadline: Deadline = None, usage: dict = None):
+    if not stream:
+        yield make_api_call(messages, max_tokens, temperature=temperature, is_final_answer=is_final_answer,
+                            model=model, client=client, deadline=deadline, usage=usage), True
+        return
+    yield from make_api_call_stream(messages, max_tokens, temperature=temperature, is_final_answer=is_final_answer,
+                                    model=model, client=client, deadline=deadline, usage=usage)
+
+
+SEED_PROMPT = """A very similar question was answered before.
+Previous question: {prompt}
+Previous final answer: {answer}
+Check whether this answer applies to the current question, correct it where the questions differ, and give the final answer as soon as you are confident."""
+
+
+def initial_messages(prompt, reference: SemanticMatch = None):
+    """reference 为语义缓存中相似问题的记录，其最终答案作为参考附在问题之后"""
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+    if reference is not None:
+        answer = reference.result["steps"][-1][1]
+        messages.append({"role": "user", "content": SEED_PROMPT.format(prompt=reference.prompt, answer=answer)})
+    return messages
+
+
+FINAL_ANSWER_PROMPT = "Please provide a comprehensive final answer based on your reasoning above, summarizing key points and addressing any uncertainties. USE JSON Formate"
+
+
+def prepare_messages(messages, compactor, step_count):
+    """按上下文预算压缩要发送的消息，返回 (messages, 本步统计)"""
+    saved = 0
+    if compactor is not None:
+        messages, saved = compactor.compact(messages)
+        if saved:
+            logger.info(f"第 {step_count} 步上下文压缩节省约 {saved} tokens")
+    return messages, {"context_tokens": estimate_tokens(messages), "context_tokens_saved": saved}
+
+
+def final_answer_content(final_data):
+    if 'content' in final_data:
+        return final_data["content"]
+    elif 'final_answer' in final_data:
+        return final_data["final_answer"]
+    else:
+        return json.dumps(final_data)
+
+
+def step_tokens(stats, step_data):
+    """本步消耗的 token 估算：请求上下文加上模型输出"""
+    return stats["context_tokens"] + estimate_tokens([{"role": "assistant", "content": json.dumps(step_data)}])
+
+
+def cached_note(stats):
+    """本步输入中命中服务端前缀缓存的 token 数，用于日志"""
+    if not stats.get("prompt_tokens"):
+        return ""
+    return f"，输入 {stats['prompt_tokens']} tokens（缓存命中 {stats.get('cached_tokens', 0)}）"
+
+
+def policy_summary(policy, state):
+    saved = policy.finish(state)
+    return {"name": policy.name, "stopped_by": state.stopped_by, "steps": state.step_count, "calls_saved": saved}
+
+
+def is_error_step(step_data):
+    return step_data.get("title") == "错误"
+
+
+class ChainCheckpoint:
+    """
+    把推理链的每一步写入 ChainStore，store 为 None 时不做任何事。
+    chain_id 已存在时从其最后一个完好的步骤继续（resume_from 指定时先截断到该步）；
+    出现错误步骤后链被标记为 failed，之后的步骤不再保存，下次可以从出错前的一步继续。
+    """
+
+    def __init__(self, store: ChainStore, prompt, model, params, chain_id=None, resume_from=None, reference=None):
+        self.store = store
+        self.chain_id = chain_id
+        self.messages = initial_messages(prompt, reference)
+        self.records = []
+        self.result = None
+        self.error = None
+        if store is None:
+            return
+        if chain_id is not None and store.get(chain_id) is not None:
+            if resume_from is not None:
+                store.truncate(chain_id, resume_from)
+            saved = store.load(chain_id)
+            self.messages, self.records, self.result = saved["messages"], saved["steps"], saved["result"]
+            logger.info(f"从第 {len(self.records)} 步恢复推理链 {chain_id}")
+        else:
+            self.chain_id = store.create(prompt, model, self.messages, params, chain_id=chain_id)
+
+    @property
+    def stopped(self) -> bool:
+        """保存的最后一步之后推理已经结束，只差最终答案"""
+        return bool(self.records) and self.records[-1]["stopped"]
+
+    def replay(self, state: ChainState):
+        """把已保存的步骤恢复到 state，返回 (steps, step_stats, total_thinking_time)"""
+        steps, step_stats, total_thinking_time = [], [], 0
+        for record in self.records:
+            steps.append((record["title"], record["content"], record["thinking_time"]))
+            step_stats.append(record["stats"])
+            state.add(record["step_data"], step_tokens(record["stats"], record["step_data"]))
+            total_thinking_time += record["thinking_time"]
+        return steps, step_stats, total_thinking_time
+
+    def save_step(self, step_count, step, step_data, messages, stats):
+        if self.store is None or self.error is not None:
+            return
+        if is_error_step(step_data):
+            self.error = step_data["content"]
+            self.store.finish(self.chain_id, "failed", error=self.error)
+            return
+        title, content, thinking_time = step
+        added = messages[-2:] if messages[-1]["role"] == "user" else messages[-1:]
+        self.store.append_step(self.chain_id, step_count, title, content, thinking_time, step_data, added, stats)
+
+    def finish(self, full_response, final_data):
+        if self.store is None:
+            return
+        full_response["chain_id"] = self.chain_id
+        if self.error is None and is_error_step(final_data):
+            self.error = final_data["content"]
+        if self.error is None:
+            self.store.finish(self.chain_id, "done", result=full_response)
+        else:
+            self.store.finish(self.chain_id, "failed", error=self.error)
+
+
+def semantic_lookup(semantic_cache: SemanticCache, prompt, model, store: ChainStore = None, chain_id=None):
+    """查找相似问题的推理链，继续 store 中已有的链时不查找"""
+    if semantic_cache is None:
+        return None
+    if store is not None and chain_id is not None and store.get(chain_id) is not None:
+        return None
+    match = semantic_cache.lookup(prompt, model)
+    if match is not None:
+        action = "直接返回保存的推理链" if match.kind == "hit" else "以其答案为参考生成较短的推理链"
+        logger.info(f"语义缓存命中（相似度 {match.similarity:.2f}）: {match.prompt}，{action}")
+    return match
+
+
+def semantic_info(match: SemanticMatch):
+    return {"kind": match.kind, "similarity": match.similarity, "prompt": match.prompt}
+
+
+def cached_response(match: SemanticMatch):
+    """把语义缓存命中的推理链转换为 generate_response 最后 yield 的内容"""
+    steps = [tuple(step) for step in match.result["steps"]]
+    full_response = dict(match.result, steps=steps, semantic_cache=semantic_info(match))
+    full_response.pop("chain_id", None)
+    return steps, full_response["total_thinking_time"], full_response
+
+
+def remember(semantic_cache: SemanticCache, prompt, model, full_response, final_data):
+    """把没有出错的推理链写入语义缓存"""
+    if semantic_cache is None or is_error_step(final_data):
+        return
+    if any(title == "错误" for title, _, _ in full_response["steps"]):
+        return
+    semantic_cache.put(prompt, model, full_response)
+
+
+class ChainRun:
+    """
+    一条推理链在各步之间的记账：语义缓存、断点续跑、上下文压缩、步骤策略和统计。
+    generate_response 与 agenerate_response 共用这部分逻辑，两者只负责请求模型。
+    result 不为 None 时不需要请求模型（语义缓存命中或链已完成），直接 yield 即可
+    """
+
+    def __init__(self, prompt, max_steps, temperature, model, context_budget, policy: StepPolicy,
+                 chain_timeout: float, store: ChainStore, chain_id, resume_from, semantic_cache: SemanticCache):
+        logger.info(f"正在为提示生成回答: {prompt}")
+        self.prompt = prompt
+        self.model = model
+        self.semantic_cache = semantic_cache
+        self.result = None
+        self.match = semantic_lookup(semantic_cache, prompt, model, store, chain_id)
+        if self.match is not None and self.match.kind == "hit":
+            self.result = cached_response(self.match)
+            return
+        if self.match is not None:
+            max_steps = min(max_steps, semantic_cache.seed_steps)
+        self.compactor = ContextCompactor(context_budget) if context_budget else None
+        self.policy = policy or make_policy("legacy")
+        self.state = ChainState(max_steps)
+        self.deadline = Deadline(chain_timeout)
+        params = {"max_steps": max_steps, "temperature": temperature, "context_budget": context_budget,
+                  "policy": self.policy.name}
+        self.checkpoint = ChainCheckpoint(store, prompt, model, params, chain_id, resume_from, reference=self.match)
+        if self.checkpoint.result is not None:
+            steps = [tuple(step) for step in self.checkpoint.result["steps"]]
+            self.result = steps, self.checkpoint.result["total_thinking_time"], dict(self.checkpoint.result,
+                                                                                     steps=steps)
+            return
+        self.messages = self.checkpoint.messages
+        self.steps, self.step_stats, self.total_thinking_time = self.checkpoint.replay(self.state)
+        self.step_count = len(self.steps) + 1
+        self.stopped = self.checkpoint.stopped
+        if self.stopped:
+            self.step_count -= 1
+        self.start_time = None
+        self.stats = None
+
+    def _begin(self, step_count):
+        self.start_time = time.time()
+        request_messages, self.stats = prepare_messages(self.messages, self.compactor, step_count)
+        self.step_stats.append(self.stats)
+        return request_messages, self.stats
+
+    def _thinking_time(self):
+        thinking_time = time.time() - self.start_time
+        self.total_thinking_time += thinking_time
+        return thinking_time
+
+    def begin_step(self):
+        """开始下一步，返回 (要发送的消息, 本步统计)，本步统计作为 usage 传给请求"""
+        logger.info(f"开始第 {self.step_count} 步")
+        return self._begin(self.step_count)
+
+    def partial(self, title, content):
+        """已完成的步骤加上正在生成的步骤，用于流式输出"""
+        return self.steps + [(title, content, time.time() - self.start_time)]
+
+    def end_step(self, step_data) -> bool:
+        """记录模型返回的步骤并由策略决定是否继续，返回 True 时还需要下一步"""
+        thinking_time = self._thinking_time()
+        logger.info(f"第 {self.step_count} 步完成。思考时间: {thinking_time:.2f} 秒{cached_note(self.stats)}")
+        self.steps.append((f"{step_data['title']}", step_data["content"], thinking_time))
+
+        self.messages.append({"role": "assistant", "content": json.dumps(step_data)})
+
+        self.state.add(step_data, step_tokens(self.stats, step_data))
+        user_message = self.policy.next_message(self.state)
+        if user_message is not None:
+            self.messages.append({"role": "user", "content": user_message})
+        self.checkpoint.save_step(self.step_count, self.steps[-1], step_data, self.messages, self.stats)
+        if user_message is None:
+            self.stopped = True
+            return False
+        self.step_count += 1
+        return True
+
+    def begin_final(self):
+        """开始生成最终答案，返回值与 begin_step 相同"""
+        self.messages.append({"role": "user", "content": FINAL_ANSWER_PROMPT})
+        return self._begin(self.step_count + 1)
+
+    def finish(self, final_data):
+        """记录最终答案，返回最后 yield 的 (steps, total_thinking_time, full_response)"""
+        thinking_time = self._thinking_time()
+        final_content = final_answer_content(final_data)
+        logger.info(f"最终答案已生成。思考时间: {thinking_time:.2f} 秒{cached_note(self.stats)}")
+        self.steps.append(("最终答案", final_content, thinking_time))
+
+        logger.info(f"总思考时间: {self.total_thinking_time:.2f} 秒")
+        total_saved = sum(stats["context_tokens_saved"] for stats in self.step_stats)
+        if total_saved:
+            logger.info(f"上下文压缩共节省约 {total_saved} tokens")
+        prompt_cache = prompt_cache_summary(self.step_stats)
+        if prompt_cache["cached_tokens"]:
+            logger.info(f"输入共 {prompt_cache['prompt_tokens']} tokens，其中 {prompt_cache['cached_tokens']} 命中服务端前缀缓存")
+        full_response = {"steps": self.steps, "total_thinking_time": self.total_thinking_time,
+                         "step_stats": self.step_stats, "policy": policy_summary(self.policy, self.state),
+                         "prompt_cache": prompt_cache}
+        if self.match is not None:
+            full_response["semantic_cache"] = semantic_info(self.match)
+        self.checkpoint.finish(full_response, final_data)
+        remember(self.semantic_cache, self.prompt, self.model, full_response, final_data)
+        return self.steps, self.total_thinking_time, full_response
+
+
+def generate_response(prompt, max_steps=5, temperature=0.5, model="gpt-4o", stream=False, client=None,
+                      context_budget=None, policy: StepPolicy = None, chain_timeout: float = None,
+                      store: ChainStore = None, chain_id: str = None, resume_from: int = None,
+                      semantic_cache: SemanticCache = None):
+    """
+    stream 为 True 时按 token 流式生成，生成过程中额外 yield 包含当前未完成步骤的 steps。
+    context_budget 为每次请求的上下文 token 预算，超出时较早的步骤会被压缩，None 表示不压缩。
+    policy 决定每一步之后是否继续，默认沿用旧策略（见 llm.policy.LegacyPolicy）。
+    chain_timeout 为整条推理链的硬性截止时间（秒），到期后的请求直接失败而不再重试。
+    传入 store 时每一步都会被保存；chain_id 已存在时从断点（或 resume_from 步）继续，已完成的链直接返回保存的结果。
+    传入 semantic_cache 时，相似问题的推理链直接返回，或以其答案为参考生成较短的推理链，
+    full_response["semantic_cache"] 记录匹配的问题和相似度
+    """
+    run = ChainRun(prompt, max_steps, temperature, model, context_budget, policy, chain_timeout, store, chain_id,
+                   resume_from, semantic_cache)
+    if run.result is not None:
+        yield run.result
+        return
+
+    while not run.stopped:
+        request_messages, stats = run.begin_step()
+        for step_data, done in call_step(request_messages, 4096, temperature=temperature, model=model, stream=stream,
+                                         client=client, deadline=run.deadline, usage=stats):
+            if not done:
+                yield run.partial(step_data.get("title", ""), step_data.get("content", "")), None, None
+        if run.end_step(step_data):
+            yield run.steps, None, None  # 我们现在yield三个值,但只有steps是有意义的
+
+    # 生成最终答案
+    request_messages, stats = run.begin_final()
+    for final_data, done in call_step(request_messages, 4096, temperature=temperature, is_final_answer=True,
+                                      model=model, stream=stream, client=client, deadline=run.deadline, usage=stats):
+        if not done:
+            yield run.partial("最终答案", final_data.get("content", final_data.get("final_answer", ""))), None, None
+    yield run.finish(final_data)
+
+
+async def agenerate_response(prompt, max_steps=5, temperature=0.5, model="gpt-4o", client=None, context_budget=None,
+                             policy: StepPolicy = None, chain_timeout: float = None, store: ChainStore = None,
+                             chain_id: str = None, resume_from: int = None, semantic_cache: SemanticCache = None):
+    """generate_response 的异步版本，yield 的内容与其相同，可以在一个事件循环中并发运行大量推理链"""
+    run = ChainRun(prompt, max_steps, temperature, model, context_budget, policy, chain_timeout, store, chain_id,
+                   resume_from, semantic_cache)
+    if run.result is not None:
+        yield run.result
+        return
+
+    while not run.stopped:
+        request_messages, stats = run.begin_step()
+        step_data = await make_api_call_async(request_messages, 4096, temperature=temperature, model=model,
+                                              client=client, deadline=run.deadline, usage=stats)
+        if run.end_step(step_data):
+            yield run.steps, None, None
+
+    # 生成最终答案
+    request_messages, stats = run.begin_final()
+    final_data = await make_api_call_async(request_messages, 4096, temperature=temperature, is_final_answer=True,
+                                           model=model, client=client, deadline=run.deadline, usage=stats)
+    yield run.finish(final_data)
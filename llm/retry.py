@@ -0,0 +1,338 @@
+import asyncio
+import contextvars
+import random
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+# 调用方放弃结果时被设置的事件，由 cancel_scope 设置
+_cancel_event = contextvars.ContextVar("g1_cancel_event", default=None)
+
+
+def transport_errors() -> tuple:
+    """
+    可重试的网络错误类型。只检查已经导入的 HTTP 库：没有导入的库不可能抛出异常，
+    因此本模块不必为此在启动时导入 requests / httpx / openai
+    """
+    errors = []
+    requests = sys.modules.get("requests")
+    if requests is not None:
+        errors += [requests.exceptions.ConnectionError, requests.exceptions.Timeout]
+    httpx = sys.modules.get("httpx")
+    if httpx is not None:
+        errors.append(httpx.TransportError)
+    openai = sys.modules.get("openai")
+    if openai is not None:
+        errors.append(openai.APIConnectionError)
+    return tuple(errors)
+
+
+class HTTPStatusError(Exception):
+    """接口返回非 200 状态码"""
+
+    def __init__(self, status_code: int, reason: str, text: str, headers=None):
+        super().__init__(f"{status_code} {reason} {text}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class CircuitOpenError(Exception):
+    """模型的熔断器处于打开状态，请求被直接拒绝"""
+
+
+class DeadlineExceeded(Exception):
+    """单步或整条推理链的截止时间已到"""
+
+
+class CallCancelled(Exception):
+    """调用方已经放弃结果（例如对冲落败），不再发出新的请求"""
+
+
+@contextmanager
+def cancel_scope(event: threading.Event):
+    """
+    在此范围内发出的同步调用在 event 被设置后停止：不再重试，退避等待立即结束。
+    已经发出的 HTTP 请求无法中断，其结果由调用方丢弃
+    """
+    token = _cancel_event.set(event)
+    try:
+        yield
+    finally:
+        _cancel_event.reset(token)
+
+
+def raise_if_cancelled(model: str):
+    event = _cancel_event.get()
+    if event is not None and event.is_set():
+        raise CallCancelled(f"call to {model} cancelled")
+
+
+class Deadline:
+    """基于单调时钟的截止时间，timeout 为 None 表示不限制"""
+
+    def __init__(self, timeout: float = None):
+        self.expires_at = time.monotonic() + timeout if timeout is not None else None
+
+    def remaining(self) -> Optional[float]:
+        if self.expires_at is None:
+            return None
+        return self.expires_at - time.monotonic()
+
+    @property
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    @staticmethod
+    def earliest(*deadlines) -> "Deadline":
+        deadlines = [d for d in deadlines if d is not None and d.expires_at is not None]
+        if not deadlines:
+            return Deadline()
+        return min(deadlines, key=lambda d: d.expires_at)
+
+
+def parse_retry_after(value) -> Optional[float]:
+    """Retry-After 可以是秒数，也可以是 HTTP 日期"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _causes(exc: BaseException):
+    """依次返回异常本身及其包装的原始异常（instructor 会把底层错误包在 InstructorRetryException 里）"""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        yield exc
+        inner = exc.__cause__ or exc.__context__
+        if inner is None and exc.args and isinstance(exc.args[0], BaseException):
+            inner = exc.args[0]
+        exc = inner
+
+
+class CircuitBreaker:
+    """
+    按模型统计最近 window 次请求的失败率，样本数不少于 min_calls 且失败率达到 failure_rate 时打开，
+    cooldown 秒内直接拒绝请求；之后放行一次探测请求，成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, window: int = 20, min_calls: int = 10, failure_rate: float = 0.5, cooldown: float = 30):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.cooldown = cooldown
+        self._outcomes = defaultdict(lambda: deque(maxlen=self.window))
+        self._opened_at = {}
+        self._probing = set()
+        self._lock = threading.Lock()
+
+    def state(self, model: str) -> str:
+        with self._lock:
+            if model not in self._opened_at:
+                return "closed"
+            if model in self._probing or time.monotonic() - self._opened_at[model] >= self.cooldown:
+                return "half_open"
+            return "open"
+
+    def admit(self, model: str):
+        """返回 (是否放行, 是否为探测请求)"""
+        with self._lock:
+            opened_at = self._opened_at.get(model)
+            if opened_at is None:
+                return True, False
+            if model in self._probing or time.monotonic() - opened_at < self.cooldown:
+                return False, False
+            self._probing.add(model)
+            return True, True
+
+    def allow(self, model: str) -> bool:
+        return self.admit(model)[0]
+
+    def release(self, model: str):
+        """探测请求被取消、没有结果时调用：结束探测但不改变状态，下一次 allow 会重新放行一次探测"""
+        with self._lock:
+            self._probing.discard(model)
+
+    def record(self, model: str, ok: bool):
+        with self._lock:
+            if model in self._probing:
+                self._probing.discard(model)
+                if ok:
+                    del self._opened_at[model]
+                    self._outcomes[model].clear()
+                else:
+                    self._opened_at[model] = time.monotonic()
+                return
+            outcomes = self._outcomes[model]
+            outcomes.append(ok)
+            failures = outcomes.count(False)
+            if len(outcomes) >= self.min_calls and failures / len(outcomes) >= self.failure_rate:
+                self._opened_at[model] = time.monotonic()
+
+
+class RetryPolicy:
+    """
+    所有调用路径共用的重试策略：只重试网络错误和 retry_status 中的状态码，
+    退避间隔为带完全抖动的指数退避，服务端给出 Retry-After 时以其为准。
+    每次 ask 的所有尝试受 step_timeout 限制，也不会超过调用方传入的推理链截止时间；
+    熔断器打开时直接失败，不再发出请求。
+    """
+
+    retry_status = (429, 500, 502, 503, 504, 529)
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 20,
+                 step_timeout: float = None, breaker: CircuitBreaker = None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.step_timeout = step_timeout
+        self.breaker = breaker or CircuitBreaker()
+        self._counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def _count(self, model: str, kind: str, amount: int = 1):
+        with self._lock:
+            self._counters[(model, kind)] += amount
+
+    def stats(self) -> dict:
+        """按模型统计：attempts 为实际发出的请求数，retries 为其中的重试次数"""
+        with self._lock:
+            counters = dict(self._counters)
+        result = defaultdict(dict)
+        for (model, kind), value in counters.items():
+            result[model][kind] = value
+        for model, stats in result.items():
+            stats["circuit"] = self.breaker.state(model)
+        return dict(result)
+
+    def classify(self, exc: BaseException):
+        """返回 (是否可重试, Retry-After 秒数)"""
+        errors = transport_errors()
+        for error in _causes(exc):
+            status = getattr(error, "status_code", None)
+            if status is not None:
+                headers = getattr(error, "headers", None)
+                if headers is None:
+                    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+                return status in self.retry_status, parse_retry_after(headers.get("retry-after"))
+            if isinstance(error, errors):
+                return True, None
+        return False, None
+
+    def backoff(self, attempt: int, retry_after: float = None) -> float:
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def step_deadline(self, deadline: Deadline = None) -> Deadline:
+        return Deadline.earliest(Deadline(self.step_timeout), deadline)
+
+    def attempt_timeout(self, deadline: Deadline, timeout: float = None) -> Optional[float]:
+        """单次请求的超时时间，不超过剩余的截止时间"""
+        remaining = deadline.remaining()
+        if remaining is None:
+            return timeout
+        if remaining <= 0:
+            raise DeadlineExceeded("deadline exceeded before request")
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def _before_attempt(self, model: str, deadline: Deadline) -> bool:
+        """放行时返回本次尝试是否为熔断器的探测请求"""
+        try:
+            raise_if_cancelled(model)
+        except CallCancelled:
+            self._count(model, "cancelled")
+            raise
+        if deadline.expired:
+            self._count(model, "deadline_exceeded")
+            raise DeadlineExceeded(f"deadline exceeded for {model}")
+        allowed, probe = self.breaker.admit(model)
+        if not allowed:
+            self._count(model, "short_circuited")
+            raise CircuitOpenError(f"circuit open for {model}, failing fast")
+        self._count(model, "attempts")
+        return probe
+
+    def _after_failure(self, model: str, attempt: int, exc: Exception, deadline: Deadline, probe: bool) -> float:
+        """记录失败并返回重试前的等待秒数，不应重试时重新抛出异常"""
+        if isinstance(exc, (DeadlineExceeded, CallCancelled)):
+            # 截止时间到了或调用被放弃（对冲落败）都不是服务端的结果，不计入熔断器；探测请求就此结束，下一次调用重新探测
+            if probe:
+                self.breaker.release(model)
+            raise exc
+        retryable, retry_after = self.classify(exc)
+        self.breaker.record(model, not retryable)
+        if not retryable:
+            raise exc
+        self._count(model, "failures")
+        if attempt + 1 >= self.max_attempts:
+            raise exc
+        delay = self.backoff(attempt, retry_after)
+        remaining = deadline.remaining()
+        if remaining is not None and delay >= remaining:
+            # 等不到下一次尝试，直接失败而不是白白睡到截止时间
+            self._count(model, "deadline_exceeded")
+            raise exc
+        self._count(model, "retries")
+        return delay
+
+    def call(self, model: str, fn, deadline: Deadline = None, call=None):
+        """fn(deadline) 执行一次请求；call 为 CallMetrics 时会累加实际尝试次数和重试次数"""
+        deadline = self.step_deadline(deadline)
+        for attempt in range(self.max_attempts):
+            probe = self._before_attempt(model, deadline)
+            if call is not None:
+                call.attempts += 1
+                call.retries += 1 if attempt else 0
+            try:
+                result = fn(deadline)
+            except Exception as e:
+                delay = self._after_failure(model, attempt, e, deadline, probe)
+                cancel = _cancel_event.get()
+                # 调用被放弃时提前结束等待，下一次尝试之前会抛出 CallCancelled
+                if cancel is not None:
+                    cancel.wait(delay)
+                else:
+                    time.sleep(delay)
+                continue
+            except BaseException:
+                # 被取消（对冲落败、客户端断开）的请求没有结果；探测请求被取消时结束探测，否则熔断器会一直停在半开状态
+                if probe:
+                    self.breaker.release(model)
+                raise
+            self.breaker.record(model, True)
+            return result
+
+    async def acall(self, model: str, fn, deadline: Deadline = None, call=None):
+        """call 的异步版本，fn(deadline) 返回 awaitable，退避等待不阻塞事件循环"""
+        deadline = self.step_deadline(deadline)
+        for attempt in range(self.max_attempts):
+            probe = self._before_attempt(model, deadline)
+            if call is not None:
+                call.attempts += 1
+                call.retries += 1 if attempt else 0
+            try:
+                result = await fn(deadline)
+            except Exception as e:
+                await asyncio.sleep(self._after_failure(model, attempt, e, deadline, probe))
+                continue
+            except BaseException:
+                if probe:
+                    self.breaker.release(model)
+                raise
+            self.breaker.record(model, True)
+            return result
+
+
+retry_policy = RetryPolicy()
@@ -0,0 +1,319 @@
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List
+
+from llm.retry import cancel_scope
+
+logger = logging.getLogger(__name__)
+
+
+def parse_fallbacks(values) -> Dict[str, List[str]]:
+    """解析 MODEL=FALLBACK1,FALLBACK2 形式的备用模型链，多条规则可以用分号或多次传入分隔"""
+    fallbacks = {}
+    for value in values or []:
+        for rule in value.split(";"):
+            if not rule.strip():
+                continue
+            model, _, chain = rule.partition("=")
+            fallbacks[model.strip()] = [m.strip() for m in chain.split(",") if m.strip()]
+    return fallbacks
+
+
+class _Leg:
+    """一次路由中发往某个模型的请求"""
+
+    def __init__(self, model: str, hedge: bool = False):
+        self.model = model
+        self.hedge = hedge
+        self.started = time.monotonic()
+        self.stopped = threading.Event()
+
+
+class Router:
+    """
+    包装 Chatbot / AsyncChatbot，接口与被包装的客户端一致，可以直接作为 client 传给推理函数。
+
+    - 按模型统计最近 error_window 秒内的错误率，错误率达到 max_error_rate 或熔断器打开的模型视为不可用，
+      请求直接交给 fallbacks 中配置的下一个可用模型；
+    - 主请求的耗时超过该模型最近的 p95（流式请求为首 token 的 p95）仍未返回时，向备用链中的下一个模型发出对冲请求，
+      先成功的结果被采用，另一个请求被取消；
+    - 分位数取自 client.metrics，样本数不足 min_samples 时不对冲。
+
+    同步的非流式请求无法中断正在进行的 HTTP 调用：落败的请求不再重试、不再排队申请额度，
+    已经发出的请求在后台完成，结果被丢弃；流式请求在收到下一个数据块时关闭连接，异步请求直接取消。
+    线程池只用于非流式请求，流式请求的读取线程单独创建，长时间的流不会占满线程池而让对冲请求排队。
+    """
+
+    def __init__(self, client, fallbacks: Dict[str, List[str]] = None, hedge: bool = True, min_samples: int = 20,
+                 min_hedge_delay: float = 0.5, max_error_rate: float = 0.5, error_window: float = 60,
+                 max_workers: int = 32):
+        self.client = client
+        self.fallbacks = fallbacks or {}
+        self.hedge = hedge
+        self.min_samples = min_samples
+        self.min_hedge_delay = min_hedge_delay
+        self.max_error_rate = max_error_rate
+        self.error_window = error_window
+        self._outcomes = defaultdict(lambda: deque(maxlen=1000))
+        self._counters = defaultdict(int)
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="g1-router")
+
+    def __getattr__(self, name):
+        # retry、metrics、close 等属性直接使用被包装的客户端
+        return getattr(self.client, name)
+
+    def _count(self, model: str, kind: str):
+        with self._lock:
+            self._counters[(model, kind)] += 1
+
+    def _record(self, model: str, ok: bool):
+        with self._lock:
+            self._outcomes[model].append((time.monotonic(), ok))
+
+    def error_rate(self, model: str):
+        """最近 error_window 秒内的错误率，样本不足 min_samples 时返回 None"""
+        since = time.monotonic() - self.error_window
+        with self._lock:
+            recent = [ok for at, ok in self._outcomes.get(model, ()) if at >= since]
+        if len(recent) < self.min_samples:
+            return None
+        return recent.count(False) / len(recent)
+
+    def is_down(self, model: str) -> bool:
+        breaker = getattr(getattr(self.client, "retry", None), "breaker", None)
+        if breaker is not None and breaker.state(model) == "open":
+            return True
+        error_rate = self.error_rate(model)
+        return error_rate is not None and error_rate >= self.max_error_rate
+
+    def candidates(self, model: str) -> List[str]:
+        """model 及其备用链中当前可用的模型，全部不可用时仍然尝试 model 本身"""
+        chain = [model] + [m for m in self.fallbacks.get(model, []) if m != model]
+        available = [m for m in chain if not self.is_down(m)]
+        if available and available[0] != model:
+            logger.warning(f"模型 {model} 不可用，改用 {available[0]}")
+            self._count(model, "failovers")
+        return available or [model]
+
+    def hedge_delay(self, model: str, stream: bool = False):
+        """发出对冲请求前等待的秒数，None 表示不对冲"""
+        if not self.hedge:
+            return None
+        percentiles = self.client.metrics.latency_percentiles(model, first_token=stream)
+        if percentiles["samples"] < self.min_samples:
+            return None
+        return max(self.min_hedge_delay, percentiles["p95"])
+
+    def stats(self) -> dict:
+        """按模型统计：p50/p95 延迟、错误率、对冲次数（hedges）与对冲胜出次数（hedge_wins）、故障转移次数"""
+        with self._lock:
+            counters = dict(self._counters)
+            models = set(self._outcomes) | {model for model, _ in counters}
+        result = {}
+        for model in sorted(models):
+            stats = {kind: value for (m, kind), value in counters.items() if m == model}
+            percentiles = self.client.metrics.latency_percentiles(model)
+            stats.update(p50=percentiles["p50"], p95=percentiles["p95"], error_rate=self.error_rate(model),
+                         down=self.is_down(model))
+            result[model] = stats
+        return result
+
+    def _start(self, model: str, primary: str = None) -> _Leg:
+        leg = _Leg(model, hedge=primary is not None)
+        if primary is not None:
+            logger.info(f"模型 {primary} 超过 p95 仍未返回，向 {model} 发出对冲请求")
+            self._count(primary, "hedges")
+        return leg
+
+    def _finish(self, leg: _Leg, primary: str, error: Exception = None):
+        self._record(leg.model, error is None)
+        if error is not None:
+            logger.warning(f"模型 {leg.model} 请求失败: {error}")
+        elif leg.hedge:
+            self._count(primary, "hedge_wins")
+
+    def _route(self, model: str, fn, stream: bool = False):
+        """按备用链依次尝试 fn(model)，每一轮最多对冲一次，返回第一个成功的结果"""
+        order = self.candidates(model)
+        error = None
+        while order:
+            primary = order.pop(0)
+            leg = self._start(primary)
+            # 线程池中的调用沿用当前上下文（例如限流器的排队会话）
+            futures = {self._submit(fn, leg): leg}
+            delay = self.hedge_delay(primary, stream) if order else None
+            try:
+                while futures:
+                    timeout = None
+                    if delay is not None:
+                        timeout = max(0.0, leg.started + delay - time.monotonic())
+                    done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                    if not done:
+                        hedge = self._start(order.pop(0), primary)
+                        futures[self._submit(fn, hedge)] = hedge
+                        delay = None
+                        continue
+                    for future in done:
+                        finished = futures.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            self._finish(finished, primary, e)
+                            error = e
+                            continue
+                        self._finish(finished, primary)
+                        return result
+            finally:
+                # 通知落败的请求停止：还在队列中的直接取消，正在执行的不再重试
+                for loser, loser_leg in futures.items():
+                    loser.cancel()
+                    loser_leg.stopped.set()
+            if order:
+                self._count(primary, "failovers")
+        raise error
+
+    def _submit(self, fn, leg: _Leg):
+        """在线程池中执行 fn(leg.model)，沿用当前上下文（例如限流器的排队会话），leg.stopped 被设置后调用停止重试"""
+        def run():
+            with cancel_scope(leg.stopped):
+                return fn(leg.model)
+
+        return self._pool.submit(contextvars.copy_context().run, run)
+
+    def ask(self, model: str, prompt, system_prompt: str = None, json_format: bool = False, **kwargs):
+        return self._route(model, lambda m: self.client.ask(m, prompt, system_prompt, json_format, **kwargs))
+
+    def ask_n(self, model: str, prompt, n: int, system_prompt: str = None, json_format: bool = False, **kwargs):
+        return self._route(model, lambda m: self.client.ask_n(m, prompt, n, system_prompt, json_format, **kwargs))
+
+    def _pump(self, leg: _Leg, stream, events: queue.Queue):
+        """在线程中读取一路流式响应并放入 events，leg.stopped 被设置后关闭流（连同底层连接）"""
+        try:
+            with cancel_scope(leg.stopped):
+                for item in stream:
+                    if leg.stopped.is_set():
+                        break
+                    events.put((leg, item, None))
+        except Exception as e:
+            events.put((leg, None, e))
+        else:
+            events.put((leg, None, None))
+        finally:
+            stream.close()
+
+    def ask_stream(self, model: str, prompt, system_prompt: str = None, json_format: bool = False, **kwargs):
+        """
+        ask_stream 的路由版本：在收到第一个数据块之前可以对冲和故障转移，
+        最先输出数据的模型胜出，其余请求被关闭；开始输出之后的错误直接抛出
+        """
+        order = self.candidates(model)
+        error = None
+        while order:
+            primary = order.pop(0)
+            events = queue.Queue()
+            legs = []
+
+            def start(leg):
+                legs.append(leg)
+                stream = self.client.ask_stream(leg.model, prompt, system_prompt, json_format, **kwargs)
+                # 每一路流使用单独的线程读取，流的持续时间不可预期，不占用非流式请求的线程池
+                threading.Thread(target=contextvars.copy_context().run, args=(self._pump, leg, stream, events),
+                                 name=f"g1-router-stream-{leg.model}", daemon=True).start()
+
+            start(self._start(primary))
+            delay = self.hedge_delay(primary, stream=True) if order else None
+            running = 1
+            winner = None
+            try:
+                while winner is None and running:
+                    timeout = None
+                    if delay is not None:
+                        timeout = max(0.0, legs[0].started + delay - time.monotonic())
+                    try:
+                        leg, item, e = events.get(timeout=timeout)
+                    except queue.Empty:
+                        start(self._start(order.pop(0), primary))
+                        running += 1
+                        delay = None
+                        continue
+                    if item is not None:
+                        winner = leg
+                        for other in legs:
+                            if other is not leg:
+                                other.stopped.set()
+                        yield item
+                        continue
+                    running -= 1
+                    error = e or RuntimeError(f"empty stream from {leg.model}")
+                    self._finish(leg, primary, error)
+                if winner is None:
+                    if order:
+                        self._count(primary, "failovers")
+                    continue
+                while True:
+                    leg, item, e = events.get()
+                    if leg is not winner:
+                        continue
+                    if item is not None:
+                        yield item
+                        continue
+                    self._finish(winner, primary, e)
+                    if e is not None:
+                        raise e
+                    return
+            finally:
+                for leg in legs:
+                    leg.stopped.set()
+        raise error
+
+    async def _aroute(self, model: str, fn, stream: bool = False):
+        """_route 的异步版本，落败的请求被直接取消"""
+        order = self.candidates(model)
+        error = None
+        while order:
+            primary = order.pop(0)
+            leg = self._start(primary)
+            tasks = {asyncio.ensure_future(fn(primary)): leg}
+            delay = self.hedge_delay(primary, stream) if order else None
+            try:
+                while tasks:
+                    timeout = None
+                    if delay is not None:
+                        timeout = max(0.0, leg.started + delay - time.monotonic())
+                    done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                    if not done:
+                        hedge = self._start(order.pop(0), primary)
+                        tasks[asyncio.ensure_future(fn(hedge.model))] = hedge
+                        delay = None
+                        continue
+                    for task in done:
+                        finished = tasks.pop(task)
+                        if task.exception() is not None:
+                            self._finish(finished, primary, task.exception())
+                            error = task.exception()
+                            continue
+                        self._finish(finished, primary)
+                        return task.result()
+            finally:
+                for task in tasks:
+                    task.cancel()
+            if order:
+                self._count(primary, "failovers")
+        raise error
+
+    async def ask_async(self, model: str, prompt, system_prompt: str = None, json_format: bool = False, **kwargs):
+        return await self._aroute(
+            model, lambda m: self.client.ask_async(m, prompt, system_prompt, json_format, **kwargs)
+        )
+
+    def close(self):
+        """关闭线程池和被包装的客户端，包装 AsyncChatbot 时返回需要 await 的协程"""
+        self._pool.shutdown(wait=False)
+        return self.client.close()
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, defaultdict
+from typing import NamedTuple, Optional
+
+# MinHash 使用的 (a * x + b) mod p 哈希族，p 为梅森素数 2^61 - 1
+_PRIME = (1 << 61) - 1
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+_SPACES = re.compile(r"\s+")
+_TRAILING = re.compile(r"[\s?？!！。.,，;；:：]+$")
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """全角转半角、转小写、合并空白并去掉结尾的标点"""
+    text = unicodedata.normalize("NFKC", prompt).lower()
+    text = _SPACES.sub(" ", text).strip()
+    return _TRAILING.sub("", text)
+
+
+def wording(text: str) -> str:
+    """去掉空白和标点后的归一化问题，直接返回保存的推理链要求措辞完全相同"""
+    return _NON_WORD.sub("", text)
+
+
+def shingles(text: str, size: int = 3) -> frozenset:
+    """去掉空白后的字符 n-gram，不需要分词，中英文混合的问题同样适用，"1.11和1.3" 与 "1.11 和 1.3" 相同"""
+    text = _SPACES.sub("", text)
+    if len(text) <= size:
+        return frozenset([text])
+    return frozenset(text[i:i + size] for i in range(len(text) - size + 1))
+
+
+def _shingle_hash(shingle: str) -> int:
+    return int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class SemanticMatch(NamedTuple):
+    kind: str  # "hit" 直接返回保存的推理链，"seed" 以保存的答案为参考生成较短的推理链
+    similarity: float
+    prompt: str
+    result: dict
+
+
+class SemanticCache:
+    """
+    按问题相似度查找以前的推理链，不依赖外部服务：问题归一化后取字符 n-gram，用 MinHash + LSH 找候选，
+    再用 n-gram 集合的 Jaccard 相似度确认。相似度不低于 threshold、且去掉大小写、空白和标点后措辞完全相同时
+    直接返回保存的推理链；其余相似度不低于 seed_threshold 的问题只返回保存的答案作为新推理链的参考，新链最多 seed_steps 步。
+    n-gram 相似度分不清意思相反的问题（"哪个大" 与 "哪个不大"），因此相似但措辞不同的问题不会直接命中。
+
+    问题中的数字必须完全一致才算匹配，"1.11 和 1.3 哪个大" 不会命中 "1.11 和 1.5 哪个大" 的答案。
+    条目按模型区分，超过 max_entries 时淘汰最久未使用的条目；path 不为空时条目保存在 SQLite 中，重启后重建索引。
+    """
+
+    def __init__(self, threshold: float = 0.85, seed_threshold: float = 0.6, max_entries: int = 1000,
+                 ttl: float = None, path: str = None, seed_steps: int = 2, num_perm: int = 64, bands: int = 32,
+                 ngram: int = 3):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.seed_threshold = min(seed_threshold, threshold)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.seed_steps = seed_steps
+        self.ngram = ngram
+        self.bands = bands
+        self._rows = num_perm // bands
+        # 固定种子生成的哈希参数，签名在进程之间保持一致
+        seeds = [hashlib.blake2b(f"g1-minhash-{i}".encode(), digest_size=16).digest() for i in range(num_perm)]
+        self._perms = [(int.from_bytes(s[:8], "big") % (_PRIME - 1) + 1, int.from_bytes(s[8:], "big") % _PRIME)
+                       for s in seeds]
+        self._entries: OrderedDict = OrderedDict()
+        self._index = defaultdict(set)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "seeds": 0, "misses": 0, "puts": 0, "evictions": 0}
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS semantic_cache (key TEXT PRIMARY KEY, model TEXT NOT NULL, "
+                "prompt TEXT NOT NULL, result TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.commit()
+            self._load()
+
+    def _signature(self, grams: frozenset) -> tuple:
+        hashes = [_shingle_hash(gram) for gram in grams]
+        return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in self._perms)
+
+    def _band_keys(self, model: str, numbers: tuple, signature: tuple):
+        for band in range(self.bands):
+            yield model, numbers, band, signature[band * self._rows:(band + 1) * self._rows]
+
+    def _features(self, prompt: str):
+        text = normalize_prompt(prompt)
+        grams = shingles(text, self.ngram)
+        return text, tuple(_NUMBER.findall(text)), grams, self._signature(grams), wording(text)
+
+    @staticmethod
+    def _key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl is not None and now - created > self.ttl
+
+    def _add(self, key, model, prompt, result, created, features):
+        """调用方持有 self._lock，返回被淘汰的 key"""
+        if key in self._entries:
+            self._remove(key)
+        _, numbers, grams, signature, words = features
+        self._entries[key] = {"model": model, "prompt": prompt, "result": result, "created": created,
+                              "numbers": numbers, "grams": grams, "signature": signature, "wording": words}
+        for band_key in self._band_keys(model, numbers, signature):
+            self._index[band_key].add(key)
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            evicted.append(next(iter(self._entries)))
+            self._remove(evicted[-1])
+            self._stats["evictions"] += 1
+        return evicted
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        for band_key in self._band_keys(entry["model"], entry["numbers"], entry["signature"]):
+            bucket = self._index[band_key]
+            bucket.discard(key)
+            if not bucket:
+                del self._index[band_key]
+
+    def _load(self):
+        now = time.time()
+        rows = self._db.execute(
+            "SELECT key, model, prompt, result, created FROM semantic_cache ORDER BY created DESC LIMIT ?",
+            (self.max_entries,),
+        ).fetchall()
+        for key, model, prompt, result, created in reversed(rows):
+            if not self._expired(created, now):
+                self._add(key, model, prompt, json.loads(result), created, self._features(prompt))
+
+    def lookup(self, prompt: str, model: str) -> Optional[SemanticMatch]:
+        """返回最相似的条目，相似度低于 seed_threshold 时返回 None"""
+        _, numbers, grams, signature, words = self._features(prompt)
+        now = time.time()
+        with self._lock:
+            candidates = set()
+            for band_key in self._band_keys(model, numbers, signature):
+                candidates |= self._index.get(band_key, set())
+            best, best_similarity = None, 0.0
+            for key in candidates:
+                entry = self._entries[key]
+                if self._expired(entry["created"], now):
+                    continue
+                similarity = len(grams & entry["grams"]) / len(grams | entry["grams"])
+                if similarity > best_similarity:
+                    best, best_similarity = key, similarity
+            if best is None or best_similarity < self.seed_threshold:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(best)
+            entry = self._entries[best]
+            kind = "hit" if best_similarity >= self.threshold and entry["wording"] == words else "seed"
+            self._stats[f"{kind}s"] += 1
+            return SemanticMatch(kind, best_similarity, entry["prompt"], entry["result"])
+
+    def put(self, prompt: str, model: str, result: dict):
+        """保存一条完成的推理链，result 为 generate_response 最后返回的 full_response"""
+        features = self._features(prompt)
+        key = self._key(model, features[0])
+        now = time.time()
+        result = json.loads(json.dumps(result, ensure_ascii=False, default=str))
+        with self._lock:
+            evicted = self._add(key, model, prompt, result, now, features)
+            self._stats["puts"] += 1
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO semantic_cache (key, model, prompt, result, created) VALUES (?, ?, ?, ?, ?)",
+                (key, model, prompt, json.dumps(result, ensure_ascii=False), now),
+            )
+            self._db.executemany("DELETE FROM semantic_cache WHERE key = ?", [(k,) for k in evicted])
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["seeds"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["seed_rate"] = stats["seeds"] / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM semantic_cache")
+                self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
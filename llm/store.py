@@ -0,0 +1,212 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chains (
+    id TEXT PRIMARY KEY,
+    prompt TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    model TEXT NOT NULL,
+    params TEXT NOT NULL,
+    messages TEXT NOT NULL,
+    status TEXT NOT NULL,
+    parent_id TEXT,
+    parent_step INTEGER,
+    steps INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    result TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chains_prompt_hash ON chains (prompt_hash);
+CREATE INDEX IF NOT EXISTS chains_model_updated ON chains (model, updated);
+CREATE INDEX IF NOT EXISTS chains_updated ON chains (updated);
+CREATE TABLE IF NOT EXISTS chain_steps (
+    chain_id TEXT NOT NULL,
+    step INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    content TEXT NOT NULL,
+    thinking_time REAL NOT NULL,
+    step_data TEXT NOT NULL,
+    messages TEXT NOT NULL,
+    stats TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (chain_id, step)
+);
+"""
+
+_CHAIN_COLUMNS = ("id", "prompt", "prompt_hash", "model", "params", "status", "parent_id", "parent_step", "steps",
+                  "error", "created", "updated")
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class ChainStore:
+    """
+    推理链的持久化存储（SQLite），每完成一步立即写入，进程重启或调用失败后可以从最后一个完好的步骤继续。
+    每步保存本步新增的消息（assistant 回复和随后的 user 提示），与链的初始消息拼接即可还原任意一步时完整的 messages。
+    status 为 running / done / failed；链可以截断到第 k 步后继续（truncate），也可以从第 k 步分叉出新链（branch）。
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        if path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def create(self, prompt: str, model: str, messages: list, params: dict = None, chain_id: str = None,
+               parent_id: str = None, parent_step: int = None) -> str:
+        chain_id = chain_id or uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO chains (id, prompt, prompt_hash, model, params, messages, status, parent_id, parent_step,"
+                " created, updated) VALUES (?, ?, ?, ?, ?, ?, 'running', ?, ?, ?, ?)",
+                (chain_id, prompt, prompt_hash(prompt), model, json.dumps(params or {}, ensure_ascii=False),
+                 json.dumps(messages, ensure_ascii=False), parent_id, parent_step, now, now),
+            )
+            self._db.commit()
+        return chain_id
+
+    def append_step(self, chain_id: str, step: int, title: str, content: str, thinking_time: float, step_data: dict,
+                    messages: list, stats: dict = None):
+        """保存第 step 步，messages 为本步新增的消息"""
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO chain_steps (chain_id, step, title, content, thinking_time, step_data, messages,"
+                " stats, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (chain_id, step, title, content, thinking_time, json.dumps(step_data, ensure_ascii=False),
+                 json.dumps(messages, ensure_ascii=False), json.dumps(stats or {}), now),
+            )
+            self._db.execute("UPDATE chains SET steps = ?, status = 'running', updated = ? WHERE id = ?",
+                             (step, now, chain_id))
+            self._db.commit()
+
+    def finish(self, chain_id: str, status: str = "done", result: dict = None, error: str = None):
+        with self._lock:
+            self._db.execute(
+                "UPDATE chains SET status = ?, result = ?, error = ?, updated = ? WHERE id = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, time.time(),
+                 chain_id),
+            )
+            self._db.commit()
+
+    def get(self, chain_id: str) -> Optional[dict]:
+        """链的摘要信息，不包含步骤"""
+        with self._lock:
+            row = self._db.execute(f"SELECT {', '.join(_CHAIN_COLUMNS)} FROM chains WHERE id = ?",
+                                   (chain_id,)).fetchone()
+        return self._chain(row) if row else None
+
+    @staticmethod
+    def _chain(row) -> dict:
+        chain = dict(row)
+        chain["params"] = json.loads(chain["params"])
+        return chain
+
+    def load(self, chain_id: str, upto: int = None) -> Optional[dict]:
+        """
+        读取链及其前 upto 步（默认全部），返回的 messages 为第 upto 步完成时的完整消息列表，可直接继续请求。
+        每个步骤的 stopped 为 True 表示该步之后推理已结束，接下来只需要生成最终答案
+        """
+        with self._lock:
+            row = self._db.execute("SELECT * FROM chains WHERE id = ?", (chain_id,)).fetchone()
+            if row is None:
+                return None
+            rows = self._db.execute(
+                "SELECT step, title, content, thinking_time, step_data, messages, stats FROM chain_steps"
+                " WHERE chain_id = ? AND step <= ? ORDER BY step",
+                (chain_id, upto if upto is not None else row["steps"]),
+            ).fetchall()
+        chain = self._chain({key: row[key] for key in _CHAIN_COLUMNS})
+        messages = json.loads(row["messages"])
+        steps = []
+        for step in rows:
+            delta = json.loads(step["messages"])
+            messages.extend(delta)
+            steps.append({
+                "step": step["step"],
+                "title": step["title"],
+                "content": step["content"],
+                "thinking_time": step["thinking_time"],
+                "step_data": json.loads(step["step_data"]),
+                "stats": json.loads(step["stats"]),
+                "stopped": not delta or delta[-1]["role"] != "user",
+            })
+        chain["steps"] = steps
+        chain["messages"] = messages
+        chain["result"] = json.loads(row["result"]) if row["result"] and upto is None else None
+        return chain
+
+    def truncate(self, chain_id: str, step: int):
+        """丢弃第 step 步之后的内容，之后可以从第 step 步继续"""
+        with self._lock:
+            self._db.execute("DELETE FROM chain_steps WHERE chain_id = ? AND step > ?", (chain_id, step))
+            self._db.execute(
+                "UPDATE chains SET steps = MIN(steps, ?), status = 'running', result = NULL, error = NULL, updated = ?"
+                " WHERE id = ?", (step, time.time(), chain_id))
+            self._db.commit()
+
+    def branch(self, chain_id: str, step: int, chain_id_new: str = None) -> str:
+        """复制链的前 step 步为一条新链，原链不受影响"""
+        chain_id_new = chain_id_new or uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO chains (id, prompt, prompt_hash, model, params, messages, status, parent_id, parent_step,"
+                " steps, created, updated) SELECT ?, prompt, prompt_hash, model, params, messages, 'running', id, ?,"
+                " MIN(steps, ?), ?, ? FROM chains WHERE id = ?",
+                (chain_id_new, step, step, now, now, chain_id),
+            )
+            self._db.execute(
+                "INSERT INTO chain_steps (chain_id, step, title, content, thinking_time, step_data, messages, stats,"
+                " created) SELECT ?, step, title, content, thinking_time, step_data, messages, stats, created"
+                " FROM chain_steps WHERE chain_id = ? AND step <= ?",
+                (chain_id_new, chain_id, step),
+            )
+            self._db.commit()
+        return chain_id_new
+
+    def list_chains(self, model: str = None, prompt: str = None, status: str = None, limit: int = 50,
+                    offset: int = 0) -> list:
+        """按更新时间倒序列出链的摘要，prompt 按内容哈希精确匹配"""
+        conditions, args = [], []
+        if model is not None:
+            conditions.append("model = ?")
+            args.append(model)
+        if prompt is not None:
+            conditions.append("prompt_hash = ?")
+            args.append(prompt_hash(prompt))
+        if status is not None:
+            conditions.append("status = ?")
+            args.append(status)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {', '.join(_CHAIN_COLUMNS)} FROM chains {where} ORDER BY updated DESC LIMIT ? OFFSET ?",
+                (*args, limit, offset),
+            ).fetchall()
+        return [self._chain(row) for row in rows]
+
+    def delete(self, chain_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM chain_steps WHERE chain_id = ?", (chain_id,))
+            self._db.execute("DELETE FROM chains WHERE id = ?", (chain_id,))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
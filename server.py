@@ -0,0 +1,387 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import time
+from contextlib import suppress
+
+from dotenv import load_dotenv
+
+from llm.V4 import AsyncChatbot
+from llm.cache import ResponseCache
+from llm.capabilities import capabilities, parse_capabilities
+from llm.export import chain_summary, step_records
+from llm.metrics import metrics
+from llm.policy import POLICIES, make_policy
+from llm.rate_limit import RateLimiter, admission_session
+from llm.reasoning import agenerate_response
+from llm.retry import RetryPolicy
+from llm.router import Router, parse_fallbacks
+from llm.semantic_cache import SemanticCache
+from llm.store import ChainStore
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY = 1 << 20
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 408: "Request Timeout",
+           411: "Length Required", 413: "Payload Too Large", 500: "Internal Server Error",
+           503: "Service Unavailable"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str, headers: dict = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+async def read_request(reader: asyncio.StreamReader):
+    """读取一个 HTTP/1.1 请求，返回 (method, path, headers, body)；每个连接只处理一个请求"""
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    parts = request_line.split()
+    if len(parts) != 3:
+        raise HTTPError(400, "malformed request line")
+    method, path, _ = parts
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1")
+        if line in ("\r\n", "\n", ""):
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HTTPError(411, "chunked request bodies are not supported")
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise HTTPError(400, "invalid Content-Length")
+    if length > MAX_BODY:
+        raise HTTPError(413, "request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method, path.split("?")[0], headers, body
+
+
+def write_response(writer: asyncio.StreamWriter, status: int, body, content_type: str = "application/json",
+                   headers: dict = None):
+    if not isinstance(body, bytes):
+        body = json.dumps(body, ensure_ascii=False, default=str).encode("utf-8")
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", f"Content-Type: {content_type}",
+             f"Content-Length: {len(body)}", "Connection: close"]
+    lines += [f"{key}: {value}" for key, value in (headers or {}).items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+
+
+def write_event(writer: asyncio.StreamWriter, event: str, data):
+    """写入一条 Server-Sent Event"""
+    writer.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n".encode("utf-8"))
+
+
+def chain_payload(full_response: dict) -> dict:
+    return dict(chain_summary(full_response), steps=step_records(full_response))
+
+
+class ChainServer:
+    """
+    以 HTTP 提供 agenerate_response：POST /v1/chains 在推理链完成后返回整条链，
+    POST /v1/chains/stream 以 SSE 逐步推送（queued / step / done / error 事件）。
+
+    同时运行的推理链不超过 workers 条，另有 queue_size 条可以排队，超出时返回 503；
+    客户端断开连接时对应的推理链被取消，正在进行的 API 请求随之中止。
+    GET /healthz 为存活探针，GET /readyz 在排队已满或正在排空时返回 503，GET /metrics 为 Prometheus 指标。
+    """
+
+    def __init__(self, client, args, store: ChainStore = None, semantic_cache: SemanticCache = None):
+        self.client = client
+        self.args = args
+        self.store = store
+        self.semantic_cache = semantic_cache
+        self.draining = False
+        self._slots = asyncio.Semaphore(args.workers)
+        self._running = 0
+        self._pending = 0
+        self._tasks = set()
+        self._connections = set()
+        self._counters = {"completed": 0, "failed": 0, "cancelled": 0, "rejected": 0}
+
+    @property
+    def ready(self) -> bool:
+        return not self.draining and self._pending < self.args.workers + self.args.queue_size
+
+    def status(self) -> dict:
+        return dict(self._counters, ready=self.ready, draining=self.draining, running=self._running,
+                    queued=self._pending - self._running, workers=self.args.workers)
+
+    def parse_chain_request(self, body: bytes) -> dict:
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "request body is not valid JSON")
+        if not isinstance(request, dict) or not isinstance(request.get("prompt"), str) or not request["prompt"]:
+            raise HTTPError(400, "prompt is required")
+        policy = request.get("policy", self.args.policy)
+        if policy not in POLICIES:
+            raise HTTPError(400, f"unknown step policy: {policy}")
+        try:
+            max_steps = min(int(request.get("max_steps", self.args.max_steps)), self.args.max_steps_limit)
+            temperature = float(request.get("temperature", self.args.temperature))
+        except (TypeError, ValueError):
+            raise HTTPError(400, "max_steps and temperature must be numbers")
+        return {
+            "prompt": request["prompt"],
+            "model": request.get("model", self.args.model),
+            "max_steps": max(max_steps, 1),
+            "temperature": temperature,
+            "policy": policy,
+            "chain_id": request.get("chain_id") if self.store is not None else None,
+        }
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(asyncio.current_task())
+        try:
+            try:
+                method, path, headers, body = await asyncio.wait_for(read_request(reader),
+                                                                     self.args.header_timeout)
+                if path in ("/v1/chains", "/v1/chains/stream"):
+                    if method != "POST":
+                        raise HTTPError(405, "use POST")
+                    params = self.parse_chain_request(body)
+                    if not self.ready:
+                        self._counters["rejected"] += 1
+                        raise HTTPError(503, "draining" if self.draining else "queue is full", {"Retry-After": "1"})
+                    # 同一会话（默认按客户端地址）的请求在限流器中共用一个轮转位置
+                    session_id = headers.get("x-session-id") or str((writer.get_extra_info("peername") or ("",))[0])
+                    await self._serve_chain(reader, writer, params, path.endswith("/stream"), session_id)
+                elif method != "GET":
+                    raise HTTPError(405, "use GET")
+                elif path == "/healthz":
+                    write_response(writer, 200, {"status": "ok"})
+                elif path == "/readyz":
+                    write_response(writer, 200 if self.ready else 503, self.status())
+                elif path == "/metrics":
+                    write_response(writer, 200, metrics.prometheus_text().encode("utf-8"),
+                                   "text/plain; version=0.0.4")
+                else:
+                    raise HTTPError(404, "not found")
+            except HTTPError as e:
+                write_response(writer, e.status, {"error": str(e)}, headers=e.headers)
+            except asyncio.TimeoutError:
+                write_response(writer, 408, {"error": "request timeout"})
+            with suppress(ConnectionError):
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            with suppress(ConnectionError):
+                await writer.wait_closed()
+            self._connections.discard(asyncio.current_task())
+
+    async def _serve_chain(self, reader, writer, params: dict, stream: bool, session_id: str):
+        """在独立的任务中运行推理链，同时监视连接，客户端断开时取消该任务"""
+        self._pending += 1
+        task = asyncio.create_task(self._run_chain(writer, params, stream, session_id))
+        self._tasks.add(task)
+        watcher = asyncio.create_task(self._wait_disconnect(reader))
+        try:
+            await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not task.done():
+                logger.info(f"客户端已断开，取消推理链: {params['prompt'][:50]}")
+                task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+        finally:
+            watcher.cancel()
+            self._tasks.discard(task)
+            self._pending -= 1
+
+    @staticmethod
+    async def _wait_disconnect(reader: asyncio.StreamReader):
+        """请求已经读完，读到 EOF 或连接被重置说明客户端已经断开，多余的数据被丢弃"""
+        with suppress(ConnectionError):
+            while await reader.read(4096):
+                pass
+
+    async def _run_chain(self, writer, params: dict, stream: bool, session_id: str):
+        def on_wait(position, wait):
+            write_event(writer, "queued", {"position": position, "wait": wait})
+
+        if stream:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                         b"Connection: close\r\n\r\n")
+        start_time = time.time()
+        try:
+            async with self._slots:
+                self._running += 1
+                try:
+                    full_response = await self._generate(writer, params, stream, session_id,
+                                                         on_wait if stream else None)
+                finally:
+                    self._running -= 1
+        except asyncio.CancelledError:
+            self._counters["cancelled"] += 1
+            if self.draining:
+                # 排空超时被取消，客户端仍然在线，告诉它可以重试
+                if stream:
+                    write_event(writer, "error", {"error": "server shutting down"})
+                else:
+                    write_response(writer, 503, {"error": "server shutting down"}, headers={"Retry-After": "1"})
+            raise
+        except Exception as e:
+            logger.error(f"推理链失败: {e}")
+            self._counters["failed"] += 1
+            if stream:
+                write_event(writer, "error", {"error": str(e)})
+            else:
+                write_response(writer, 500, {"error": str(e)})
+            return
+        self._counters["completed"] += 1
+        logger.info(f"推理链完成，耗时 {time.time() - start_time:.2f} 秒")
+        if stream:
+            write_event(writer, "done", chain_payload(full_response))
+        else:
+            write_response(writer, 200, chain_payload(full_response))
+
+    async def _generate(self, writer, params: dict, stream: bool, session_id: str, on_wait):
+        args = self.args
+        policy = make_policy(params["policy"], confidence=args.confidence_threshold, max_seconds=args.chain_timeout,
+                             max_tokens=args.chain_tokens)
+        sent = 0
+        full_response = None
+        with admission_session(session_id, on_wait):
+            async for steps, _, full_response in agenerate_response(
+                    params["prompt"], max_steps=params["max_steps"], temperature=params["temperature"],
+                    model=params["model"], client=self.client, context_budget=args.context_budget, policy=policy,
+                    chain_timeout=args.chain_deadline, store=self.store, chain_id=params["chain_id"],
+                    semantic_cache=self.semantic_cache
+            ):
+                if not stream:
+                    continue
+                for index, (title, content, thinking_time) in enumerate(steps[sent:], start=sent + 1):
+                    write_event(writer, "step", {"index": index, "title": title, "content": content,
+                                                 "thinking_time": thinking_time})
+                sent = len(steps)
+                # 客户端读得慢时在这里等待，未发送的数据不会无限堆积
+                await writer.drain()
+        return full_response
+
+    async def drain(self, timeout: float):
+        """等待进行中的推理链完成，超过 timeout 秒后取消剩余的推理链，最后等待各连接写完响应"""
+        if self._tasks:
+            logger.info(f"等待 {len(self._tasks)} 条进行中的推理链完成")
+            _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.warning(f"排空超时，取消 {len(pending)} 条推理链")
+                await asyncio.gather(*pending, return_exceptions=True)
+        if self._connections:
+            await asyncio.wait(set(self._connections), timeout=5)
+
+
+async def serve(args):
+    for prefix, mode in parse_capabilities(args.structured_output).items():
+        capabilities.register(prefix, mode)
+    limiter = None
+    if args.rpm or args.tpm:
+        limiter = RateLimiter(rpm=args.rpm, tpm=args.tpm, path=args.rate_limit_state)
+    cache = ResponseCache(path=args.cache) if args.cache else None
+    store = ChainStore(args.store) if args.store else None
+    semantic_cache = None
+    if args.semantic_cache:
+        semantic_cache = SemanticCache(threshold=args.semantic_threshold, seed_threshold=args.semantic_seed_threshold,
+                                       path=None if args.semantic_cache == ":memory:" else args.semantic_cache)
+    client = AsyncChatbot(
+        api_key=os.getenv('OPENAI_API_KEY'),
+        api_url=os.getenv('OPENAI_API_BASE'),
+        proxy=os.getenv('OPENAI_PROXY'),
+        max_connections=args.workers * 2,
+        max_keepalive_connections=args.workers,
+        rate_limiter=limiter,
+        cache=cache,
+        retry=RetryPolicy(max_attempts=args.max_attempts, step_timeout=args.step_timeout),
+    )
+    fallbacks = parse_fallbacks(args.fallback)
+    if fallbacks:
+        client = Router(client, fallbacks, hedge=not args.no_hedge)
+
+    chain_server = ChainServer(client, args, store, semantic_cache)
+    server = await asyncio.start_server(chain_server.handle, args.host, args.port)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    logger.info(f"g1 服务已启动: http://{args.host}:{args.port}，workers={args.workers}，queue={args.queue_size}")
+
+    await stop.wait()
+    # 先让 /readyz 返回 503，负载均衡器摘除本实例后再停止接受连接，进行中的推理链继续完成
+    chain_server.draining = True
+    logger.info(f"收到停止信号，开始排空（最长 {args.drain_timeout} 秒）")
+    if args.drain_delay:
+        await asyncio.sleep(args.drain_delay)
+    server.close()
+    await chain_server.drain(args.drain_timeout)
+    await server.wait_closed()
+    await client.close()
+    logger.info(f"调用统计: {json.dumps(metrics.snapshot(), ensure_ascii=False)}")
+    logger.info(f"服务统计: {chain_server.status()}")
+    for resource in (cache, store, semantic_cache):
+        if resource is not None:
+            resource.close()
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="以 HTTP / SSE 提供 g1 推理链")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=8, help="同时运行的推理链数量")
+    parser.add_argument("--queue-size", type=int, default=32, help="可以排队等待的推理链数量，超出时返回 503")
+    parser.add_argument("--header-timeout", type=float, default=10, help="读取请求的超时时间（秒）")
+    parser.add_argument("--drain-delay", type=float, default=0,
+                        help="收到停止信号后继续接受连接的秒数，留给负载均衡器根据 /readyz 摘除本实例")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="停止时等待进行中的推理链的最长时间（秒）")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--max-steps", type=int, default=10)
+    parser.add_argument("--max-steps-limit", type=int, default=25, help="请求中 max_steps 的上限")
+    parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument("--context-budget", type=int, default=None, help="每次请求的上下文 token 预算，超出时压缩较早的步骤")
+    parser.add_argument("--policy", choices=POLICIES, default="adaptive", help="请求未指定 policy 时使用的步骤策略")
+    parser.add_argument("--confidence-threshold", type=float, default=0.9, help="置信度达到该值即停止")
+    parser.add_argument("--chain-timeout", type=float, default=None, help="每条推理链的墙钟时间预算（秒）")
+    parser.add_argument("--chain-tokens", type=int, default=None, help="每条推理链的 token 预算")
+    parser.add_argument("--chain-deadline", type=float, default=None,
+                        help="每条推理链的硬性截止时间（秒），到期后请求直接失败")
+    parser.add_argument("--step-timeout", type=float, default=None, help="单步调用（含所有重试）的超时时间（秒）")
+    parser.add_argument("--max-attempts", type=int, default=3, help="每次调用最多发出的请求数（含首次请求）")
+    parser.add_argument("--rpm", type=float, default=None, help="每个模型每分钟的请求数上限")
+    parser.add_argument("--tpm", type=float, default=None, help="每个模型每分钟的 token 数上限")
+    parser.add_argument("--rate-limit-state", default=None,
+                        help="限流状态文件路径，使用同一文件的多个进程（包括界面和批处理）共享同一份 rpm/tpm 额度")
+    parser.add_argument("--fallback", action="append", metavar="MODEL=FALLBACK1,FALLBACK2",
+                        help="模型不可用时依次改用的备用模型，也用作超过 p95 时的对冲目标，可以重复使用")
+    parser.add_argument("--structured-output", action="append", metavar="PREFIX=MODE",
+                        help="指定模型（按名称前缀）的结构化输出方式：json_schema / tools / json_object，可以重复使用")
+    parser.add_argument("--no-hedge", action="store_true", help="只做故障转移，不发出对冲请求")
+    parser.add_argument("--cache", default=None, help="SQLite 响应缓存文件路径，相同请求不会重复调用 API")
+    parser.add_argument("--store", default=None, help="SQLite 推理链存储路径，请求中带 chain_id 时从该链的断点继续")
+    parser.add_argument("--semantic-cache", default=None,
+                        help="SQLite 语义缓存文件路径（:memory: 只在进程内缓存），相似的问题复用已有的推理链")
+    parser.add_argument("--semantic-threshold", type=float, default=0.85, help="相似度达到该值时直接返回已有的推理链")
+    parser.add_argument("--semantic-seed-threshold", type=float, default=0.6,
+                        help="相似度达到该值时以已有的答案为参考生成较短的推理链")
+    parser.add_argument("--verbose", action="store_true", help="输出每一步推理的日志")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if not args.verbose:
+        logging.getLogger("llm.reasoning").setLevel(logging.WARNING)
+        logging.getLogger("llm.policy").setLevel(logging.WARNING)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+    asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+from contextlib import nullcontext
+
+import app
+from llm.V4 import Chatbot
+from llm.router import Router
+
+
+def test_client_is_shared_across_reruns(monkeypatch):
+    monkeypatch.delenv("MODEL_FALLBACKS", raising=False)
+    monkeypatch.delenv("RATE_LIMIT_RPM", raising=False)
+    monkeypatch.delenv("RATE_LIMIT_TPM", raising=False)
+    app.get_client.clear()
+    client = app.get_client("k", None, None)
+    assert isinstance(client, Chatbot)
+    assert app.get_client("k", None, None) is client
+    other = app.get_client("k2", None, None)
+    assert other is not client
+    # 不同的 API key 使用各自的连接池，但共享同一个响应缓存
+    assert other.cache is client.cache and other.rate_limiter is None
+    app.get_client.clear()
+
+
+def test_client_with_fallbacks_is_router(monkeypatch):
+    monkeypatch.setenv("MODEL_FALLBACKS", "gpt-4o=gpt-4o-mini")
+    app.get_client.clear()
+    router = app.get_client("k", None, None)
+    assert isinstance(router, Router)
+    assert app.get_client("k", None, None) is router
+    app.get_client.clear()
+
+
+def test_rate_limiter_is_shared(monkeypatch):
+    monkeypatch.delenv("MODEL_FALLBACKS", raising=False)
+    monkeypatch.setenv("RATE_LIMIT_RPM", "60")
+    app.get_client.clear()
+    app.get_rate_limiter.clear()
+    first, second = app.get_client("k", None, None), app.get_client("k2", None, None)
+    assert first.rate_limiter is not None and first.rate_limiter is second.rate_limiter
+    app.get_client.clear()
+    app.get_rate_limiter.clear()
+
+
+class Placeholder:
+    def __init__(self):
+        self.emptied = 0
+
+    def empty(self):
+        self.emptied += 1
+
+
+def _renderer(monkeypatch, min_interval=0.1):
+    rendered = []
+    monkeypatch.setattr(app.st, "empty", Placeholder)
+    monkeypatch.setattr(app.StepRenderer, "_render", staticmethod(lambda placeholder, step: rendered.append(step)))
+    return app.StepRenderer(nullcontext(), min_interval=min_interval), rendered
+
+
+def test_renderer_only_redraws_changed_steps(monkeypatch):
+    renderer, rendered = _renderer(monkeypatch, min_interval=60)
+    first, second = ("一", "a", 1.0), ("二", "b", 2.0)
+    renderer.update([first])
+    renderer.update([first, second])
+    assert rendered == [first, second]
+    # 流式输出时最新一步在 min_interval 内不会重绘，最终结果总会重绘
+    renderer.update([first, ("二", "bc", 2.1)])
+    assert len(rendered) == 2
+    renderer.update([first, ("二", "bcd", 2.2)], final=True)
+    assert rendered[-1] == ("二", "bcd", 2.2) and len(rendered) == 3
+    assert len(renderer.placeholders) == 2
+
+
+def test_renderer_clears_steps_that_disappear(monkeypatch):
+    renderer, rendered = _renderer(monkeypatch)
+    renderer.update([("一", "a", 1.0), ("二", "b", 2.0), ("三", "c", 3.0)])
+    renderer.update([("一", "a", 1.0), ("二'", "b'", 2.0)])
+    assert rendered[-1] == ("二'", "b'", 2.0) and len(rendered) == 4
+    assert [p.emptied for p in renderer.placeholders] == [0, 0, 1]
@@ -0,0 +1,73 @@
+import json
+import threading
+
+from llm.branching import _fork, generate_branched_response
+
+STEP = {"title": "t", "content": "1.3 更大", "next_action": "final_answer", "confidence": 0.9}
+MALFORMED = {"title": "t", "content": "缺少 next_action", "confidence": 0.95}
+
+
+class FakeClient:
+    def __init__(self, candidates):
+        self.candidates = candidates
+        self.asks = 0
+
+    def ask_n(self, model, prompt, n, **kwargs):
+        return [json.dumps(c) for c in self.candidates], 1, 1, False
+
+    def ask(self, model, prompt, **kwargs):
+        self.asks += 1
+        return json.dumps(STEP), 1, 1, False
+
+
+class InlinePool:
+    def submit(self, fn, *args, **kwargs):
+        class Done:
+            result = staticmethod(lambda: fn(*args, **kwargs))
+        return Done()
+
+
+def test_fork_replaces_malformed_candidates():
+    client = FakeClient([STEP, MALFORMED])
+    candidates = _fork(client, [], 2, 0.7, "m", True, InlinePool())
+    assert candidates == [STEP, STEP]
+    assert client.asks == 1
+
+
+def test_branched_chain_with_malformed_candidate():
+    client = FakeClient([MALFORMED, STEP, MALFORMED])
+    for steps, total_time, full_response in generate_branched_response("q", max_steps=1, branches=3, client=client):
+        pass
+    assert steps[-1][0] == "最终答案"
+    assert len(full_response["branches"]) == 3
+
+
+class SequenceClient(FakeClient):
+    """分叉时返回两个 continue 步骤，之后按顺序返回 replies 中的步骤"""
+
+    def __init__(self, replies):
+        super().__init__([dict(STEP, next_action="continue")] * 2)
+        self.replies = list(replies)
+        self.lock = threading.Lock()
+
+    def ask(self, model, prompt, **kwargs):
+        with self.lock:
+            reply = self.replies.pop(0) if self.replies else STEP
+        return json.dumps(reply), 1, 1, False
+
+
+def test_malformed_later_step_prunes_one_branch():
+    client = SequenceClient([MALFORMED])
+    for steps, total_time, full_response in generate_branched_response("q", max_steps=2, branches=2, client=client):
+        pass
+    assert steps[-1][0] == "最终答案"
+    pruned = [b for b in full_response["branches"] if b["pruned_at"] == 2]
+    assert len(pruned) == 1
+    assert full_response["winner"] != pruned[0]["branch"]
+
+
+def test_all_later_steps_malformed_ends_with_error_step():
+    client = SequenceClient([MALFORMED, MALFORMED])
+    for steps, total_time, full_response in generate_branched_response("q", max_steps=2, branches=2, client=client):
+        pass
+    assert [s[0] for s in steps][-2:] == ["错误", "最终答案"]
@@ -0,0 +1,63 @@
+from llm.V4 import Chatbot
+from llm.cache import ResponseCache
+from llm.metrics import MetricsRegistry
+
+MESSAGES = [{"role": "user", "content": "q"}]
+RESULT = ("1.3 更大", 10, 5, False)
+
+
+def test_key_ignores_credentials_and_timeout():
+    key = ResponseCache.make_key("m", MESSAGES, temperature=0.5)
+    assert ResponseCache.make_key("m", MESSAGES, temperature=0.5, api_key="k", timeout=3) == key
+    assert ResponseCache.make_key("m", MESSAGES, temperature=0.7) != key
+    assert ResponseCache.make_key("other", MESSAGES, temperature=0.5) != key
+
+
+def test_memory_lru_eviction():
+    cache = ResponseCache(max_entries=2)
+    for key in ("a", "b"):
+        cache.put(key, RESULT)
+    assert cache.get("a") == RESULT
+    cache.put("c", RESULT)
+    assert cache.get("b") is None
+    assert cache.get("a") == RESULT
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ttl_expires_entries():
+    cache = ResponseCache(ttl=-1)
+    cache.put("a", RESULT)
+    assert cache.get("a") is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ResponseCache(path=path)
+    cache.put("a", RESULT)
+    cache.close()
+    reloaded = ResponseCache(path=path)
+    assert reloaded.get("a") == RESULT
+    assert reloaded.get("a") == RESULT
+    stats = reloaded.stats()
+    assert (stats["disk_hits"], stats["memory_hits"]) == (1, 1)
+    reloaded.close()
+
+
+def test_ask_serves_repeated_requests_from_cache():
+    registry = MetricsRegistry()
+    chatbot = Chatbot(api_key="k", cache=ResponseCache(), metrics=registry)
+    requests = []
+
+    def ask_request(**kwargs):
+        requests.append(kwargs)
+        return RESULT
+
+    chatbot._ask_request = ask_request
+    assert chatbot.ask("m", "q") == RESULT
+    assert chatbot.ask("m", "q") == RESULT
+    assert chatbot.ask("m", "q", use_cache=False) == RESULT
+    assert len(requests) == 2
+    assert [call["cached"] for call in registry.recent_calls()] == [False, True, False]
+    # 命中缓存时 token 数与原始请求一致
+    assert registry.recent_calls()[1]["prompt_tokens"] == 10
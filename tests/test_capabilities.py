@@ -0,0 +1,126 @@
+import json
+
+import pytest
+
+from llm.V4 import Chatbot
+from llm.capabilities import CapabilityRegistry, parse_capabilities, structured_output
+from llm.metrics import MetricsRegistry
+from llm.reasoning import StepResultModel
+from llm.retry import HTTPStatusError, RetryPolicy
+
+STEP = {"title": "t", "content": "c", "next_action": "continue", "confidence": 0.5}
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+def _completion(message):
+    return {"choices": [{"message": message, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 5}}
+
+
+class FakeServer:
+    """记录请求体；reject 为 True 时以 400 拒绝带 schema 的请求"""
+
+    def __init__(self, reject=False, status=400):
+        self.reject = reject
+        self.status = status
+        self.payloads = []
+
+    def post(self, payload, deadline, **kwargs):
+        self.payloads.append(payload)
+        if self.reject and ("tools" in payload or payload["response_format"]["type"] == "json_schema"):
+            raise HTTPStatusError(self.status, "Bad Request", "unsupported parameter")
+        if "tools" in payload:
+            call = {"type": "function", "function": {"name": "StepResultModel", "arguments": json.dumps(STEP)}}
+            return FakeResponse(_completion({"content": None, "tool_calls": [call]}))
+        return FakeResponse(_completion({"content": json.dumps(STEP)}))
+
+
+def _chatbot(server):
+    registry = MetricsRegistry()
+    chatbot = Chatbot(api_key="k", metrics=registry, capabilities=CapabilityRegistry(),
+                      retry=RetryPolicy(base_delay=0))
+    chatbot._post = server.post
+    return chatbot, registry
+
+
+def _ask(chatbot, model):
+    return chatbot.ask(model, "q", json_format=True, response_model=StepResultModel)
+
+
+def test_registry_rules():
+    registry = CapabilityRegistry()
+    assert registry.mode("gpt-4o-mini") == "json_schema"
+    assert registry.mode("claude-3-5-sonnet") == "tools"
+    assert registry.mode("local-model") == "json_object"
+    registry.register("local-", "tools")
+    assert registry.mode("local-model") == "tools"
+    assert parse_capabilities(["a=tools;b=json_schema", "c=json_object"]) == {
+        "a": "tools", "b": "json_schema", "c": "json_object"}
+    with pytest.raises(ValueError):
+        parse_capabilities(["a=xml"])
+
+
+def test_strict_schema_request():
+    params = structured_output("json_schema", StepResultModel)
+    schema = params["response_format"]["json_schema"]["schema"]
+    assert schema["additionalProperties"] is False
+    assert schema["required"] == ["title", "content", "next_action", "confidence"]
+    assert "title" not in schema
+
+
+@pytest.mark.parametrize("model,mode", [("gpt-4o", "json_schema"), ("claude-3-5-sonnet", "tools")])
+def test_schema_output_parses_on_first_call(model, mode):
+    server = FakeServer()
+    chatbot, registry = _chatbot(server)
+    assert json.loads(_ask(chatbot, model)[0]) == STEP
+    assert len(server.payloads) == 1
+    assert registry.recent_calls()[-1]["json_tier"] == "schema"
+
+
+def test_rejected_schema_falls_back_and_marks_model():
+    server = FakeServer(reject=True)
+    chatbot, registry = _chatbot(server)
+    assert json.loads(_ask(chatbot, "gpt-4o")[0]) == STEP
+    assert [p["response_format"]["type"] for p in server.payloads] == ["json_schema", "json_object"]
+    assert chatbot.capabilities.mode("gpt-4o") == "json_object"
+    assert registry.recent_calls()[-1]["json_tier"] == "direct"
+    # 之后直接使用 json_object，不再先发一次会被拒绝的请求
+    _ask(chatbot, "gpt-4o")
+    assert len(server.payloads) == 3
+    # 只影响被拒绝的模型
+    assert chatbot.capabilities.mode("gpt-4o-mini") == "json_schema"
+
+
+def test_server_errors_do_not_mark_model():
+    server = FakeServer(reject=True, status=503)
+    chatbot, _ = _chatbot(server)
+    chatbot.retry.max_attempts = 1
+    with pytest.raises(HTTPStatusError):
+        _ask(chatbot, "gpt-4o")
+    assert chatbot.capabilities.mode("gpt-4o") == "json_schema"
+
+
+def test_stream_fallback_marks_model():
+    chatbot, _ = _chatbot(FakeServer())
+    requests = []
+
+    def ask_stream_request(structured=None, **kwargs):
+        requests.append(structured)
+        if structured is not None:
+            raise HTTPStatusError(422, "Unprocessable Entity", "tools are not supported")
+        content = json.dumps(STEP)
+        yield content, None
+        yield "", (content, 10, 5, False)
+
+    chatbot._ask_stream_request = ask_stream_request
+    chunks = list(chatbot.ask_stream("claude-3-5-sonnet", "q", json_format=True, response_model=StepResultModel))
+    assert json.loads(chunks[-1][1][0]) == STEP
+    assert requests[0] is not None and requests[1] is None
+    assert chatbot.capabilities.mode("claude-3-5-sonnet") == "json_object"
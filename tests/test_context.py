@@ -0,0 +1,78 @@
+import json
+
+from llm.context import SUMMARY_HEADER, ContextCompactor
+from llm.llm_tools import estimate_tokens
+from llm.policy import CONTINUE_PROMPT
+from llm.reasoning import SEED_PROMPT, initial_messages
+from llm.semantic_cache import SemanticMatch
+
+
+def _chain(messages, steps):
+    messages = list(messages)
+    for i in range(steps):
+        step = {"title": f"Step {i + 1}", "content": "reasoning " * 200, "next_action": "continue", "confidence": 0.5}
+        messages.append({"role": "assistant", "content": json.dumps(step)})
+        messages.append({"role": "user", "content": CONTINUE_PROMPT})
+    return messages
+
+
+def test_under_budget_is_unchanged():
+    messages = _chain(initial_messages("q"), 2)
+    assert ContextCompactor(10 ** 6).compact(messages) == (messages, 0)
+
+
+def test_compact_shape():
+    messages = _chain(initial_messages("q"), 6)
+    original = json.loads(json.dumps(messages))
+    compacted, saved = ContextCompactor(2000, keep_recent=2).compact(messages)
+    assert messages == original
+    assert saved > 0 and estimate_tokens(compacted) <= 2000
+    # 系统提示、附加了摘要的问题，以及最近 2 步（assistant, user）原样保留
+    assert [m["role"] for m in compacted] == ["system", "user", "assistant", "user", "assistant", "user"]
+    assert compacted[0] == messages[0]
+    assert compacted[1]["content"].startswith("q\n\n" + SUMMARY_HEADER)
+    assert "1. Step 1" in compacted[1]["content"] and "4. Step 4" in compacted[1]["content"]
+    assert compacted[2:] == messages[-4:]
+
+
+def test_compact_omits_earliest_steps_when_titles_do_not_fit():
+    messages = _chain(initial_messages("q"), 40)
+    budget = estimate_tokens(messages[:2] + messages[-6:]) + 100
+    compacted, _ = ContextCompactor(budget, keep_recent=3).compact(messages)
+    assert estimate_tokens(compacted) <= budget
+    assert "earliest steps omitted" in compacted[1]["content"]
+
+
+def test_compact_keeps_seed_reference():
+    reference = SemanticMatch("seed", 0.7, "1.11 和 1.3 哪个大", {"steps": [["最终答案", "1.3 更大", 1.0]]})
+    head = initial_messages("1.11 和 1.30 哪个大", reference)
+    messages = _chain(head, 6)
+    compacted, saved = ContextCompactor(2000, keep_recent=2).compact(messages)
+    assert saved > 0
+    assert compacted[:2] == head[:2]
+    assert compacted[2]["content"].startswith(SEED_PROMPT.format(prompt=reference.prompt, answer="1.3 更大"))
+    assert SUMMARY_HEADER in compacted[2]["content"]
+    assert [m["role"] for m in compacted[3:]] == ["assistant", "user", "assistant", "user"]
+
+
+def test_chain_sends_compacted_context():
+    from llm.reasoning import generate_response
+
+    class Client:
+        def __init__(self):
+            self.prompts = []
+
+        def ask(self, model, prompt, **kwargs):
+            self.prompts.append(list(prompt))
+            step = {"title": f"Step {len(self.prompts)}", "content": "reasoning " * 50,
+                    "next_action": "final_answer", "confidence": 0.5}
+            return json.dumps(step), 1, 1, False
+
+    client = Client()
+    for steps, total_time, full_response in generate_response("q", max_steps=6, client=client, context_budget=1200):
+        pass
+    saved = [stats["context_tokens_saved"] for stats in full_response["step_stats"]]
+    assert saved[0] == 0 and saved[-1] > 0
+    assert all(estimate_tokens(prompt) <= 1200 for prompt in client.prompts)
+    assert all(stats["context_tokens"] == estimate_tokens(prompt)
+               for stats, prompt in zip(full_response["step_stats"], client.prompts))
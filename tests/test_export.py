@@ -0,0 +1,45 @@
+import gzip
+import json
+
+import pytest
+
+from llm.export import export_chain
+
+FULL_RESPONSE = {
+    "steps": [("读题", "比较 1.11 和 1.3", 0.5), ("最终答案", "1.3 更大", 0.25)],
+    "total_thinking_time": 0.75,
+    "step_stats": [{"context_tokens": 600, "context_tokens_saved": 0}],
+    "policy": {"name": "legacy", "stopped_by": "model", "steps": 1, "calls_saved": 0},
+}
+
+
+def test_json_round_trip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data, file_name, mime = export_chain(FULL_RESPONSE)
+    assert (file_name, mime) == ("reasoning_chain.json", "application/json")
+    chain = json.loads(data.decode("utf-8"))
+    assert chain["policy"] == FULL_RESPONSE["policy"]
+    assert chain["steps"] == [
+        {"index": 1, "title": "读题", "content": "比较 1.11 和 1.3", "thinking_time": 0.5,
+         "context_tokens": 600, "context_tokens_saved": 0},
+        {"index": 2, "title": "最终答案", "content": "1.3 更大", "thinking_time": 0.25},
+    ]
+    # 只在内存中序列化，不写入工作目录
+    assert not list(tmp_path.iterdir())
+
+
+def test_compressed_jsonl_round_trip():
+    data, file_name, mime = export_chain(FULL_RESPONSE, "jsonl", compress=True)
+    assert (file_name, mime) == ("reasoning_chain.jsonl.gz", "application/gzip")
+    # mtime 固定，相同的链导出的字节相同
+    assert export_chain(FULL_RESPONSE, "jsonl", compress=True)[0] == data
+    lines = [json.loads(line) for line in gzip.decompress(data).decode("utf-8").splitlines()]
+    assert lines[0] == {"total_thinking_time": 0.75, "policy": FULL_RESPONSE["policy"], "type": "chain"}
+    assert [(line["type"], line["title"]) for line in lines[1:]] == [("step", "读题"), ("step", "最终答案")]
+    uncompressed = export_chain(FULL_RESPONSE, "jsonl")[0]
+    assert gzip.decompress(data) == uncompressed
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        export_chain(FULL_RESPONSE, "csv")
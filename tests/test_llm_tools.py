@@ -0,0 +1,87 @@
+import json
+from json import JSONDecodeError
+
+import pytest
+
+from llm.llm_tools import PartialJsonParser, parse_json_locally, repair_json
+
+STEP = {"title": "比较", "content": "1.11 < 1.3", "next_action": "continue"}
+
+
+def test_valid_json_parses_directly():
+    assert parse_json_locally(json.dumps(STEP)) == (STEP, "direct")
+
+
+@pytest.mark.parametrize("text", [
+    'Here is my step:\n```json\n{"title": "比较", "content": "1.11 < 1.3", "next_action": "continue"}\n```\n说明',
+    '{"title": "比较", "content": "1.11 < 1.3", "next_action": "continue",}',
+    '{"title": "比较" "content": "1.11 < 1.3" "next_action": "continue"}',
+    '{"title": "比较", "content": "1.11 < 1.3", "next_action": "continue"',
+])
+def test_repair_structure(text):
+    assert repair_json(text) == STEP
+
+
+def test_repair_is_second_tier():
+    assert parse_json_locally(json.dumps(STEP)[:-1] + ",}") == (STEP, "local_repair")
+
+
+def test_repair_string_contents():
+    data = repair_json('{"content": "He said "hi" there\nand left", "ok": True, "missing": None}')
+    assert data == {"content": 'He said "hi" there\nand left', "ok": True, "missing": None}
+
+
+def test_repair_keeps_latex_backslashes():
+    text = r'{"content": "\frac{1}{2} + \beta \theta \nabla \times \(x\) é", "next_action": "continue",}'
+    assert repair_json(text)["content"] == r"\frac{1}{2} + \beta \theta \nabla \times \(x\) " + "é"
+
+
+def test_repair_keeps_json_escapes():
+    text = r'{"content": "line one\nNext line\tTab \"q\"", "next_action": "continue",}'
+    assert repair_json(text)["content"] == 'line one\nNext line\tTab "q"'
+
+
+def test_repair_fails_instead_of_dropping_keys():
+    with pytest.raises(JSONDecodeError):
+        repair_json('{"title": "use "}" here", "content": "x", "next_action": "continue"}')
+
+
+def test_repair_without_json_fails():
+    with pytest.raises(JSONDecodeError):
+        repair_json("no json here")
+
+
+def test_partial_parser_streams_fields():
+    parser = PartialJsonParser()
+    text = '```json\n{"title": "比较", "content": "a\\"b\\u00e9", "confidence": 0.8, "next_action": "final_answer"}'
+    snapshots = [parser.feed(ch) for ch in text]
+    # 未闭合的字符串值以当前内容返回
+    assert any(snapshot.get("content") == "a" for snapshot in snapshots)
+    assert snapshots[-1] == {"title": "比较", "content": 'a"bé', "confidence": 0.8,
+                             "next_action": "final_answer"}
+    assert parser.done
+
+
+def test_partial_parser_skips_nested_values():
+    parser = PartialJsonParser()
+    fields = parser.feed('{"title": "t", "meta": {"a": "b"}, "list": [1, "x"], "content": "c"}')
+    assert fields == {"title": "t", "content": "c"}
+
+
+def _is_step(json_obj) -> bool:
+    return isinstance(json_obj, dict) and all(key in json_obj for key in STEP)
+
+
+@pytest.mark.parametrize("text", [
+    '{"title": "Step", "content": "truncated...',
+    "{",
+    'See note [1] below.\n{"title": "Step", "content": "truncated',
+])
+def test_repair_must_pass_validation(text):
+    with pytest.raises(ValueError):
+        parse_json_locally(text, _is_step)
+
+
+def test_repair_skips_bracket_in_leading_prose():
+    text = 'See note [1] below.\n{"title": "比较", "content": "1.11 < 1.3", "next_action": "continue",}'
+    assert parse_json_locally(text, _is_step) == (STEP, "local_repair")
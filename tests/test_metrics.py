@@ -0,0 +1,71 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+import llm.metrics
+from llm.metrics import CallMetrics, MetricsRegistry, report_usage, start_metrics_server, usage_scope
+
+
+def _call(**fields):
+    values = dict(model="m", total_time=0.3, network_time=0.2, parse_time=0.01, json_tier="direct",
+                  attempts=1, prompt_tokens=10, cached_tokens=4, completion_tokens=5)
+    values.update(fields)
+    return CallMetrics(**values)
+
+
+def test_snapshot_aggregates_by_model():
+    registry = MetricsRegistry()
+    registry.record(_call())
+    registry.record(_call(total_time=1.5, network_time=1.4, attempts=3, retries=2, tokens_exceed=True))
+    registry.record(_call(cached=True, total_time=0.001))
+    registry.record(_call(error="boom", attempts=2, retries=1))
+    stats = registry.snapshot()["m"]
+    assert (stats["calls"], stats["errors"], stats["cache_hits"]) == (4, 1, 1)
+    # 失败的调用计入尝试次数，但不计入延迟和 token
+    assert (stats["attempts"], stats["retries"], stats["truncated"]) == (7, 3, 1)
+    assert (stats["prompt_tokens"], stats["cached_tokens"], stats["completion_tokens"]) == (30, 12, 15)
+    assert stats["json_tiers"] == {"direct": 3}
+    assert stats["avg_network_time"] == pytest.approx(0.8)
+    # 分位数只统计发出请求的调用
+    assert (stats["p50"], stats["p95"], stats["samples"]) == (1.5, 1.5, 2)
+
+
+def test_prometheus_histograms_are_cumulative():
+    registry = MetricsRegistry()
+    registry.record(_call(model='a"b', total_time=0.3))
+    registry.record(_call(model='a"b', total_time=7))
+    text = registry.prometheus_text()
+    assert 'g1_llm_call_duration_seconds_bucket{model="a\\"b",phase="total",le="0.5"} 1' in text
+    assert 'g1_llm_call_duration_seconds_bucket{model="a\\"b",phase="total",le="+Inf"} 2' in text
+    assert 'g1_llm_call_duration_seconds_count{model="a\\"b",phase="total"} 2' in text
+    assert 'g1_llm_calls_total{model="a\\"b",source="network",status="ok"} 2' in text
+    assert 'g1_llm_tokens_total{model="a\\"b",type="cached"} 8' in text
+
+
+def test_usage_scope_keeps_first_successful_call():
+    usage = {}
+    with usage_scope(usage):
+        report_usage(_call(error="boom", cached_tokens=1))
+        report_usage(_call(cached_tokens=4))
+        report_usage(_call(cached_tokens=9))
+    report_usage(_call(cached_tokens=7))
+    assert usage == {"cached_tokens": 4}
+
+
+def test_metrics_endpoint(monkeypatch):
+    monkeypatch.setattr(llm.metrics, "_server", None)
+    registry = MetricsRegistry()
+    registry.record(_call())
+    server = start_metrics_server(0, registry, host="127.0.0.1")
+    try:
+        assert start_metrics_server(0, registry) is server
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        with urllib.request.urlopen(f"{url}/metrics", timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert 'g1_llm_calls_total{model="m",source="network",status="ok"} 1' in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/other", timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
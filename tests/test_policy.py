@@ -0,0 +1,74 @@
+import pytest
+
+from llm.policy import (CONTINUE_PROMPT, MORE_STEPS_PROMPT, REFLECT_PROMPT, BudgetPolicy, ChainState,
+                        ConvergencePolicy, make_policy)
+
+
+def _step(content="step", next_action="continue", confidence=0.5):
+    return {"title": "t", "content": content, "next_action": next_action, "confidence": confidence}
+
+
+def _run(policy, steps, max_steps=10):
+    """依次加入 steps，返回停止时的 (步数, stopped_by, 最后一条消息)"""
+    state = ChainState(max_steps)
+    message = None
+    for step in steps:
+        state.add(step, tokens=100)
+        message = policy.next_message(state)
+        if message is None:
+            break
+    return state.step_count, state.stopped_by, message
+
+
+def test_legacy_forces_steps_until_max():
+    policy = make_policy("legacy")
+    assert _run(policy, [_step(next_action="final_answer")], max_steps=3) == (1, None, MORE_STEPS_PROMPT)
+    assert _run(policy, [_step()] * 2 + [_step(next_action="final_answer")], max_steps=3) == (3, "model", None)
+    assert _run(policy, [_step()] * 3)[2] == REFLECT_PROMPT
+
+
+def test_model_final_answer_stops_adaptive_chain():
+    policy = make_policy("adaptive")
+    assert _run(policy, [_step(next_action="final_answer")]) == (1, "model", None)
+
+
+def test_confidence_stops_after_min_steps():
+    policy = make_policy("confidence", confidence=0.8)
+    steps = [_step("a", confidence=0.95), _step("b", confidence=0.7), _step("c", confidence=0.85), _step("d")]
+    assert _run(policy, steps) == (3, "confidence", None)
+
+
+def test_convergence_stops_when_steps_repeat():
+    policy = ConvergencePolicy(window=2, similarity=0.6)
+    steps = [_step("first idea"), _step("so 1.3 is larger"), _step("so 1.3 is larger indeed"),
+             _step("so 1.3 is larger"), _step("other")]
+    assert _run(policy, steps) == (4, "convergence", None)
+    assert _run(policy, [_step(f"idea {i} " + "x" * i) for i in range(5)]) == (5, None, CONTINUE_PROMPT)
+
+
+def test_budget_stops_on_tokens_and_time():
+    assert _run(BudgetPolicy(max_tokens=250), [_step()] * 5) == (3, "budget", None)
+    assert _run(BudgetPolicy(max_seconds=0), [_step()] * 5) == (1, "budget", None)
+
+
+def test_reflect_and_max_steps():
+    policy = make_policy("adaptive")
+    assert _run(policy, [_step(next_action="reflect")])[2] == REFLECT_PROMPT
+    assert _run(policy, [_step(str(i)) for i in range(5)], max_steps=2) == (2, "max_steps", None)
+
+
+def test_composite_credits_stopping_policy():
+    policy = make_policy("adaptive", confidence=0.8)
+    state = ChainState(10)
+    for step in (_step("a", confidence=0.9), _step("b", confidence=0.9)):
+        state.add(step)
+        message = policy.next_message(state)
+    assert message is None and state.stopped_by == "confidence"
+    assert policy.finish(state) == 8
+    assert policy.calls_saved == 8
+    assert [p.calls_saved for p in policy.policies] == [8, 0, 0]
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        make_policy("nope")
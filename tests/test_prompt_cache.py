@@ -0,0 +1,61 @@
+import json
+from types import SimpleNamespace
+
+from llm.V4 import Chatbot
+from llm.capabilities import CapabilityRegistry
+from llm.prompt_cache import cache_style, cached_prompt_tokens, prompt_cache_summary, with_cache_breakpoints
+from llm.reasoning import generate_response, initial_messages
+
+STEP = {"title": "t", "content": "c", "next_action": "final_answer", "confidence": 0.9}
+
+
+def test_anthropic_breakpoints_on_system_and_last_message():
+    messages = initial_messages("q") + [{"role": "assistant", "content": [{"type": "text", "text": "a"}]}]
+    original = json.loads(json.dumps(messages))
+    marked = with_cache_breakpoints(messages, cache_style("claude-3-5-sonnet"))
+    assert messages == original
+    assert marked[0]["content"][-1] == {"type": "text", "text": messages[0]["content"],
+                                        "cache_control": {"type": "ephemeral"}}
+    assert marked[1] is messages[1]
+    assert marked[2]["content"][-1]["cache_control"] == {"type": "ephemeral"}
+    assert with_cache_breakpoints(messages, cache_style("gpt-4o")) is messages
+
+
+def test_cached_prompt_tokens_fields():
+    assert cached_prompt_tokens({"prompt_tokens": 10, "prompt_tokens_details": {"cached_tokens": 6}}) == 6
+    assert cached_prompt_tokens({"input_tokens": 10, "cache_read_input_tokens": 4}) == 4
+    assert cached_prompt_tokens(SimpleNamespace(prompt_tokens=10, prompt_tokens_details=None)) == 0
+    assert cached_prompt_tokens(None) == 0
+    summary = prompt_cache_summary([{"prompt_tokens": 10, "cached_tokens": 6}, {"prompt_tokens": 5}])
+    assert summary == {"prompt_tokens": 15, "cached_tokens": 6, "uncached_tokens": 9}
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+def test_chain_reports_cached_tokens_and_keeps_prefix_stable():
+    chatbot = Chatbot(api_key="k", capabilities=CapabilityRegistry(rules=()))
+    payloads = []
+
+    def post(payload, deadline, **kwargs):
+        payloads.append(json.loads(json.dumps(payload)))
+        usage = {"prompt_tokens": 100, "completion_tokens": 5, "prompt_tokens_details": {"cached_tokens": 60}}
+        return FakeResponse({"choices": [{"message": {"content": json.dumps(STEP)}, "finish_reason": "stop"}],
+                             "usage": usage})
+
+    chatbot._post = post
+    for steps, total_time, full_response in generate_response("q", max_steps=2, model="claude-3-5-sonnet",
+                                                               client=chatbot):
+        pass
+    assert full_response["prompt_cache"] == {"prompt_tokens": 300, "cached_tokens": 180, "uncached_tokens": 120}
+    assert [stats["cached_tokens"] for stats in full_response["step_stats"]] == [60, 60, 60]
+    # 断点只加在发送的副本上，前一步发送的消息（除去最后一条的断点）是后一步的前缀
+    first, second = payloads[0]["messages"], payloads[1]["messages"]
+    assert second[:len(first) - 1] == first[:-1]
+    assert second[len(first) - 1]["content"] == first[-1]["content"][0]["text"]
+    assert "cache_control" in second[-1]["content"][-1]
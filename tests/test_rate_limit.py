@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from llm.V4 import AsyncChatbot, Chatbot
+from llm.rate_limit import RateLimiter, TokenBucket, admission_session
+
+MESSAGES = [{"role": "user", "content": "q"}]
+
+
+def test_token_bucket_reserve_and_refund():
+    bucket = TokenBucket(60, capacity=2)
+    assert bucket.reserve(2, now=bucket.updated) == 0
+    assert bucket.reserve(1, now=bucket.updated) == pytest.approx(1.0)
+    bucket.adjust(2)
+    assert bucket.wait_time(1, now=bucket.updated) == 0
+
+
+def test_sessions_are_admitted_in_turn():
+    # 每秒 100 个 token，先耗尽额度，之后每个 10 token 的请求约 0.1 秒放行一个
+    limiter = RateLimiter(tpm=6000)
+    limiter.reserve("m", 6000)
+    order = []
+    lock_free = []
+
+    def on_wait(position, wait):
+        # 回调在限流器的锁外执行
+        lock_free.append(limiter._lock.acquire(blocking=False))
+        if lock_free[-1]:
+            limiter._lock.release()
+
+    def request(session, name):
+        with admission_session(session, on_wait):
+            limiter.acquire("m", 10)
+        order.append(name)
+
+    threads = []
+    for session, name in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")]:
+        threads.append(threading.Thread(target=request, args=(session, name)))
+        threads[-1].start()
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join(5)
+    # 会话 a 的三个请求不会把会话 b 挤到最后
+    assert order == ["a1", "b1", "a2", "a3"]
+    assert lock_free and all(lock_free)
+    assert limiter.queue_length() == 0
+
+
+def test_settle_refunds_unused_tokens():
+    limiter = RateLimiter(tpm=600)
+    limiter.reserve("m", 600)
+    assert limiter.wait_time("m", 100) > 0
+    limiter.settle("m", 600, 100)
+    assert limiter.wait_time("m", 100) == 0
+
+
+def test_cancelled_call_refunds_reservation():
+    limiter = RateLimiter(tpm=6000)
+    chatbot = Chatbot(api_key="k", rate_limiter=limiter)
+
+    def cancelled(deadline):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        chatbot._limited("m", MESSAGES, {"max_tokens": 5000}, cancelled)(None)
+    assert limiter.queue_length() == 0
+    assert limiter.wait_time("m", 6000, api_key="k") == 0
+
+
+def test_cancelled_async_call_refunds_reservation():
+    limiter = RateLimiter(tpm=6000)
+    chatbot = AsyncChatbot(api_key="k", rate_limiter=limiter)
+
+    async def hang(deadline):
+        await asyncio.sleep(10)
+
+    async def main():
+        task = asyncio.create_task(chatbot._limited("m", MESSAGES, {"max_tokens": 5000}, hang)(None))
+        await asyncio.sleep(0.01)
+        assert limiter.wait_time("m", 6000, api_key="k") > 0
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert limiter.wait_time("m", 6000, api_key="k") == 0
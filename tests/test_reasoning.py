@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+from llm.reasoning import agenerate_response, generate_response
+
+STEPS = [
+    {"title": "读题", "content": "比较 1.11 和 1.3", "next_action": "continue", "confidence": 0.6},
+    {"title": "比较", "content": "1.3 更大", "next_action": "final_answer", "confidence": 0.9},
+    {"title": "答案", "content": "1.3 更大", "next_action": "final_answer", "confidence": 0.9},
+]
+
+
+class FakeClient:
+    def __init__(self):
+        self.replies = list(STEPS)
+        self.prompts = []
+
+    def ask(self, model, prompt, **kwargs):
+        self.prompts.append([dict(message) for message in prompt])
+        return json.dumps(self.replies.pop(0)), 10, 5, False
+
+    async def ask_async(self, model, prompt, **kwargs):
+        return self.ask(model, prompt, **kwargs)
+
+
+def _shape(yields):
+    steps, total_time, full_response = yields[-1]
+    return {
+        "yields": [[step[:2] for step in steps] for steps, _, _ in yields],
+        "policy": full_response["policy"],
+        "prompt_cache": full_response["prompt_cache"],
+        "context_tokens": [stats["context_tokens"] for stats in full_response["step_stats"]],
+    }
+
+
+def test_sync_and_async_chains_match():
+    sync_client, async_client = FakeClient(), FakeClient()
+    sync_yields = list(generate_response("q", max_steps=2, client=sync_client))
+
+    async def collect():
+        return [item async for item in agenerate_response("q", max_steps=2, client=async_client)]
+
+    async_yields = asyncio.run(collect())
+    assert _shape(sync_yields) == _shape(async_yields)
+    assert sync_client.prompts == async_client.prompts
+    assert [step[0] for step in sync_yields[-1][0]] == ["读题", "比较", "最终答案"]
@@ -0,0 +1,166 @@
+import asyncio
+import threading
+
+import pytest
+
+from llm.retry import (
+    CallCancelled,
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceeded,
+    HTTPStatusError,
+    RetryPolicy,
+    cancel_scope,
+    raise_if_cancelled,
+)
+
+
+def _open(breaker, model="m"):
+    for _ in range(breaker.min_calls):
+        breaker.record(model, False)
+
+
+def _fail(deadline):
+    raise HTTPStatusError(503, "Service Unavailable", "")
+
+
+def test_breaker_opens_after_failures():
+    breaker = CircuitBreaker(window=4, min_calls=2, cooldown=60)
+    breaker.record("m", True)
+    assert breaker.state("m") == "closed"
+    _open(breaker)
+    assert breaker.state("m") == "open"
+    assert not breaker.allow("m")
+
+
+def test_half_open_probe_success_closes():
+    breaker = CircuitBreaker(window=4, min_calls=2, cooldown=0)
+    _open(breaker)
+    assert breaker.state("m") == "half_open"
+    assert breaker.allow("m")
+    # 同一时间只放行一个探测请求
+    assert not breaker.allow("m")
+    breaker.record("m", True)
+    assert breaker.state("m") == "closed"
+
+
+def test_half_open_probe_failure_reopens():
+    breaker = CircuitBreaker(window=4, min_calls=2, cooldown=60)
+    _open(breaker)
+    breaker.cooldown = 0
+    assert breaker.allow("m")
+    breaker.cooldown = 60
+    breaker.record("m", False)
+    assert breaker.state("m") == "open"
+
+
+def test_policy_short_circuits_when_open():
+    policy = RetryPolicy(max_attempts=1, breaker=CircuitBreaker(window=4, min_calls=2, cooldown=60))
+    for _ in range(2):
+        with pytest.raises(HTTPStatusError):
+            policy.call("m", _fail)
+    with pytest.raises(CircuitOpenError):
+        policy.call("m", lambda deadline: "ok")
+
+
+def test_cancelled_probe_is_released():
+    breaker = CircuitBreaker(window=4, min_calls=2, cooldown=0)
+    policy = RetryPolicy(breaker=breaker)
+    _open(breaker)
+
+    def cancelled(deadline):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        policy.call("m", cancelled)
+    # 探测被取消后不能一直停在半开状态，下一次调用重新探测
+    assert policy.call("m", lambda deadline: "ok") == "ok"
+    assert breaker.state("m") == "closed"
+
+
+def test_cancelled_call_keeps_other_probe():
+    breaker = CircuitBreaker(window=4, min_calls=2, cooldown=0)
+    policy = RetryPolicy(breaker=breaker)
+
+    def cancelled(deadline):
+        # 熔断器打开前已经放行的请求，在另一个请求探测期间被取消
+        _open(breaker)
+        assert breaker.allow("m")
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        policy.call("m", cancelled)
+    assert not breaker.allow("m")
+
+
+def test_cancelled_async_probe_is_released():
+    breaker = CircuitBreaker(window=4, min_calls=2, cooldown=0)
+    policy = RetryPolicy(breaker=breaker)
+    _open(breaker)
+
+    async def hang(deadline):
+        await asyncio.sleep(10)
+
+    async def ok(deadline):
+        return "ok"
+
+    async def main():
+        task = asyncio.create_task(policy.acall("m", hang))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return await policy.acall("m", ok)
+
+    assert asyncio.run(main()) == "ok"
+    assert breaker.state("m") == "closed"
+
+
+def test_deadline_is_not_an_outcome():
+    breaker = CircuitBreaker(window=4, min_calls=2, cooldown=0)
+    policy = RetryPolicy(breaker=breaker)
+    _open(breaker)
+
+    def expired(deadline):
+        raise DeadlineExceeded("deadline exceeded before request")
+
+    with pytest.raises(DeadlineExceeded):
+        policy.call("m", expired)
+    # 探测请求没有得到服务端的结果，熔断器不能因此关闭
+    assert breaker.state("m") == "half_open"
+    assert breaker.allow("m")
+
+
+def test_deadline_does_not_lower_failure_rate():
+    breaker = CircuitBreaker(window=4, min_calls=2, cooldown=60)
+    policy = RetryPolicy(max_attempts=1, breaker=breaker)
+
+    def expired(deadline):
+        raise DeadlineExceeded("deadline exceeded before request")
+
+    with pytest.raises(HTTPStatusError):
+        policy.call("m", _fail)
+    for _ in range(3):
+        with pytest.raises(DeadlineExceeded):
+            policy.call("m", expired)
+    with pytest.raises(HTTPStatusError):
+        policy.call("m", _fail)
+    assert breaker.state("m") == "open"
+
+
+def test_cancelled_hedge_probe_does_not_close():
+    breaker = CircuitBreaker(window=4, min_calls=2, cooldown=0)
+    policy = RetryPolicy(breaker=breaker)
+    _open(breaker)
+    stopped = threading.Event()
+
+    def hedge_lost(deadline):
+        # Chatbot._limited 在排队后发现调用已被放弃时抛出 CallCancelled
+        stopped.set()
+        raise_if_cancelled("m")
+
+    with cancel_scope(stopped):
+        with pytest.raises(CallCancelled):
+            policy.call("m", hedge_lost)
+    assert breaker.state("m") == "half_open"
+    assert breaker.allow("m")
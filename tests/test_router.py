@@ -0,0 +1,70 @@
+import threading
+import time
+
+from llm.retry import CircuitBreaker, HTTPStatusError, RetryPolicy
+from llm.router import Router
+
+
+class FakeMetrics:
+    def latency_percentiles(self, model, first_token=False):
+        return {"samples": 100, "p50": 0.01, "p95": 0.01}
+
+
+class FakeClient:
+    """模拟 Chatbot：每个模型的行为由 handlers 中的函数决定，调用经过真实的 RetryPolicy"""
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.metrics = FakeMetrics()
+        self.retry = RetryPolicy(max_attempts=5, base_delay=0.5, max_delay=0.5, breaker=CircuitBreaker(min_calls=100))
+        self.attempts = {model: 0 for model in handlers}
+
+    def ask(self, model, prompt, system_prompt=None, json_format=False, **kwargs):
+        def attempt(deadline):
+            self.attempts[model] += 1
+            return self.handlers[model]()
+
+        return self.retry.call(model, attempt)
+
+    def ask_stream(self, model, prompt, system_prompt=None, json_format=False, **kwargs):
+        yield from self.handlers[model]()
+
+    def close(self):
+        pass
+
+
+def _unavailable():
+    time.sleep(0.2)
+    raise HTTPStatusError(503, "Service Unavailable", "")
+
+
+def test_hedge_loser_stops_retrying():
+    client = FakeClient({"slow": _unavailable, "fast": lambda: ("ok", 1, 1, False)})
+    router = Router(client, {"slow": ["fast"]}, min_samples=1, min_hedge_delay=0.05)
+    assert router.ask("slow", "q")[0] == "ok"
+    time.sleep(0.5)
+    # 落败的请求完成当前尝试后不再重试
+    assert client.attempts["slow"] == 1
+    assert client.retry.stats()["slow"]["cancelled"] == 1
+    assert router.stats()["slow"]["hedge_wins"] == 1
+    router.close()
+
+
+def test_streams_do_not_hold_request_pool():
+    release = threading.Event()
+
+    def long_stream():
+        yield "a"
+        release.wait(5)
+        yield "b"
+
+    client = FakeClient({"stream": long_stream, "plain": lambda: ("ok", 1, 1, False)})
+    router = Router(client, hedge=False, max_workers=1)
+    streams = [router.ask_stream("stream", "q") for _ in range(3)]
+    assert [next(stream) for stream in streams] == ["a"] * 3
+    start = time.monotonic()
+    assert router.ask("plain", "q")[0] == "ok"
+    assert time.monotonic() - start < 1
+    release.set()
+    assert [list(stream) for stream in streams] == [["b"]] * 3
+    router.close()
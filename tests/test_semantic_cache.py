@@ -0,0 +1,81 @@
+from llm.semantic_cache import SemanticCache, normalize_prompt
+
+RESULT = {"steps": [["最终答案", "1.3 更大", 1.0]], "total_thinking_time": 1.0}
+PROMPT = "Which number is larger, 1.11 or 1.3? Explain your reasoning step by step."
+
+
+def test_normalize_prompt():
+    assert normalize_prompt("  Ｈｅｌｌｏ\n  World？ ") == "hello world"
+
+
+def test_exact_and_near_duplicates_hit():
+    cache = SemanticCache()
+    cache.put(PROMPT, "m", RESULT)
+    match = cache.lookup("which number is LARGER, 1.11 or 1.3 ?  explain your reasoning step by step", "m")
+    assert match.kind == "hit" and match.similarity >= cache.threshold
+    assert match.result == RESULT
+    assert cache.lookup("1.11和1.3哪个大？", "m") is None
+    cache.put("1.11和1.3哪个大？", "m", RESULT)
+    assert cache.lookup("1.11 和 1.3 哪个大", "m").kind == "hit"
+
+
+def test_seed_between_thresholds():
+    cache = SemanticCache(threshold=0.95, seed_threshold=0.5)
+    cache.put(PROMPT, "m", RESULT)
+    match = cache.lookup("Which number is larger, 1.11 or 1.3? Explain briefly.", "m")
+    assert match.kind == "seed"
+    assert cache.seed_threshold <= match.similarity < cache.threshold
+
+
+def test_unrelated_prompt_misses():
+    cache = SemanticCache()
+    cache.put(PROMPT, "m", RESULT)
+    assert cache.lookup("How many r are in the word strawberry?", "m") is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_numbers_and_models_must_match():
+    cache = SemanticCache()
+    cache.put(PROMPT, "m", RESULT)
+    assert cache.lookup(PROMPT.replace("1.3", "1.5"), "m") is None
+    assert cache.lookup(PROMPT, "other-model") is None
+
+
+def test_lru_eviction():
+    cache = SemanticCache(max_entries=2)
+    prompts = [f"{PROMPT} Case {i}." for i in range(3)]
+    for prompt in prompts[:2]:
+        cache.put(prompt, "m", RESULT)
+    assert cache.lookup(prompts[0], "m").kind == "hit"
+    cache.put(prompts[2], "m", RESULT)
+    assert cache.lookup(prompts[1], "m") is None
+    assert cache.lookup(prompts[0], "m").kind == "hit"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ttl_expires_entries():
+    cache = SemanticCache(ttl=-1)
+    cache.put(PROMPT, "m", RESULT)
+    assert cache.lookup(PROMPT, "m") is None
+
+
+def test_entries_survive_restart(tmp_path):
+    path = str(tmp_path / "semantic.db")
+    cache = SemanticCache(path=path)
+    cache.put(PROMPT, "m", RESULT)
+    cache.close()
+    reloaded = SemanticCache(path=path)
+    assert reloaded.lookup(PROMPT, "m").result == RESULT
+    reloaded.close()
+
+
+def test_negated_prompt_is_not_a_hit():
+    cache = SemanticCache()
+    cache.put(PROMPT, "m", RESULT)
+    negated = PROMPT.replace("is larger", "is not larger")
+    match = cache.lookup(negated, "m")
+    # 相似度高于 threshold，但措辞不同，只能作为参考
+    assert match.similarity >= cache.threshold
+    assert match.kind == "seed"
+    cache.put("1.11和1.3哪个大？", "m", RESULT)
+    assert cache.lookup("1.11和1.3哪个不大？", "m").kind == "seed"
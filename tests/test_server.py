@@ -0,0 +1,147 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from server import ChainServer
+
+STEP = {"title": "比较", "content": "1.3 更大", "next_action": "final_answer", "confidence": 0.95}
+
+
+class FakeClient:
+    """gate 不为 None 时每次调用都等待 gate 被设置"""
+
+    def __init__(self, gate=None):
+        self.gate = gate
+        self.calls = 0
+        self.cancelled = 0
+
+    async def ask_async(self, model, prompt, **kwargs):
+        self.calls += 1
+        if self.gate is not None:
+            try:
+                await self.gate.wait()
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+        return json.dumps(STEP), 10, 5, False
+
+
+def _args(**overrides):
+    args = dict(workers=2, queue_size=0, header_timeout=5, policy="adaptive", max_steps=3, max_steps_limit=5,
+                temperature=0.2, model="m", confidence_threshold=0.9, chain_timeout=None, chain_tokens=None,
+                context_budget=None, chain_deadline=None)
+    args.update(overrides)
+    return SimpleNamespace(**args)
+
+
+async def _start(client, **overrides):
+    chain_server = ChainServer(client, _args(**overrides))
+    server = await asyncio.start_server(chain_server.handle, "127.0.0.1", 0)
+    return chain_server, server, server.sockets[0].getsockname()[1]
+
+
+async def _open(port, method, path, body=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    data = json.dumps(body).encode() if body is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: x\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+    await writer.drain()
+    return reader, writer
+
+
+async def _request(port, method, path, body=None):
+    reader, writer = await _open(port, method, path, body)
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), payload.decode("utf-8")
+
+
+async def _wait_for(condition):
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not reached")
+
+
+def test_chain_request_and_stream():
+    async def main():
+        chain_server, server, port = await _start(FakeClient())
+        async with server:
+            status, body = await _request(port, "POST", "/v1/chains", {"prompt": "1.11 和 1.3 哪个大"})
+            assert status == 200
+            assert [step["title"] for step in json.loads(body)["steps"]] == ["比较", "最终答案"]
+            status, body = await _request(port, "POST", "/v1/chains/stream", {"prompt": "q"})
+            events = [block.split("\n")[0] for block in body.strip().split("\n\n")]
+            assert status == 200 and events == ["event: step", "event: step", "event: done"]
+        assert chain_server.status()["completed"] == 2
+
+    asyncio.run(main())
+
+
+def test_invalid_requests():
+    async def main():
+        chain_server, server, port = await _start(FakeClient())
+        async with server:
+            assert (await _request(port, "POST", "/v1/chains", {"model": "m"}))[0] == 400
+            assert (await _request(port, "POST", "/v1/chains", {"prompt": "q", "policy": "nope"}))[0] == 400
+            assert (await _request(port, "GET", "/v1/chains"))[0] == 405
+            assert (await _request(port, "GET", "/missing"))[0] == 404
+            assert (await _request(port, "GET", "/healthz"))[0] == 200
+        params = chain_server.parse_chain_request(b'{"prompt": "q", "max_steps": 99}')
+        assert params["max_steps"] == 5 and params["chain_id"] is None
+
+    asyncio.run(main())
+
+
+def test_disconnect_cancels_chain():
+    async def main():
+        client = FakeClient(gate=asyncio.Event())
+        chain_server, server, port = await _start(client)
+        async with server:
+            reader, writer = await _open(port, "POST", "/v1/chains/stream", {"prompt": "q"})
+            await _wait_for(lambda: client.calls == 1)
+            writer.close()
+            await _wait_for(lambda: chain_server.status()["cancelled"] == 1)
+            assert client.cancelled == 1
+            assert chain_server.status()["running"] == 0
+
+    asyncio.run(main())
+
+
+def test_drain_rejects_new_chains_and_cancels_stragglers():
+    async def main():
+        client = FakeClient(gate=asyncio.Event())
+        chain_server, server, port = await _start(client)
+        async with server:
+            reader, writer = await _open(port, "POST", "/v1/chains", {"prompt": "q"})
+            await _wait_for(lambda: client.calls == 1)
+            chain_server.draining = True
+            assert (await _request(port, "GET", "/readyz"))[0] == 503
+            assert (await _request(port, "POST", "/v1/chains", {"prompt": "q"}))[0] == 503
+            await chain_server.drain(timeout=0.05)
+            response = await reader.read()
+            assert response.startswith(b"HTTP/1.1 503") and b"Retry-After: 1" in response
+            writer.close()
+        assert chain_server.status()["cancelled"] == 1
+        assert chain_server.status()["rejected"] == 1
+
+    asyncio.run(main())
+
+
+def test_drain_waits_for_running_chain():
+    async def main():
+        gate = asyncio.Event()
+        client = FakeClient(gate=gate)
+        chain_server, server, port = await _start(client)
+        async with server:
+            pending = asyncio.create_task(_request(port, "POST", "/v1/chains", {"prompt": "q"}))
+            await _wait_for(lambda: client.calls == 1)
+            chain_server.draining = True
+            asyncio.get_running_loop().call_later(0.05, gate.set)
+            await chain_server.drain(timeout=5)
+            status, body = await pending
+            assert status == 200 and json.loads(body)["steps"][-1]["title"] == "最终答案"
+        assert chain_server.status()["completed"] == 1
+
+    asyncio.run(main())
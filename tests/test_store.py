@@ -0,0 +1,87 @@
+import json
+
+from llm.reasoning import generate_response
+from llm.store import ChainStore
+
+
+def _step(title, next_action="continue"):
+    return {"title": title, "content": f"{title} 的内容", "next_action": next_action, "confidence": 0.8}
+
+
+class ScriptedClient:
+    """按顺序返回 replies，遇到异常对象时抛出"""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.prompts = []
+
+    def ask(self, model, prompt, **kwargs):
+        self.prompts.append([dict(message) for message in prompt])
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return json.dumps(reply), 1, 1, False
+
+
+def _run(client, **kwargs):
+    for steps, total_time, full_response in generate_response("q", client=client, **kwargs):
+        pass
+    return steps, full_response
+
+
+def test_failed_chain_resumes_from_last_good_step():
+    store = ChainStore()
+    client = ScriptedClient([_step("一"), RuntimeError("boom"), _step("答案")])
+    steps, full_response = _run(client, max_steps=2, store=store, chain_id="c1")
+    assert [s[0] for s in steps] == ["一", "错误", "最终答案"]
+    assert store.get("c1")["status"] == "failed"
+    assert [s["title"] for s in store.load("c1")["steps"]] == ["一"]
+
+    client = ScriptedClient([_step("二", "final_answer"), _step("答案")])
+    steps, full_response = _run(client, max_steps=2, store=store, chain_id="c1")
+    assert [s[0] for s in steps] == ["一", "二", "最终答案"]
+    # 继续时发送的消息与第 1 步完成时的消息相同，不重新请求第 1 步
+    assert client.prompts[0] == store.load("c1", upto=1)["messages"]
+    chain = store.get("c1")
+    assert (chain["status"], chain["steps"]) == ("done", 2)
+    assert full_response["chain_id"] == "c1"
+
+
+def test_finished_chain_returns_saved_result():
+    store = ChainStore()
+    _run(ScriptedClient([_step("一", "final_answer"), _step("答案")]), max_steps=1, store=store, chain_id="c1")
+    client = ScriptedClient([])
+    steps, full_response = _run(client, max_steps=1, store=store, chain_id="c1")
+    assert not client.prompts
+    assert [s[0] for s in steps] == ["一", "最终答案"]
+    assert full_response["chain_id"] == "c1"
+
+
+def test_resume_from_earlier_step():
+    store = ChainStore()
+    _run(ScriptedClient([_step("一"), _step("二", "final_answer"), _step("答案")]), max_steps=2, store=store,
+         chain_id="c1")
+    client = ScriptedClient([_step("新的二", "final_answer"), _step("新答案")])
+    steps, _ = _run(client, max_steps=2, store=store, chain_id="c1", resume_from=1)
+    assert [s[0] for s in steps] == ["一", "新的二", "最终答案"]
+    assert len(client.prompts) == 2
+
+
+def test_branch_and_list(tmp_path):
+    path = str(tmp_path / "chains.db")
+    store = ChainStore(path)
+    _run(ScriptedClient([_step("一"), _step("二", "final_answer"), _step("答案")]), max_steps=2, store=store,
+         chain_id="c1")
+    store.branch("c1", 1, "c2")
+    store.close()
+
+    store = ChainStore(path)
+    branch = store.load("c2")
+    assert (branch["parent_id"], branch["parent_step"], branch["status"]) == ("c1", 1, "running")
+    assert [s["title"] for s in branch["steps"]] == ["一"]
+    assert branch["messages"] == store.load("c1", upto=1)["messages"]
+    assert {chain["id"] for chain in store.list_chains(prompt="q")} == {"c1", "c2"}
+    assert [chain["id"] for chain in store.list_chains(status="done")] == ["c1"]
+    store.delete("c2")
+    assert store.get("c2") is None
+    store.close()
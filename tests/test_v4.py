@@ -0,0 +1,102 @@
+import asyncio
+import json
+
+import llm.V4
+from llm.V4 import AsyncChatbot, Chatbot
+from llm.capabilities import CapabilityRegistry
+from llm.metrics import CallMetrics, MetricsRegistry
+from llm.retry import HTTPStatusError
+from llm.reasoning import StepResultModel
+
+STEP = {"title": "t", "content": "c", "next_action": "continue", "confidence": 0.5}
+
+
+def _check(monkeypatch, content, fixed=None):
+    chatbot = Chatbot(api_key="k")
+    instructor_calls = []
+    monkeypatch.setattr(llm.V4, "try_fix_json_format", lambda text: fixed)
+
+    def ask_instructor(**kwargs):
+        instructor_calls.append(kwargs)
+        return json.dumps(STEP), 1, 1, False
+
+    monkeypatch.setattr(chatbot, "_ask_instructor", ask_instructor)
+    call = CallMetrics(model="m")
+    result = chatbot._check_json("m", [], (content, 1, 1, False), StepResultModel, call=call)
+    return result, call, instructor_calls
+
+
+def test_truncated_step_falls_through_to_instructor(monkeypatch):
+    result, call, instructor_calls = _check(monkeypatch, '{"title": "Step", "content": "truncated...')
+    assert json.loads(result[0]) == STEP
+    assert call.json_tier == "instructor"
+    assert len(instructor_calls) == 1
+
+
+def test_llm_fix_must_match_model(monkeypatch):
+    result, call, _ = _check(monkeypatch, "{", fixed=json.dumps({"title": "t"}))
+    assert call.json_tier == "instructor"
+    result, call, _ = _check(monkeypatch, "{", fixed=json.dumps(STEP))
+    assert call.json_tier == "llm_fix"
+
+
+def test_valid_repair_is_local(monkeypatch):
+    result, call, instructor_calls = _check(monkeypatch, json.dumps(STEP)[:-1] + ",}")
+    assert json.loads(result[0]) == STEP
+    assert call.json_tier == "local_repair"
+    assert not instructor_calls
+
+
+def _rejecting_request(requests):
+    def ask_request(structured=None, **kwargs):
+        requests.append(structured is not None)
+        if structured is not None:
+            raise HTTPStatusError(400, "Bad Request", "response_format is not supported")
+        return "{", 1, 1, False
+
+    return ask_request
+
+
+def test_sync_and_async_clients_share_call_flow(monkeypatch):
+    monkeypatch.setattr(llm.V4, "try_fix_json_format", lambda text: json.dumps(STEP))
+    results = []
+    for client_class in (Chatbot, AsyncChatbot):
+        registry = MetricsRegistry()
+        chatbot = client_class(api_key="k", metrics=registry, capabilities=CapabilityRegistry())
+        requests = []
+        ask_request = _rejecting_request(requests)
+        if client_class is AsyncChatbot:
+            async def async_request(**kwargs):
+                return ask_request(**kwargs)
+
+            monkeypatch.setattr(chatbot, "_ask_request", async_request)
+            result = asyncio.run(chatbot.ask_async("gpt-4o", "q", json_format=True, response_model=StepResultModel))
+        else:
+            monkeypatch.setattr(chatbot, "_ask_request", ask_request)
+            result = chatbot.ask("gpt-4o", "q", json_format=True, response_model=StepResultModel)
+        call = registry.recent_calls()[-1]
+        results.append((result, requests, call["json_tier"], call["error"], chatbot.capabilities.mode("gpt-4o")))
+    assert results[0] == results[1]
+    assert results[0] == ((json.dumps(STEP), 1, 1, False), [True, False], "llm_fix", None, "json_object")
+
+
+def test_cancelled_async_call_is_recorded():
+    registry = MetricsRegistry()
+    chatbot = AsyncChatbot(api_key="k", metrics=registry)
+
+    async def hang(**kwargs):
+        await asyncio.sleep(10)
+
+    chatbot._ask_request = hang
+
+    async def main():
+        task = asyncio.create_task(chatbot.ask_async("m", "q"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
+    assert registry.recent_calls()[-1]["error"] == "cancelled"